@@ -0,0 +1,46 @@
+# Measure the resolution of the OpenIMIS models (get_policy_model and the
+# like), memoized by get_openimis_model, against their resolution on each
+# call through the app registry or, for the custom models of the test
+# settings, the import of their module.
+#
+#   python -m benchmarks.bench_model_resolution [--calls 100000]
+import argparse
+import os
+import timeit
+
+import django
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the resolution of the OpenIMIS models')
+    parser.add_argument('--calls', type=int, default=100000)
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE',
+                          'qmoney_payment.test_settings')
+    django.setup()
+    # pylint: disable=import-outside-toplevel
+    from qmoney_payment.models import utils
+    from qmoney_payment.models.mutation_log import APP_NAME as MUTATION_LOG_APP, MODEL_NAME as MUTATION_LOG_MODEL
+    from qmoney_payment.models.policy import APP_NAME as POLICY_APP, MODEL_NAME as POLICY_MODEL
+    from qmoney_payment.models.premium import APP_NAME as PREMIUM_APP, MODEL_NAME as PREMIUM_MODEL
+
+    print(f'{"model":>12} {"memoized ns":>12} {"resolved ns":>12} '
+          f'{"speedup":>8}')
+    for app, name in ((POLICY_APP, POLICY_MODEL),
+                      (PREMIUM_APP, PREMIUM_MODEL),
+                      (MUTATION_LOG_APP, MUTATION_LOG_MODEL)):
+        utils.get_openimis_model(app, name)
+        memoized = timeit.timeit(
+            lambda app=app, name=name: utils.get_openimis_model(app, name),
+            number=args.calls) / args.calls * 1e9
+        resolved = timeit.timeit(
+            lambda app=app, name=name: utils.resolve_openimis_model(app, name),
+            number=args.calls) / args.calls * 1e9
+        print(f'{name:>12} {memoized:>12.0f} {resolved:>12.0f} '
+              f'{resolved / memoized:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
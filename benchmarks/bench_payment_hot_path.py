@@ -0,0 +1,404 @@
+# Measure the request -> proceed -> premium creation hot path, from the
+# GraphQL mutations of schema.py down to the services and the models, with
+# the test settings, a throwaway SQLite DB and the fake QMoney gateway. For
+# each level of concurrent payers, it reports the latency percentiles and the
+# DB queries of each operation. The allocations are measured in a separate
+# sequential pass, tracemalloc being too slow to be left on while timing.
+#
+#   python -m benchmarks.bench_payment_hot_path [--concurrency 1 10 100] \
+#       [--rounds 5] [--output results.json] [--compare previous.json]
+#
+# Another DJANGO_SETTINGS_MODULE (e.g. pointing to PostgreSQL) can be given
+# through the environment, the DB is then expected to be an empty one.
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+
+OTP = '123456'
+
+REQUEST_MUTATION = '''
+mutation {
+  requestQmoneyPayment(policyUuid: "%s", amount: %i, payerWallet: "%s") {
+    qmoneyPayment { uuid status externalTransactionId }
+    ok
+  }
+}
+'''
+
+PROCEED_MUTATION = '''
+mutation {
+  proceedQmoneyPayment(uuid: "%s", otp: "%s") {
+    qmoneyPayment { uuid status premiumUuid }
+    ok
+  }
+}
+'''
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def setup_django(database_path):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE',
+                          'qmoney_payment.test_settings')
+    from django.conf import settings  # pylint: disable=import-outside-toplevel
+    database = settings.DATABASES['default']
+    if database['ENGINE'] == 'django.db.backends.sqlite3':
+        database['NAME'] = database_path
+        # let the concurrent payers wait for the write lock
+        database.setdefault('OPTIONS', {})['timeout'] = 120
+        serialize_sqlite_transactions()
+    django.setup()
+    # the failed mutations are counted, no need for their traceback
+    logging.getLogger('graphql').setLevel(logging.CRITICAL)
+
+
+def serialize_sqlite_transactions():
+    # SQLite fails at once, instead of waiting, when a transaction which has
+    # read the DB tries to write in it while another one is writing. Taking
+    # the write lock at the start of the transactions makes the concurrent
+    # payers wait for each other, as they would with a DB server.
+    from django.db.backends.sqlite3.base import DatabaseWrapper  # pylint: disable=import-outside-toplevel
+
+    def start_transaction_under_autocommit(self):
+        self.cursor().execute('BEGIN IMMEDIATE')
+
+    DatabaseWrapper._start_transaction_under_autocommit = start_transaction_under_autocommit  # pylint: disable=protected-access
+
+
+def create_tables():
+    # pylint: disable=import-outside-toplevel
+    from qmoney_payment.models.qmoney_payment import QMoneyPayment
+    from qmoney_payment.models.qmoney_payment_outbox import QMoneyPaymentOutbox
+    from qmoney_payment.models.qmoney_payment_policy_summary import QMoneyPaymentPolicySummary
+    from qmoney_payment.tests.fake_mutation_log import FakeMutationLog
+    from qmoney_payment.tests.fake_policy import FakePolicy
+    from qmoney_payment.tests.fake_premium import FakePremium
+    from qmoney_payment.tests.fakemodel_helpers import setup_table_for
+    for model in (FakePolicy, FakePremium, FakeMutationLog, QMoneyPayment,
+                  QMoneyPaymentPolicySummary, QMoneyPaymentOutbox):
+        setup_table_for(model)
+
+
+def plug_gateway(gateway):
+    # pylint: disable=import-outside-toplevel
+    from django.apps import apps
+    from qmoney_payment.api.client import Client as QMoneyClient
+    config = apps.get_app_config('qmoney_payment')
+    config.session = QMoneyClient.session(gateway.url, gateway.username,
+                                          gateway.password,
+                                          gateway.login_token,
+                                          {'pool_maxsize': 100})
+    config.merchant = config.session.merchant('payee', '1234')
+
+
+def percentile(sorted_values, rank):
+    if not sorted_values:
+        return None
+    index = max(0, int(round(rank / 100 * len(sorted_values))) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+class Recorder:
+    # Collect the duration and the number of DB queries of the operations
+    # made by all the threads.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def measure(self, name, func, *args, **kwargs):
+        # pylint: disable=import-outside-toplevel
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries:
+            started_at = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                with self.lock:
+                    self.errors[name] += 1
+                raise
+            finally:
+                elapsed = time.perf_counter() - started_at
+                with self.lock:
+                    self.durations[name].append(elapsed)
+                    self.queries[name].append(len(queries))
+
+    def error(self, name):
+        with self.lock:
+            self.errors[name] += 1
+
+    def summary(self):
+        operations = {}
+        for name, durations in self.durations.items():
+            durations = sorted(durations)
+            queries = self.queries[name]
+            latency = {
+                f'p{rank}': percentile(durations, rank) * 1000
+                for rank in PERCENTILES
+            }
+            latency['mean'] = sum(durations) / len(durations) * 1000
+            latency['max'] = durations[-1] * 1000
+            operations[name] = {
+                'count': len(durations),
+                'errors': self.errors[name],
+                'latency_ms': latency,
+                'queries': {
+                    'mean': sum(queries) / len(queries),
+                    'max': max(queries),
+                },
+            }
+        return operations
+
+
+class HotPath:
+
+    def __init__(self, recorder):
+        # pylint: disable=import-outside-toplevel
+        import graphene
+        from graphene.test import Client
+        from django.test import RequestFactory
+        from qmoney_payment import services
+        from qmoney_payment.schema import Mutation, Query
+        from qmoney_payment.tests.helpers import Struct
+
+        self.recorder = recorder
+        self.client = Client(graphene.Schema(query=Query, mutation=Mutation))
+        self.user = Struct(id=1,
+                           id_for_audit='1',
+                           username='bench',
+                           has_perms=lambda permissions: True)
+        self.request_factory = RequestFactory()
+        # the premium creation is measured on its own, within the proceed
+        self.services = services
+        self.create_premium_for = services.create_premium_for
+        services.create_premium_for = lambda *args: recorder.measure(
+            'create_premium_for', self.create_premium_for, *args)
+
+    def close(self):
+        self.services.create_premium_for = self.create_premium_for
+
+    def context(self):
+        context = self.request_factory.post('/graphql')
+        context.user = self.user
+        return context
+
+    def execute(self, name, query):
+        result = self.recorder.measure(name,
+                                       self.client.execute,
+                                       query,
+                                       context_value=self.context())
+        data = (result.get('data') or {}).get(name)
+        if result.get('errors') or not data or not data.get('ok'):
+            self.recorder.error(name)
+            return None
+        return data['qmoneyPayment']
+
+    def pay(self, policy_uuid):
+        payment = self.execute('requestQmoneyPayment',
+                               REQUEST_MUTATION % (policy_uuid, 1, 'payer'))
+        if payment is not None:
+            self.execute('proceedQmoneyPayment',
+                         PROCEED_MUTATION % (payment['uuid'], OTP))
+
+
+def create_policies(count):
+    # pylint: disable=import-outside-toplevel
+    from qmoney_payment.models.policy import get_policy_model
+    policy_model = get_policy_model()
+    return [
+        str(
+            policy_model.objects.create(
+                status=policy_model.STATUS_IDLE).uuid) for _ in range(count)
+    ]
+
+
+def run_concurrently(concurrency, rounds):
+    from django.db import connections  # pylint: disable=import-outside-toplevel
+    recorder = Recorder()
+    hot_path = HotPath(recorder)
+    policies = create_policies(concurrency * rounds)
+    barrier = threading.Barrier(concurrency)
+
+    def payer(index):
+        barrier.wait()
+        try:
+            for policy_uuid in policies[index::concurrency]:
+                hot_path.pay(policy_uuid)
+        finally:
+            connections.close_all()
+
+    started_at = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(payer, range(concurrency)))
+    finally:
+        hot_path.close()
+    elapsed = time.perf_counter() - started_at
+    return {
+        'concurrency': concurrency,
+        'payers': len(policies),
+        'elapsed_s': elapsed,
+        'payments_per_second': len(policies) / elapsed,
+        'operations': recorder.summary(),
+    }
+
+
+class AllocationRecorder(Recorder):
+    # tracemalloc traces all the threads, so the payers run one at a time
+
+    def __init__(self):
+        super().__init__()
+        self.allocations = defaultdict(list)
+
+    def measure(self, name, func, *args, **kwargs):
+        if name == 'create_premium_for':
+            # nested in the proceed, which is measured as a whole
+            return func(*args, **kwargs)
+        tracemalloc.clear_traces()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            retained, peak = tracemalloc.get_traced_memory()
+            self.allocations[name].append((peak, retained))
+
+    def summary(self):
+        summary = {}
+        for name, allocations in self.allocations.items():
+            peaks = sorted(peak for peak, _retained in allocations)
+            retained = sorted(retained for _peak, retained in allocations)
+            summary[name] = {
+                'count': len(allocations),
+                'peak_kib_p50': percentile(peaks, 50) / 1024,
+                'retained_kib_p50': percentile(retained, 50) / 1024,
+            }
+        return summary
+
+
+def measure_allocations(payers):
+    recorder = AllocationRecorder()
+    hot_path = HotPath(recorder)
+    policies = create_policies(payers)
+    tracemalloc.start()
+    try:
+        for policy_uuid in policies:
+            hot_path.pay(policy_uuid)
+    finally:
+        tracemalloc.stop()
+        hot_path.close()
+    return recorder.summary()
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              capture_output=True,
+                              text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(report, previous=None):
+    previous_runs = {
+        run['concurrency']: run
+        for run in (previous or {}).get('results', [])
+    }
+    for run in report['results']:
+        print(f'\n{run["concurrency"]} concurrent payers, {run["payers"]} '
+              f'payments, {run["payments_per_second"]:.1f} payments/s')
+        print(f'{"operation":<24}{"p50 ms":>9}{"p90 ms":>9}{"p99 ms":>9}'
+              f'{"max ms":>9}{"queries":>9}{"errors":>8}')
+        for name, operation in run['operations'].items():
+            latency = operation['latency_ms']
+            line = (f'{name:<24}{latency["p50"]:>9.2f}{latency["p90"]:>9.2f}'
+                    f'{latency["p99"]:>9.2f}{latency["max"]:>9.2f}'
+                    f'{operation["queries"]["mean"]:>9.1f}'
+                    f'{operation["errors"]:>8}')
+            before = previous_runs.get(run['concurrency'],
+                                       {}).get('operations', {}).get(name)
+            if before is not None:
+                change = latency['p50'] / before['latency_ms']['p50'] - 1
+                line += (f'   p50 {change:+.0%}, queries '
+                         f'{before["queries"]["mean"]:.1f} -> '
+                         f'{operation["queries"]["mean"]:.1f}')
+            print(line)
+    print('\nallocations per operation (sequential)')
+    for name, allocation in report['allocations'].items():
+        print(f'{name:<24} peak {allocation["peak_kib_p50"]:>9.1f} KiB'
+              f'  retained {allocation["retained_kib_p50"]:>9.1f} KiB')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency',
+                        type=int,
+                        nargs='+',
+                        default=[1, 10, 100])
+    parser.add_argument('--rounds',
+                        type=int,
+                        default=5,
+                        help='payments made by each concurrent payer')
+    parser.add_argument('--allocation-payers', type=int, default=20)
+    parser.add_argument('--latency',
+                        default='fixed:0',
+                        help='latency of the fake gateway, e.g. fixed:0.05')
+    parser.add_argument('--output', help='where to save the JSON results')
+    parser.add_argument('--compare',
+                        help='JSON results of a previous run to compare to')
+    args = parser.parse_args()
+
+    from qmoney_payment.tests.fake_qmoney_gateway import FakeQMoneyGateway  # pylint: disable=import-outside-toplevel
+
+    with tempfile.TemporaryDirectory() as directory:
+        setup_django(os.path.join(directory, 'bench.sqlite3'))
+        create_tables()
+        with FakeQMoneyGateway(latency=args.latency, otp=OTP,
+                               seed=0) as gateway:
+            plug_gateway(gateway)
+            report = {
+                'metadata': {
+                    'benchmark': 'payment_hot_path',
+                    'created_at': datetime.datetime.now().isoformat(),
+                    'revision': git_revision(),
+                    'python': platform.python_version(),
+                    'django': django.get_version(),
+                    'platform': platform.platform(),
+                    'database': django.conf.settings.DATABASES['default']
+                    ['ENGINE'],
+                    'gateway_latency': args.latency,
+                    'rounds': args.rounds,
+                },
+                'results': [
+                    run_concurrently(concurrency, args.rounds)
+                    for concurrency in args.concurrency
+                ],
+                'allocations': measure_allocations(args.allocation_payers),
+            }
+
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as previous_file:
+            previous = json.load(previous_file)
+    print_results(report, previous)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# Compare the creation of the premiums of proceeded payments one by one, with
+# create_premium_for, and all at once, with create_premiums_for, with the test
+# settings and a throwaway SQLite DB. For each number of payments, it reports
+# the elapsed time and the DB queries of both paths.
+#
+#   python -m benchmarks.bench_premium_creation [--payments 1 10 100] \
+#       [--rounds 5]
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks.bench_payment_hot_path import create_tables, setup_django
+
+
+def proceeded_payments(count):
+    # pylint: disable=import-outside-toplevel
+    from qmoney_payment.models.policy import get_policy_model
+    from qmoney_payment.models.qmoney_payment import QMoneyPayment
+    policy_model = get_policy_model()
+    return [
+        QMoneyPayment.objects.create(policy=policy_model.objects.create(
+            status=policy_model.STATUS_IDLE),
+                                     amount=1,
+                                     payer_wallet='payer',
+                                     status=QMoneyPayment.Status.P)
+        for _ in range(count)
+    ]
+
+
+def one_by_one(qmoney_payments, user):
+    from qmoney_payment.services import create_premium_for  # pylint: disable=import-outside-toplevel
+    for qmoney_payment in qmoney_payments:
+        create_premium_for(qmoney_payment, user)
+
+
+def all_at_once(qmoney_payments, user):
+    from qmoney_payment.services import create_premiums_for  # pylint: disable=import-outside-toplevel
+    create_premiums_for(qmoney_payments, user)
+
+
+def measure(create, count, rounds):
+    # pylint: disable=import-outside-toplevel
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from qmoney_payment.tests.helpers import Struct
+    user = Struct(id=1, id_for_audit='1', username='bench')
+    durations = []
+    queries = 0
+    for _ in range(rounds):
+        qmoney_payments = proceeded_payments(count)
+        with CaptureQueriesContext(connection) as captured:
+            started_at = time.perf_counter()
+            create(qmoney_payments, user)
+            durations.append(time.perf_counter() - started_at)
+        queries = len(captured)
+    return {
+        'mean_ms': sum(durations) / len(durations) * 1000,
+        'min_ms': min(durations) * 1000,
+        'queries': queries,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=
+        'Compare the creation of premiums one by one and all at once')
+    parser.add_argument('--payments', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        setup_django(os.path.join(directory, 'bench.sqlite3'))
+        create_tables()
+        print(f'{"payments":>8} {"path":>12} {"mean ms":>9} {"min ms":>9} '
+              f'{"queries":>8}')
+        for count in args.payments:
+            for name, create in (('one by one', one_by_one),
+                                 ('all at once', all_at_once)):
+                result = measure(create, count, args.rounds)
+                print(f'{count:>8} {name:>12} {result["mean_ms"]:>9.2f} '
+                      f'{result["min_ms"]:>9.2f} {result["queries"]:>8}')
+
+
+if __name__ == '__main__':
+    main()
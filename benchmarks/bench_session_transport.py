@@ -0,0 +1,63 @@
+# Compare the throughput of Session against a local fake QMoney gateway when
+# every call opens a new connection (as it was done with `requests.post`) and
+# when the calls go through the pooled keep-alive Transport.
+#
+#   python -m benchmarks.bench_session_transport [--calls 2000] [--threads 8]
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from qmoney_payment.api.session import Session
+from qmoney_payment.api.transport import Transport
+from qmoney_payment.tests.fake_qmoney_gateway import FakeQMoneyGateway
+
+
+class UnpooledTransport(Transport):
+
+    def post(self, url, json, auth, timeout=None):
+        return requests.post(url=url,
+                             json=json,
+                             auth=auth,
+                             timeout=timeout or self.timeout())
+
+
+def run(gateway, transport, calls, threads):
+    session = Session(gateway.url, gateway.username, gateway.password,
+                      gateway.login_token, transport)
+    session.login()
+    connections_before = gateway.connections
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(
+            executor.map(
+                lambda _: session.get_money('payer', 'payee', 1, '1234').ok,
+                range(calls)))
+    elapsed = time.perf_counter() - started_at
+    assert all(results)
+    return {
+        'requests_per_second': calls / elapsed,
+        'connections': gateway.connections - connections_before,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    with FakeQMoneyGateway() as gateway:
+        for name, transport in (
+            ('requests.post (before)', UnpooledTransport()),
+            ('pooled Transport (after)',
+             Transport(pool_maxsize=args.threads)),
+        ):
+            result = run(gateway, transport, args.calls, args.threads)
+            print(f'{name:<26} {result["requests_per_second"]:>10.1f} req/s'
+                  f' {result["connections"]:>6} connections')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+class AccessToken:
+    value = None
+    expires_at = None
+
+    def __init__(self, value, expires_at=None):
+        self.value = value
+        self.expires_at = expires_at
+
+    @classmethod
+    def from_login_data(cls, data, now):
+        # QMoney answers `accessTokenExpiry: -1` when the token never expires,
+        # we also accept the OAuth `expires_in`, both in seconds
+        expires_in = data.get('expires_in', data.get('accessTokenExpiry'))
+        try:
+            expires_in = float(expires_in)
+        except (TypeError, ValueError):
+            expires_in = -1
+        expires_at = now + expires_in if expires_in > 0 else None
+        return cls(data['access_token'], expires_at)
+
+    def is_expired(self, now, margin=0):
+        return self.expires_at is not None and now >= self.expires_at - margin
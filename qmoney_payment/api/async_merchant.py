@@ -0,0 +1,14 @@
+from qmoney_payment.api.async_payment_transaction import AsyncPaymentTransaction
+from qmoney_payment.api.merchant import Merchant
+
+
+class AsyncMerchant(Merchant):
+
+    async def request_payment(self, session, from_wallet_id, amount):
+        payment_transaction = AsyncPaymentTransaction(session, self,
+                                                      from_wallet_id, amount)
+        await payment_transaction.request_otp()
+        return payment_transaction
+
+    async def proceed(self, payment_transaction, otp):
+        return await payment_transaction.proceed(otp)
@@ -0,0 +1,30 @@
+from django.utils.translation import gettext as _
+
+from qmoney_payment.api.payment_transaction import PaymentTransaction
+
+
+class AsyncPaymentTransaction(PaymentTransaction):
+    # Same states and transitions as PaymentTransaction, but the calls to
+    # QMoney are awaited through an AsyncSession
+
+    async def request_otp(self):
+        response = await self.session.get_money(self.from_wallet_id,
+                                                self.to_merchant.wallet_id,
+                                                self.amount_to_pay,
+                                                self.to_merchant.pin_code)
+        return self.set_state_after_request(response)
+
+    async def proceed(self, otp):
+        if self.transaction_id is None:
+            return False, _('qmoney_payment.proceed.error.transaction_empty')
+        if otp is None:
+            return False, _('qmoney_payment.proceed.error.otp_empty')
+        response = await self.session.verify_code(self.transaction_id, otp)
+        return self.set_state_after_proceed(response)
+
+    async def fetch_state(self):
+        if self.transaction_id is None:
+            return False, _('qmoney_payment.proceed.error.transaction_empty')
+        response = await self.session.get_transaction_status(
+            self.transaction_id)
+        return self.set_state_after_status(response)
@@ -0,0 +1,132 @@
+import logging
+
+import httpx
+
+from qmoney_payment.api.async_merchant import AsyncMerchant
+from qmoney_payment.api.async_transport import AsyncTransport
+from qmoney_payment.api.auth_base import QMoneyBasicAuth, QMoneyBearerAuth
+from qmoney_payment.api.gateway_response import GatewayError, GatewayResponse
+from qmoney_payment.api.resilience import Resilience
+from qmoney_payment.api.session import Session
+from qmoney_payment.api.token_manager import AccessToken, AsyncTokenManager, DEFAULT_REFRESH_MARGIN
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSession:
+    url = None
+    username = None
+    password = None
+    login_token = None
+    transport = None
+    tokens = None
+    resilience = None
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self,
+            url,
+            username,
+            password,
+            login_token,
+            transport=None,
+            refresh_margin=DEFAULT_REFRESH_MARGIN,
+            token_store=None,
+            resilience=None):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.login_token = login_token
+        self.transport = transport if transport is not None else AsyncTransport(
+        )
+        self.resilience = resilience if resilience is not None else Resilience(
+        )
+        self.tokens = AsyncTokenManager(self.fetch_access_token,
+                                        refresh_margin,
+                                        store=token_store)
+
+    @property
+    def access_token(self):
+        return self.tokens.current()
+
+    def is_logged_in(self):
+        return self.access_token is not None
+
+    async def login(self):
+        return await self.tokens.get()
+
+    async def fetch_access_token(self):
+        payload = Session.login_payload(self.username, self.password)
+        response = await self.post('login', payload,
+                                   QMoneyBasicAuth(self.login_token))
+        if not response.ok or 'access_token' not in response.data:
+            raise GatewayError(response)
+        return AccessToken.from_login_data(response.data, self.tokens.clock())
+
+    async def post(self, endpoint, payload, auth):
+        return await self.resilience.call_async(
+            endpoint, lambda timeout: self.post_once(
+                endpoint, payload, auth, timeout), self.transport.timeout())
+
+    async def post_once(self, endpoint, payload, auth, timeout):
+        try:
+            response = await self.transport.post(url=f'{self.url}/{endpoint}',
+                                                 json=payload,
+                                                 auth=auth,
+                                                 timeout=timeout)
+        except (httpx.ConnectError, httpx.ConnectTimeout,
+                httpx.PoolTimeout) as error:
+            # the request has not been sent
+            return GatewayResponse.from_error(
+                GatewayResponse.Kind.CONNECT_ERROR, error)
+        except httpx.HTTPError as error:
+            return GatewayResponse.from_error(
+                GatewayResponse.Kind.TRANSPORT_ERROR, error)
+        return GatewayResponse.from_http(response.status_code,
+                                         response.content)
+
+    async def post_with_access_token(self, endpoint, payload):
+        logger.debug('POST /%s with payload:\n%s', endpoint, payload)
+        with self.resilience.deadline():
+            response = await self.__post_with_access_token(endpoint, payload)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('POST /%s response:\n%s', endpoint, response.text)
+        return response
+
+    async def __post_with_access_token(self, endpoint, payload):
+        try:
+            access_token = await self.login()
+            response = await self.post(endpoint, payload,
+                                       QMoneyBearerAuth(access_token))
+            if response.kind is GatewayResponse.Kind.UNAUTHORIZED:
+                # the token has been revoked or has expired earlier than
+                # announced
+                await self.tokens.invalidate(access_token)
+                access_token = await self.tokens.refresh(access_token)
+                response = await self.post(endpoint, payload,
+                                           QMoneyBearerAuth(access_token))
+        except GatewayError as error:
+            response = GatewayResponse.from_error(
+                GatewayResponse.Kind.LOGIN_FAILED, error)
+        return response
+
+    async def get_money(self, payer_wallet_id, merchant_wallet_id, amount,
+                        merchant_pin_code):
+        payload = Session.get_money_payload(payer_wallet_id,
+                                            merchant_wallet_id, amount,
+                                            merchant_pin_code)
+        return await self.post_with_access_token('getMoney', payload)
+
+    async def verify_code(self, transaction_id, otp):
+        payload = Session.verify_code_payload(transaction_id, otp)
+        return await self.post_with_access_token('verifyCode', payload)
+
+    async def get_transaction_status(self, transaction_id):
+        payload = Session.transaction_status_payload(transaction_id)
+        return await self.post_with_access_token('getTransactionStatus',
+                                                 payload)
+
+    async def close(self):
+        await self.transport.close()
+
+    def merchant(self, merchant_wallet_id, pin_code):
+        return AsyncMerchant(merchant_wallet_id, pin_code)
@@ -0,0 +1,55 @@
+import httpx
+
+from qmoney_payment.api.transport import DEFAULT_CONNECT_TIMEOUT, DEFAULT_POOL_BLOCK, DEFAULT_POOL_MAXSIZE, DEFAULT_READ_TIMEOUT, transport_kwargs_from_settings
+
+
+class AsyncTransport:
+    # The asyncio counterpart of Transport, backed by an httpx.AsyncClient.
+    # The client is bound to the event loop it is first used from.
+    pool_maxsize = DEFAULT_POOL_MAXSIZE
+    pool_block = DEFAULT_POOL_BLOCK
+    connect_timeout = DEFAULT_CONNECT_TIMEOUT
+    read_timeout = DEFAULT_READ_TIMEOUT
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self,
+            pool_maxsize=DEFAULT_POOL_MAXSIZE,
+            pool_block=DEFAULT_POOL_BLOCK,
+            connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+            read_timeout=DEFAULT_READ_TIMEOUT,
+            **_kwargs):
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.http = None
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(**transport_kwargs_from_settings(settings))
+
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    def __build_http_client(self):
+        # without blocking, the pool keeps `pool_maxsize` idle connections
+        # but may open more of them under load, as urllib3 does
+        limits = httpx.Limits(
+            max_connections=self.pool_maxsize if self.pool_block else None,
+            max_keepalive_connections=self.pool_maxsize)
+        timeout = httpx.Timeout(self.read_timeout,
+                                connect=self.connect_timeout)
+        return httpx.AsyncClient(limits=limits, timeout=timeout)
+
+    async def post(self, url, json, auth, timeout=None):
+        if self.http is None:
+            self.http = self.__build_http_client()
+        kwargs = {}
+        if timeout is not None:
+            kwargs['timeout'] = httpx.Timeout(timeout[1], connect=timeout[0])
+        return await self.http.post(url, json=json, auth=auth, **kwargs)
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.aclose()
+            self.http = None
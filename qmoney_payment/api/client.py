@@ -1,8 +1,62 @@
+from qmoney_payment.api.resilience import Resilience
 from qmoney_payment.api.session import Session
+from qmoney_payment.api.token_manager import DEFAULT_REFRESH_MARGIN
+from qmoney_payment.api.token_store import token_key, token_store_from_settings
+from qmoney_payment.api.transport import Transport
 
 
 class Client:
 
     @classmethod
-    def session(cls, url, username, password, login_token):
-        return Session(url, username, password, login_token)
\ No newline at end of file
+    def session(  # pylint: disable=too-many-arguments
+            cls,
+            url,
+            username,
+            password,
+            login_token,
+            transport_settings=None,
+            token_settings=None,
+            resilience_settings=None):
+        transport = Transport.from_settings(transport_settings or {})
+        resilience = Resilience.from_settings(resilience_settings or {},
+                                              transport.timeout())
+        return Session(
+            url, username, password, login_token, transport,
+            *cls.token_options(url, username, token_settings,
+                               resilience.longest_call(transport.timeout())),
+            resilience)
+
+    @classmethod
+    def async_session(  # pylint: disable=too-many-arguments
+            cls,
+            url,
+            username,
+            password,
+            login_token,
+            transport_settings=None,
+            token_settings=None,
+            resilience_settings=None):
+        # httpx is only required when the asyncio client is used
+        from qmoney_payment.api.async_session import AsyncSession  # pylint: disable=import-outside-toplevel
+        from qmoney_payment.api.async_transport import AsyncTransport  # pylint: disable=import-outside-toplevel
+        transport = AsyncTransport.from_settings(transport_settings or {})
+        resilience = Resilience.from_settings(resilience_settings or {},
+                                              transport.timeout())
+        return AsyncSession(
+            url, username, password, login_token, transport,
+            *cls.token_options(url, username, token_settings,
+                               resilience.longest_call(transport.timeout())),
+            resilience)
+
+    @classmethod
+    def token_options(cls, url, username, token_settings, lock_timeout):
+        token_settings = token_settings or {}
+        refresh_margin = token_settings.get('refresh_margin')
+        refresh_margin = float(
+            refresh_margin) if refresh_margin not in (
+                None, '') else DEFAULT_REFRESH_MARGIN
+        # the refresh lock is held for a login at most
+        token_store = token_store_from_settings(token_settings,
+                                                token_key(url, username),
+                                                lock_timeout)
+        return refresh_margin, token_store
@@ -0,0 +1,93 @@
+import json
+from enum import Enum
+
+SUCCESS_RESPONSE_CODE = '1'
+
+
+class GatewayError(Exception):
+
+    def __init__(self, response):
+        super().__init__(response.message)
+        self.response = response
+
+
+class GatewayResponse:
+    # The outcome of one call to QMoney, decoded once. The raw body is kept
+    # as bytes and only turned into text when asked (e.g. to log it).
+    __slots__ = ('kind', 'status_code', 'response_code', 'message', 'data',
+                 'transaction_id', 'content')
+
+    Kind = Enum('Kind', [
+        'OK', 'REJECTED', 'UNAUTHORIZED', 'HTTP_ERROR', 'DECODE_ERROR',
+        'CONNECT_ERROR', 'TRANSPORT_ERROR', 'LOGIN_FAILED', 'CIRCUIT_OPEN',
+        'DEADLINE_EXCEEDED'
+    ])
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self,
+            kind,
+            status_code=None,
+            response_code=None,
+            message=None,
+            data=None,
+            content=b''):
+        self.kind = kind
+        self.status_code = status_code
+        self.response_code = response_code
+        self.message = message
+        self.data = data if data is not None else {}
+        self.transaction_id = self.data.get('transactionId')
+        self.content = content
+
+    @classmethod
+    def from_http(cls, status_code, content):
+        try:
+            body = json.loads(content) if content else None
+        except ValueError:
+            body = None
+        if not isinstance(body, dict):
+            if status_code == 401:
+                kind = cls.Kind.UNAUTHORIZED
+            elif status_code != 200:
+                kind = cls.Kind.HTTP_ERROR
+            else:
+                kind = cls.Kind.DECODE_ERROR
+            return cls(kind, status_code, content=content)
+
+        data = body.get('data')
+        data = data if isinstance(data, dict) else {}
+        response_code = body.get('responseCode')
+        response_code = str(
+            response_code) if response_code is not None else None
+        message = body.get('responseMessage') or body.get(
+            'error_description') or body.get('message') or body.get('error')
+
+        if status_code == 401:
+            kind = cls.Kind.UNAUTHORIZED
+        elif status_code != 200:
+            kind = cls.Kind.HTTP_ERROR
+        elif response_code == SUCCESS_RESPONSE_CODE:
+            kind = cls.Kind.OK
+        else:
+            kind = cls.Kind.REJECTED
+        return cls(kind, status_code, response_code, message, data, content)
+
+    @classmethod
+    def from_error(cls, kind, error):
+        return cls(kind, message=str(error))
+
+    @property
+    def ok(self):  # pylint: disable=invalid-name
+        return self.kind is GatewayResponse.Kind.OK
+
+    @property
+    def text(self):
+        if self.content:
+            return self.content.decode('utf-8', errors='replace')
+        return self.message or ''
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return f'<GatewayResponse {self.kind.name} {self.status_code} {self.response_code}>'
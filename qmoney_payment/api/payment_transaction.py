@@ -9,11 +9,20 @@ class PaymentTransaction:
     amount_to_pay = 0
     session = None
     transaction_id = None
+    last_response = None
     State = Enum('State', [
         'INITIATED', 'WAITING_FOR_CONFIRMATION', 'PROCEEDED', 'UNKNOWN',
         'FAILED', 'CANCELED'
     ])
     current_state = State.UNKNOWN
+    # the states of a transaction as returned by getTransactionStatus
+    GATEWAY_STATES = {
+        'PENDING': State.WAITING_FOR_CONFIRMATION,
+        'SUCCESS': State.PROCEEDED,
+        'FAILED': State.FAILED,
+        'EXPIRED': State.FAILED,
+        'CANCELLED': State.CANCELED,
+    }
 
     def __init__(  # pylint: disable=too-many-arguments
             self,
@@ -28,6 +37,7 @@ class PaymentTransaction:
         self.amount_to_pay = amount
         self.session = with_session
         self.transaction_id = assigned_transaction_id
+        self.last_response = None
         self.current_state = self.__convert_state_initial_to_state_enum(
             state_initial)
 
@@ -69,27 +79,50 @@ class PaymentTransaction:
         return self.to_merchant
 
     def request_otp(self):
-        transaction_id = self.session.get_money(self.from_wallet_id,
-                                                self.to_merchant.wallet_id,
-                                                self.amount_to_pay,
-                                                self.to_merchant.pin_code)
-
-        if transaction_id is not None:
+        response = self.session.get_money(self.from_wallet_id,
+                                          self.to_merchant.wallet_id,
+                                          self.amount_to_pay,
+                                          self.to_merchant.pin_code)
+        return self.set_state_after_request(response)
+
+    def set_state_after_request(self, response):
+        self.last_response = response
+        if response.ok and response.transaction_id is not None:
             self.current_state = PaymentTransaction.State.WAITING_FOR_CONFIRMATION
-            self.transaction_id = transaction_id
+            self.transaction_id = response.transaction_id
         else:
             self.current_state = PaymentTransaction.State.FAILED
 
-        return transaction_id is not None
+        return self.is_waiting_for_confirmation()
 
     def proceed(self, otp):
         if self.transaction_id is None:
             return False, _('qmoney_payment.proceed.error.transaction_empty')
         if otp is None:
             return False, _('qmoney_payment.proceed.error.otp_empty')
-        result = self.session.verify_code(self.transaction_id, otp)
-        if result[0]:
+        response = self.session.verify_code(self.transaction_id, otp)
+        return self.set_state_after_proceed(response)
+
+    def set_state_after_proceed(self, response):
+        self.last_response = response
+        if response.ok:
             self.current_state = PaymentTransaction.State.PROCEEDED
         else:
             self.current_state = PaymentTransaction.State.FAILED
-        return result
\ No newline at end of file
+        return response.ok, response
+
+    def fetch_state(self):
+        if self.transaction_id is None:
+            return False, _('qmoney_payment.proceed.error.transaction_empty')
+        response = self.session.get_transaction_status(self.transaction_id)
+        return self.set_state_after_status(response)
+
+    def set_state_after_status(self, response):
+        self.last_response = response
+        if response.ok:
+            self.current_state = PaymentTransaction.GATEWAY_STATES.get(
+                response.data.get('status'), PaymentTransaction.State.UNKNOWN)
+        else:
+            # nothing is known for sure, e.g. the gateway is unreachable
+            self.current_state = PaymentTransaction.State.UNKNOWN
+        return response.ok, response
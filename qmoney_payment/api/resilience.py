@@ -0,0 +1,310 @@
+import asyncio
+import contextlib
+import contextvars
+import random
+import threading
+import time
+from collections import Counter
+from enum import Enum
+
+from qmoney_payment.api.gateway_response import GatewayResponse
+from qmoney_payment.api.transport import DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_RETRY_BASE_DELAY = 0.2
+DEFAULT_RETRY_MAX_DELAY = 5
+DEFAULT_CIRCUIT_FAILURE_THRESHOLD = 5
+DEFAULT_CIRCUIT_RESET_TIMEOUT = 30
+# at least one whole attempt of a call, as a getMoney or a verifyCode cut off
+# by the deadline can't be retried
+DEFAULT_DEADLINE = DEFAULT_CONNECT_TIMEOUT + DEFAULT_READ_TIMEOUT
+
+# Calls which can be sent again whatever happened to the previous attempt.
+# A getMoney or a verifyCode may have been processed by QMoney even if its
+# response has been lost, so they are only sent again when the previous
+# attempt did not reach the gateway at all.
+IDEMPOTENT_ENDPOINTS = frozenset(['login', 'getTransactionStatus'])
+
+Kind = GatewayResponse.Kind
+
+current_deadline = contextvars.ContextVar('qmoney_deadline', default=None)
+
+
+@contextlib.contextmanager
+def deadline(seconds, clock=time.monotonic):
+    # Bound the time spent by all the gateway calls made in this context
+    # (the login included). A nested deadline can only be tighter.
+    if seconds is None:
+        yield current_deadline.get()
+        return
+    at = clock() + seconds
+    outer = current_deadline.get()
+    if outer is not None:
+        at = min(at, outer)
+    reset_token = current_deadline.set(at)
+    try:
+        yield at
+    finally:
+        current_deadline.reset(reset_token)
+
+
+def remaining_time(clock=time.monotonic):
+    # the seconds left before the deadline of the current context, if any
+    at = current_deadline.get()
+    return None if at is None else at - clock()
+
+
+def is_gateway_failure(response):
+    # a failure of the gateway itself, as opposed to a refused payment
+    if response.kind in (Kind.CONNECT_ERROR, Kind.TRANSPORT_ERROR,
+                         Kind.DECODE_ERROR):
+        return True
+    return response.kind is Kind.HTTP_ERROR and (
+        response.status_code is None or response.status_code >= 500)
+
+
+def is_retryable(endpoint, response):
+    if response.kind is Kind.CONNECT_ERROR:
+        return True
+    return endpoint in IDEMPOTENT_ENDPOINTS and (
+        is_gateway_failure(response) or response.status_code == 429)
+
+
+class RetryPolicy:
+    max_attempts = DEFAULT_MAX_ATTEMPTS
+    base_delay = DEFAULT_RETRY_BASE_DELAY
+    max_delay = DEFAULT_RETRY_MAX_DELAY
+
+    def __init__(self,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 base_delay=DEFAULT_RETRY_BASE_DELAY,
+                 max_delay=DEFAULT_RETRY_MAX_DELAY,
+                 jitter=random.random):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        # exponential backoff with full jitter, attempt starts at 1
+        return self.jitter() * min(self.max_delay,
+                                   self.base_delay * 2**(attempt - 1))
+
+
+class CircuitBreaker:
+    # Fail fast once the gateway failed `failure_threshold` times in a row.
+    # After `reset_timeout` seconds, a single call is let through to probe
+    # the gateway: the circuit is closed again if it succeeds.
+    State = Enum('State', ['CLOSED', 'OPEN', 'HALF_OPEN'])
+    failure_threshold = DEFAULT_CIRCUIT_FAILURE_THRESHOLD
+    reset_timeout = DEFAULT_CIRCUIT_RESET_TIMEOUT
+
+    def __init__(self,
+                 failure_threshold=DEFAULT_CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_CIRCUIT_RESET_TIMEOUT,
+                 clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.state = CircuitBreaker.State.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def allow(self):
+        with self.lock:
+            if self.state is CircuitBreaker.State.CLOSED:
+                return True
+            if self.state is CircuitBreaker.State.OPEN:
+                if self.clock() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = CircuitBreaker.State.HALF_OPEN
+                self.probing = False
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.state = CircuitBreaker.State.CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state is CircuitBreaker.State.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = CircuitBreaker.State.OPEN
+                self.opened_at = self.clock()
+            self.probing = False
+
+
+class Resilience:
+    # Wrap the calls to the gateway with retries, a circuit breaker per
+    # endpoint and the deadline of the current context. `attempt` is given
+    # the (connect, read) timeout to use and returns a GatewayResponse.
+    retry_policy = None
+    deadline_seconds = DEFAULT_DEADLINE
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self,
+            retry_policy=None,
+            failure_threshold=DEFAULT_CIRCUIT_FAILURE_THRESHOLD,
+            reset_timeout=DEFAULT_CIRCUIT_RESET_TIMEOUT,
+            deadline_seconds=DEFAULT_DEADLINE,
+            clock=time.monotonic,
+            sleep=time.sleep):
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy(
+        )
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.deadline_seconds = deadline_seconds
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.breakers = {}
+        self.counters = {}
+
+    @classmethod
+    def from_settings(cls, settings, timeout=None):
+        # without a deadline of its own, the one of the (connect, read)
+        # timeout of the transport, if given
+        conversions = {
+            'max_attempts': int,
+            'retry_base_delay': float,
+            'retry_max_delay': float,
+            'circuit_failure_threshold': int,
+            'circuit_reset_timeout': float,
+            'deadline': float,
+        }
+        values = {
+            name: convert(settings[name])
+            for name, convert in conversions.items()
+            if settings.get(name) not in (None, '')
+        }
+        deadline_seconds = values.get(
+            'deadline',
+            sum(timeout) if timeout is not None else DEFAULT_DEADLINE)
+        retry_policy = RetryPolicy(
+            values.get('max_attempts', DEFAULT_MAX_ATTEMPTS),
+            values.get('retry_base_delay', DEFAULT_RETRY_BASE_DELAY),
+            values.get('retry_max_delay', DEFAULT_RETRY_MAX_DELAY))
+        return cls(
+            retry_policy,
+            values.get('circuit_failure_threshold',
+                       DEFAULT_CIRCUIT_FAILURE_THRESHOLD),
+            values.get('circuit_reset_timeout', DEFAULT_CIRCUIT_RESET_TIMEOUT),
+            # a deadline of 0 or less disables it
+            deadline_seconds if deadline_seconds > 0 else None)
+
+    def deadline(self):
+        return deadline(self.deadline_seconds, self.clock)
+
+    def longest_call(self, timeout):
+        # the time a call may last with all its retries, e.g. a login in the
+        # background, outside of any deadline
+        attempts = self.retry_policy.max_attempts
+        return attempts * sum(timeout) + (attempts -
+                                          1) * self.retry_policy.max_delay
+
+    def breaker(self, endpoint):
+        with self.lock:
+            breaker = self.breakers.get(endpoint)
+            if breaker is None:
+                breaker = self.breakers[endpoint] = CircuitBreaker(
+                    self.failure_threshold, self.reset_timeout, self.clock)
+                self.counters[endpoint] = Counter()
+            return breaker
+
+    def count(self, endpoint, name):
+        with self.lock:
+            self.counters[endpoint][name] += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                endpoint: {
+                    'calls': counters['calls'],
+                    'attempts': counters['attempts'],
+                    'retries': counters['retries'],
+                    'failures': counters['failures'],
+                    'short_circuited': counters['short_circuited'],
+                    'deadline_exceeded': counters['deadline_exceeded'],
+                    'circuit': self.breakers[endpoint].state.name.lower(),
+                }
+                for endpoint, counters in self.counters.items()
+            }
+
+    def call(self, endpoint, attempt, timeout):
+        breaker = self.breaker(endpoint)
+        self.count(endpoint, 'calls')
+        number = 1
+        while True:
+            response = self.__before_attempt(endpoint, breaker)
+            if response is None:
+                response = attempt(self.__bounded(timeout))
+                self.__after_attempt(endpoint, breaker, response)
+            delay = self.__delay_before_retry(endpoint, response, number)
+            if delay is None:
+                return response
+            self.sleep(delay)
+            number += 1
+
+    async def call_async(self, endpoint, attempt, timeout):
+        breaker = self.breaker(endpoint)
+        self.count(endpoint, 'calls')
+        number = 1
+        while True:
+            response = self.__before_attempt(endpoint, breaker)
+            if response is None:
+                response = await attempt(self.__bounded(timeout))
+                self.__after_attempt(endpoint, breaker, response)
+            delay = self.__delay_before_retry(endpoint, response, number)
+            if delay is None:
+                return response
+            await asyncio.sleep(delay)
+            number += 1
+
+    def __remaining(self):
+        return remaining_time(self.clock)
+
+    def __bounded(self, timeout):
+        remaining = self.__remaining()
+        if remaining is None:
+            return timeout
+        return tuple(min(value, remaining) for value in timeout)
+
+    def __before_attempt(self, endpoint, breaker):
+        remaining = self.__remaining()
+        if remaining is not None and remaining <= 0:
+            self.count(endpoint, 'deadline_exceeded')
+            return GatewayResponse.from_error(
+                Kind.DEADLINE_EXCEEDED,
+                f'The deadline to call /{endpoint} has been exceeded')
+        if not breaker.allow():
+            self.count(endpoint, 'short_circuited')
+            return GatewayResponse.from_error(
+                Kind.CIRCUIT_OPEN,
+                f'The circuit to /{endpoint} is open after repeated failures')
+        self.count(endpoint, 'attempts')
+        return None
+
+    def __after_attempt(self, endpoint, breaker, response):
+        if is_gateway_failure(response):
+            self.count(endpoint, 'failures')
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+    def __delay_before_retry(self, endpoint, response, number):
+        if number >= self.retry_policy.max_attempts or not is_retryable(
+                endpoint, response):
+            return None
+        delay = self.retry_policy.delay(number)
+        remaining = self.__remaining()
+        if remaining is not None and remaining <= delay:
+            return None
+        self.count(endpoint, 'retries')
+        return delay
@@ -1,44 +1,115 @@
 import logging
+
 import requests
 
 from qmoney_payment.api.auth_base import QMoneyBasicAuth, QMoneyBearerAuth
+from qmoney_payment.api.gateway_response import GatewayError, GatewayResponse
 from qmoney_payment.api.merchant import Merchant
+from qmoney_payment.api.resilience import Resilience
+from qmoney_payment.api.token_manager import AccessToken, TokenManager, DEFAULT_REFRESH_MARGIN
+from qmoney_payment.api.transport import Transport, is_connect_error
 
 logger = logging.getLogger(__name__)
 
-TIMEOUT = 100
-
 
 class Session:
     url = None
     username = None
     password = None
     login_token = None
-    access_token = None
-
-    def __init__(self, url, username, password, login_token):
+    transport = None
+    tokens = None
+    resilience = None
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self,
+            url,
+            username,
+            password,
+            login_token,
+            transport=None,
+            refresh_margin=DEFAULT_REFRESH_MARGIN,
+            token_store=None,
+            resilience=None):
         self.url = url
         self.username = username
         self.password = password
         self.login_token = login_token
+        self.transport = transport if transport is not None else Transport()
+        self.resilience = resilience if resilience is not None else Resilience(
+        )
+        self.tokens = TokenManager(self.fetch_access_token,
+                                   refresh_margin,
+                                   store=token_store)
+
+    @property
+    def access_token(self):
+        return self.tokens.current()
 
     def is_logged_in(self):
         return self.access_token is not None
 
     def login(self):
-        if self.is_logged_in():
-            return
-        json_payload = {
+        return self.tokens.get()
+
+    @classmethod
+    def login_payload(cls, username, password):
+        return {
             'grantType': 'password',
-            'username': self.username,
-            'password': self.password,
+            'username': username,
+            'password': password,
         }
-        response = requests.post(url=f'{self.url}/login',
-                                 json=json_payload,
-                                 auth=QMoneyBasicAuth(self.login_token),
-                                 timeout=TIMEOUT)
 
-        self.access_token = response.json()['data']['access_token']
+    def fetch_access_token(self):
+        payload = self.login_payload(self.username, self.password)
+        response = self.post('login', payload,
+                             QMoneyBasicAuth(self.login_token))
+        if not response.ok or 'access_token' not in response.data:
+            raise GatewayError(response)
+        return AccessToken.from_login_data(response.data, self.tokens.clock())
+
+    def post(self, endpoint, payload, auth):
+        return self.resilience.call(
+            endpoint, lambda timeout: self.post_once(
+                endpoint, payload, auth, timeout), self.transport.timeout())
+
+    def post_once(self, endpoint, payload, auth, timeout):
+        try:
+            response = self.transport.post(url=f'{self.url}/{endpoint}',
+                                           json=payload,
+                                           auth=auth,
+                                           timeout=timeout)
+        except requests.RequestException as error:
+            kind = GatewayResponse.Kind.CONNECT_ERROR if is_connect_error(
+                error) else GatewayResponse.Kind.TRANSPORT_ERROR
+            return GatewayResponse.from_error(kind, error)
+        return GatewayResponse.from_http(response.status_code,
+                                         response.content)
+
+    def post_with_access_token(self, endpoint, payload):
+        logger.debug('POST /%s with payload:\n%s', endpoint, payload)
+        with self.resilience.deadline():
+            response = self.__post_with_access_token(endpoint, payload)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('POST /%s response:\n%s', endpoint, response.text)
+        return response
+
+    def __post_with_access_token(self, endpoint, payload):
+        try:
+            access_token = self.login()
+            response = self.post(endpoint, payload,
+                                 QMoneyBearerAuth(access_token))
+            if response.kind is GatewayResponse.Kind.UNAUTHORIZED:
+                # the token has been revoked or has expired earlier than
+                # announced
+                self.tokens.invalidate(access_token)
+                access_token = self.tokens.refresh(access_token)
+                response = self.post(endpoint, payload,
+                                     QMoneyBearerAuth(access_token))
+        except GatewayError as error:
+            response = GatewayResponse.from_error(
+                GatewayResponse.Kind.LOGIN_FAILED, error)
+        return response
 
     @classmethod
     def service_name(cls):
@@ -48,10 +119,10 @@ class Session:
     def product_name(cls):
         return 'NHIA_GETMONEY'
 
-    def get_money(self, payer_wallet_id, merchant_wallet_id, amount,
-                  merchant_pin_code):
-        self.login()
-        payload = {
+    @classmethod
+    def get_money_payload(cls, payer_wallet_id, merchant_wallet_id, amount,
+                          merchant_pin_code):
+        return {
             'data': {
                 'fromUser': {
                     'userIdentifier': payer_wallet_id,
@@ -59,8 +130,8 @@ class Session:
                 'toUser': {
                     'userIdentifier': merchant_wallet_id,
                 },
-                'serviceId': self.service_name(),
-                'productId': self.product_name(),
+                'serviceId': cls.service_name(),
+                'productId': cls.product_name(),
                 'remarks': 'add',
                 'payment': [
                     {
@@ -70,36 +141,28 @@ class Session:
                 'transactionPin': merchant_pin_code
             }
         }
-        logger.debug('POST /getMoney with payload:\n%s', payload)
 
-        response = requests.post(url=f'{self.url}/getMoney',
-                                 json=payload,
-                                 auth=QMoneyBearerAuth(self.access_token),
-                                 timeout=TIMEOUT)
+    @classmethod
+    def verify_code_payload(cls, transaction_id, otp):
+        return {'transactionId': transaction_id, 'otp': otp}
 
-        logger.debug('POST /getMoney response:\n%s', response.text)
+    @classmethod
+    def transaction_status_payload(cls, transaction_id):
+        return {'transactionId': transaction_id}
 
-        if response.status_code != 200 or response.json(
-        )['responseCode'] != '1':
-            return None
-        return response.json()['data']['transactionId']
+    def get_money(self, payer_wallet_id, merchant_wallet_id, amount,
+                  merchant_pin_code):
+        payload = self.get_money_payload(payer_wallet_id, merchant_wallet_id,
+                                         amount, merchant_pin_code)
+        return self.post_with_access_token('getMoney', payload)
 
     def verify_code(self, transaction_id, otp):
-        self.login()
-        payload = {'transactionId': transaction_id, 'otp': otp}
-
-        logger.debug('POST /verifyCode with payload:\n%s', payload)
-        response = requests.post(url=f'{self.url}/verifyCode',
-                                 json=payload,
-                                 auth=QMoneyBearerAuth(self.access_token),
-                                 timeout=TIMEOUT)
-        logger.debug('POST /verifyCode response:\n%s', response.text)
-
-        if response.status_code != 200 or response.json(
-        )['responseCode'] != '1':
-            return (False, response.text)
+        payload = self.verify_code_payload(transaction_id, otp)
+        return self.post_with_access_token('verifyCode', payload)
 
-        return (True, response.text)
+    def get_transaction_status(self, transaction_id):
+        payload = self.transaction_status_payload(transaction_id)
+        return self.post_with_access_token('getTransactionStatus', payload)
 
     def merchant(self, merchant_wallet_id, pin_code):
         return Merchant(merchant_wallet_id, pin_code)
@@ -0,0 +1,249 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+import time
+
+from qmoney_payment.api.access_token import AccessToken  # noqa: F401
+from qmoney_payment.api.token_store import LocalMemoryTokenStore, RefreshLockTimeout
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REFRESH_MARGIN = 60
+
+
+def run_in_thread(func, *args):
+    # in the context of the caller, e.g. bounded by its deadline
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(context.run, func, *args))
+
+
+class Flight:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.token = None
+        self.error = None
+
+
+class TokenManager:
+    # Keep track of the access token and its expiry. Concurrent callers
+    # share a single in-flight login and the token is refreshed in the
+    # background once it gets close to its expiry. The token can be shared
+    # with other processes through a store (see token_store.py), the login
+    # then happens under the lock of the store.
+    token = None
+    flight = None
+    store = None
+    refresh_margin = DEFAULT_REFRESH_MARGIN
+
+    def __init__(self,
+                 fetch,
+                 refresh_margin=DEFAULT_REFRESH_MARGIN,
+                 clock=time.time,
+                 store=None):
+        self.fetch = fetch
+        self.refresh_margin = refresh_margin
+        self.clock = clock
+        self.store = store if store is not None else LocalMemoryTokenStore()
+        self.lock = threading.Lock()
+        self.token = None
+        self.flight = None
+
+    def current(self):
+        token = self.token
+        if token is None or token.is_expired(self.clock()):
+            return None
+        return token.value
+
+    def get(self):
+        token = self.token
+        now = self.clock()
+        if token is None or token.is_expired(now):
+            token = self.__adopt_stored_token()
+        if token is None or token.is_expired(now):
+            return self.refresh()
+        if token.is_expired(now, self.refresh_margin):
+            self.refresh_in_background()
+        return token.value
+
+    def refresh(self, stale_value=None):
+        with self.lock:
+            token = self.token
+            if stale_value is not None and self.__is_replacement_of(
+                    token, stale_value):
+                return token.value
+            flight = self.flight
+            is_leader = flight is None
+            if is_leader:
+                flight = self.flight = Flight()
+
+        if is_leader:
+            self.__fly(flight, stale_value)
+        else:
+            flight.done.wait()
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.token.value
+
+    def refresh_in_background(self):
+        with self.lock:
+            if self.flight is not None:
+                return
+            flight = self.flight = Flight()
+        threading.Thread(target=self.__fly,
+                         args=(flight, None, self.refresh_margin),
+                         name='qmoney-token-refresh',
+                         daemon=True).start()
+
+    def invalidate(self, value):
+        with self.lock:
+            if self.token is not None and self.token.value == value:
+                self.token = None
+        self.store.discard(value)
+
+    def __is_replacement_of(self, token, stale_value):
+        return token is not None and token.value != stale_value and not token.is_expired(
+            self.clock())
+
+    def __adopt_stored_token(self):
+        token = self.store.load()
+        if token is None or token.is_expired(self.clock()):
+            return None
+        with self.lock:
+            self.token = token
+        return token
+
+    def __fetch_unless_stored(self, stale_value, margin):
+        try:
+            with self.store.refresh_lock():
+                # another process may have logged in while we were waiting
+                token = self.__stored(stale_value, margin)
+                if token is not None:
+                    return token
+                token = self.fetch()
+                self.store.save(token)
+                return token
+        except RefreshLockTimeout:
+            # never log in without the lock, unless its holder stored a token
+            token = self.__stored(stale_value, margin)
+            if token is None:
+                raise
+            return token
+
+    def __stored(self, stale_value, margin):
+        token = self.store.load()
+        if token is None or token.value == stale_value or token.is_expired(
+                self.clock(), margin):
+            return None
+        return token
+
+    def __fly(self, flight, stale_value=None, margin=0):
+        try:
+            flight.token = self.__fetch_unless_stored(stale_value, margin)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning('QMoney login failed: %s', error)
+            flight.error = error
+        with self.lock:
+            if flight.error is None:
+                self.token = flight.token
+            self.flight = None
+        flight.done.set()
+
+
+class AsyncTokenManager:
+    # The asyncio counterpart of TokenManager: the coroutines waiting for a
+    # token share the login made by the first one holding the lock, made
+    # under the lock of the store as well. The store is read, written and
+    # locked from worker threads to not block the event loop.
+    token = None
+    store = None
+    refresh_margin = DEFAULT_REFRESH_MARGIN
+
+    def __init__(self,
+                 fetch,
+                 refresh_margin=DEFAULT_REFRESH_MARGIN,
+                 clock=time.time,
+                 store=None):
+        self.fetch = fetch
+        self.refresh_margin = refresh_margin
+        self.clock = clock
+        self.store = store if store is not None else LocalMemoryTokenStore()
+        self.token = None
+        self.lock = None
+        self.background_refresh = None
+
+    def current(self):
+        token = self.token
+        if token is None or token.is_expired(self.clock()):
+            return None
+        return token.value
+
+    async def get(self):
+        token = self.token
+        now = self.clock()
+        if token is None or token.is_expired(now):
+            return await self.refresh()
+        if token.is_expired(now, self.refresh_margin):
+            self.refresh_in_background()
+        return token.value
+
+    async def refresh(self, stale_value=None, margin=0):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            token = self.token
+            if self.__is_usable(token, stale_value, margin):
+                return token.value
+            token = await run_in_thread(self.store.load)
+            if not self.__is_usable(token, stale_value, margin):
+                token = await self.__fetch_unless_stored(stale_value, margin)
+            self.token = token
+            return token.value
+
+    def refresh_in_background(self):
+        if self.background_refresh is not None and not self.background_refresh.done(
+        ):
+            return
+        self.background_refresh = asyncio.ensure_future(
+            self.__refresh_quietly())
+
+    async def invalidate(self, value):
+        if self.token is not None and self.token.value == value:
+            self.token = None
+        await run_in_thread(self.store.discard, value)
+
+    def __is_usable(self, token, stale_value, margin):
+        return token is not None and token.value != stale_value and not token.is_expired(
+            self.clock(), margin)
+
+    async def __fetch_unless_stored(self, stale_value, margin):
+        # the lock of the store is taken and released from worker threads
+        refresh_lock = self.store.refresh_lock()
+        try:
+            await run_in_thread(refresh_lock.__enter__)
+        except RefreshLockTimeout:
+            # never log in without the lock, unless its holder stored a token
+            token = await run_in_thread(self.store.load)
+            if not self.__is_usable(token, stale_value, margin):
+                raise
+            return token
+        try:
+            # another process may have logged in while we were waiting
+            token = await run_in_thread(self.store.load)
+            if not self.__is_usable(token, stale_value, margin):
+                token = await self.fetch()
+                await run_in_thread(self.store.save, token)
+            return token
+        finally:
+            await run_in_thread(refresh_lock.__exit__, None, None, None)
+
+    async def __refresh_quietly(self):
+        try:
+            await self.refresh(self.token.value if self.token else None,
+                               self.refresh_margin)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning('QMoney login failed: %s', error)
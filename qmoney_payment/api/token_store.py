@@ -0,0 +1,179 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from qmoney_payment.api.access_token import AccessToken
+from qmoney_payment.api.resilience import remaining_time
+
+# covers a login with the default transport timeouts and retries
+DEFAULT_LOCK_TIMEOUT = 340
+LOCK_POLL_INTERVAL = 0.05
+LOCK_MAX_POLL_INTERVAL = 1
+
+
+class RefreshLockTimeout(TimeoutError):
+    pass
+
+
+def token_key(url, username):
+    digest = hashlib.sha256(f'{url}|{username}'.encode('utf-8')).hexdigest()
+    return f'qmoney_payment.access_token.{digest[:32]}'
+
+
+def serialize(token):
+    return {'value': token.value, 'expires_at': token.expires_at}
+
+
+def deserialize(data):
+    if not data:
+        return None
+    return AccessToken(data['value'], data.get('expires_at'))
+
+
+class LocalMemoryTokenStore:
+    # The token is only shared by the threads of the current process
+
+    def __init__(self):
+        self.token = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        return self.token
+
+    def save(self, token):
+        self.token = token
+
+    def discard(self, value):
+        if self.token is not None and self.token.value == value:
+            self.token = None
+
+    @contextlib.contextmanager
+    def refresh_lock(self):
+        with self.lock:
+            yield
+
+
+class DjangoCacheTokenStore:
+    # The token is shared through a Django cache (e.g. Redis or Memcached) by
+    # all the workers using that cache. The local-memory cache, Django's
+    # default, is per process and doesn't share it. The refresh lock relies
+    # on the atomic `cache.add`, it expires after `lock_timeout` seconds in
+    # case its holder died, which must cover the longest login. It is waited
+    # for until then at most, or until the deadline of the current call.
+
+    def __init__(self,
+                 key,
+                 alias='default',
+                 lock_timeout=DEFAULT_LOCK_TIMEOUT):
+        self.key = key
+        self.lock_key = f'{key}.lock'
+        self.alias = alias
+        self.lock_timeout = lock_timeout
+
+    @property
+    def cache(self):
+        from django.core.cache import caches  # pylint: disable=import-outside-toplevel
+        return caches[self.alias]
+
+    def load(self):
+        return deserialize(self.cache.get(self.key))
+
+    def save(self, token):
+        timeout = None
+        if token.expires_at is not None:
+            timeout = max(token.expires_at - time.time(), 1)
+        self.cache.set(self.key, serialize(token), timeout=timeout)
+
+    def discard(self, value):
+        token = self.load()
+        if token is not None and token.value == value:
+            self.cache.delete(self.key)
+
+    @contextlib.contextmanager
+    def refresh_lock(self):
+        owner = os.urandom(8).hex()
+        wait = self.lock_timeout
+        remaining = remaining_time()
+        if remaining is not None:
+            wait = max(min(wait, remaining), 0)
+        deadline = time.time() + wait
+        interval = LOCK_POLL_INTERVAL
+        while not self.cache.add(
+                self.lock_key, owner, timeout=self.lock_timeout):
+            now = time.time()
+            if now >= deadline:
+                raise RefreshLockTimeout(
+                    f'QMoney access token refresh lock not acquired within {wait:.1f}s'
+                )
+            time.sleep(min(interval, deadline - now))
+            interval = min(interval * 2, LOCK_MAX_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            if self.cache.get(self.lock_key) == owner:
+                self.cache.delete(self.lock_key)
+
+
+class FileLockTokenStore:
+    # The token is shared through a file by all the workers of a node. The
+    # refresh lock is an exclusive `flock` on a sibling lock file.
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = f'{path}.lock'
+        self.thread_lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as token_file:
+                return deserialize(json.load(token_file))
+        except (OSError, ValueError):
+            return None
+
+    def save(self, token):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        descriptor, temporary_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(descriptor, 'w', encoding='utf-8') as token_file:
+            json.dump(serialize(token), token_file)
+        os.chmod(temporary_path, 0o600)
+        os.replace(temporary_path, self.path)
+
+    def discard(self, value):
+        token = self.load()
+        if token is not None and token.value == value:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path)
+
+    @contextlib.contextmanager
+    def refresh_lock(self):
+        # flock is per open file description, the threads of this process
+        # need to be serialized on their own
+        with self.thread_lock, open(self.lock_path, 'a',
+                                    encoding='utf-8') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def token_store_from_settings(settings,
+                              key,
+                              lock_timeout=DEFAULT_LOCK_TIMEOUT):
+    backend = (settings.get('store') or 'memory').lower()
+    if backend == 'memory':
+        return LocalMemoryTokenStore()
+    if backend == 'django_cache':
+        return DjangoCacheTokenStore(
+            key,
+            settings.get('store_cache') or 'default', lock_timeout)
+    if backend == 'file':
+        path = settings.get('store_path') or os.path.join(
+            tempfile.gettempdir(), f'{key}.json')
+        return FileLockTokenStore(path)
+    raise ValueError(f'Unknown QMoney access token store: {backend}')
@@ -0,0 +1,94 @@
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+DEFAULT_POOL_CONNECTIONS = 1
+DEFAULT_POOL_MAXSIZE = 10
+DEFAULT_POOL_BLOCK = False
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 100
+
+
+def to_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def transport_kwargs_from_settings(settings):
+    conversions = {
+        'pool_connections': int,
+        'pool_maxsize': int,
+        'pool_block': to_bool,
+        'connect_timeout': float,
+        'read_timeout': float,
+    }
+    return {
+        name: convert(settings[name])
+        for name, convert in conversions.items()
+        if settings.get(name) not in (None, '')
+    }
+
+
+def is_connect_error(error):
+    # the connection could not be established, hence the request has not
+    # been sent and can safely be sent again
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.ConnectionError) and isinstance(
+        reason, NewConnectionError)
+
+
+class Transport:
+    # A keep-alive HTTP transport with a pool of connections per host. It is
+    # shared by all the threads of a worker: the underlying urllib3 pools are
+    # thread-safe and the cookies are blocked so no state leaks between
+    # requests (the QMoney API is stateless, the auth is given per request).
+    pool_connections = DEFAULT_POOL_CONNECTIONS
+    pool_maxsize = DEFAULT_POOL_MAXSIZE
+    pool_block = DEFAULT_POOL_BLOCK
+    connect_timeout = DEFAULT_CONNECT_TIMEOUT
+    read_timeout = DEFAULT_READ_TIMEOUT
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self,
+            pool_connections=DEFAULT_POOL_CONNECTIONS,
+            pool_maxsize=DEFAULT_POOL_MAXSIZE,
+            pool_block=DEFAULT_POOL_BLOCK,
+            connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+            read_timeout=DEFAULT_READ_TIMEOUT):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.http = self.__build_http_session()
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(**transport_kwargs_from_settings(settings))
+
+    def __build_http_session(self):
+        http = requests.Session()
+        http.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                              pool_maxsize=self.pool_maxsize,
+                              pool_block=self.pool_block)
+        http.mount('http://', adapter)
+        http.mount('https://', adapter)
+        return http
+
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    def post(self, url, json, auth, timeout=None):
+        return self.http.post(url=url,
+                              json=json,
+                              auth=auth,
+                              timeout=timeout or self.timeout())
+
+    def close(self):
+        self.http.close()
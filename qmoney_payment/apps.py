@@ -18,6 +18,8 @@ class QMoneyPaymentConfig(AppConfig):
     name = 'qmoney_payment'
     session = None
     merchant = None
+    worker_pool = None
+    mutation_log_sink = None
     gql_qmoney_payment_get_permissions = []
     gql_qmoney_payment_list_permissions = []
     gql_qmoney_payment_request_permissions = []
@@ -33,9 +35,52 @@ class QMoneyPaymentConfig(AppConfig):
             'token': os.getenv('QMONEY_TOKEN'),
             'merchant_wallet': os.getenv('QMONEY_PAYEE'),
             'merchant_pincode': os.getenv('QMONEY_PAYEE_PIN_CODE'),
+            'waiting_ttl': os.getenv('QMONEY_WAITING_TTL'),
+            'idempotency_ttl': os.getenv('QMONEY_IDEMPOTENCY_TTL'),
+            'request_concurrency': os.getenv('QMONEY_REQUEST_CONCURRENCY'),
+            'max_batch_size': os.getenv('QMONEY_MAX_BATCH_SIZE'),
+            'outbox_lease': os.getenv('QMONEY_OUTBOX_LEASE'),
+            'transport': {
+                'pool_connections': os.getenv('QMONEY_POOL_CONNECTIONS'),
+                'pool_maxsize': os.getenv('QMONEY_POOL_MAXSIZE'),
+                'pool_block': os.getenv('QMONEY_POOL_BLOCK'),
+                'connect_timeout': os.getenv('QMONEY_CONNECT_TIMEOUT'),
+                'read_timeout': os.getenv('QMONEY_READ_TIMEOUT'),
+            },
+            'access_token': {
+                'refresh_margin': os.getenv('QMONEY_TOKEN_REFRESH_MARGIN'),
+                'store': os.getenv('QMONEY_TOKEN_STORE'),
+                'store_path': os.getenv('QMONEY_TOKEN_STORE_PATH'),
+                'store_cache': os.getenv('QMONEY_TOKEN_STORE_CACHE'),
+            },
+            'resilience': {
+                'max_attempts': os.getenv('QMONEY_RETRY_MAX_ATTEMPTS'),
+                'retry_base_delay': os.getenv('QMONEY_RETRY_BASE_DELAY'),
+                'retry_max_delay': os.getenv('QMONEY_RETRY_MAX_DELAY'),
+                'circuit_failure_threshold':
+                os.getenv('QMONEY_CIRCUIT_FAILURE_THRESHOLD'),
+                'circuit_reset_timeout':
+                os.getenv('QMONEY_CIRCUIT_RESET_TIMEOUT'),
+                'deadline': os.getenv('QMONEY_DEADLINE'),
+            },
+            'mutation_log': {
+                'batch_size': os.getenv('QMONEY_MUTATION_LOG_BATCH_SIZE'),
+                'flush_interval':
+                os.getenv('QMONEY_MUTATION_LOG_FLUSH_INTERVAL'),
+                'spool_dir': os.getenv('QMONEY_MUTATION_LOG_SPOOL_DIR'),
+            },
+            'workers': {
+                'size': os.getenv('QMONEY_WORKERS'),
+                'queue_depth': os.getenv('QMONEY_QUEUE_DEPTH'),
+                'poll_interval': os.getenv('QMONEY_WORKER_POLL_INTERVAL'),
+                'reclaim_interval':
+                os.getenv('QMONEY_WORKER_RECLAIM_INTERVAL'),
+            },
         }
         self.session = None
         self.merchant = None
+        self.worker_pool = None
+        self.mutation_log_sink = None
 
     def get_gql_permission_for(self, action):
         return getattr(self, f'gql_qmoney_payment_{action}_permissions')
@@ -64,7 +109,10 @@ class QMoneyPaymentConfig(AppConfig):
             self.session = QMoneyClient.session(self.settings['url'],
                                                 self.settings['username'],
                                                 self.settings['password'],
-                                                self.settings['token'])
+                                                self.settings['token'],
+                                                self.settings['transport'],
+                                                self.settings['access_token'],
+                                                self.settings['resilience'])
         if self.merchant is None:
             self.merchant = self.session.merchant(
                 self.settings['merchant_wallet'],
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from qmoney_payment.services import expire_waiting_payments, DEFAULT_EXPIRY_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Cancel the QMoney payments waiting for an OTP for longer than their TTL, to free their policy'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--ttl',
+            type=float,
+            default=None,
+            help=
+            'Seconds after which a waiting payment expires (default: QMONEY_WAITING_TTL)'
+        )
+        parser.add_argument('--batch-size',
+                            type=int,
+                            default=DEFAULT_EXPIRY_BATCH_SIZE,
+                            help='Number of payments canceled at once')
+
+    def handle(self, *args, **options):
+        count = expire_waiting_payments(options['ttl'], options['batch_size'])
+        self.stdout.write(f'{count} waiting payments expired')
@@ -0,0 +1,64 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from qmoney_payment.services import process_next_outbox_entry, process_pending_outbox_entries, reclaim_abandoned_outbox_entries
+from qmoney_payment.workers import WorkerPool, DEFAULT_POLL_INTERVAL
+
+
+class Command(BaseCommand):
+    help = 'Make the QMoney gateway calls left pending, e.g. by a worker stopped before making them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit',
+                            type=int,
+                            default=100,
+                            help='Maximum number of calls made per round')
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=None,
+            help='Keep polling every given seconds instead of running once')
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=None,
+            help=
+            'Keep making the calls with the given number of concurrent workers until interrupted'
+        )
+
+    def handle(self, *args, **options):
+        if options['workers'] is not None:
+            self.__run_workers(options['workers'], options['interval'])
+            return
+        while True:
+            self.__reclaim()
+            results = process_pending_outbox_entries(options['limit'])
+            if results:
+                succeeded = sum(1 for result in results if result['ok'])
+                self.stdout.write(
+                    f'{len(results)} pending calls made, {succeeded} succeeded'
+                )
+            if options['interval'] is None:
+                return
+            time.sleep(options['interval'])
+
+    def __reclaim(self):
+        abandoned = reclaim_abandoned_outbox_entries()
+        if abandoned:
+            self.stdout.write(f'{abandoned} abandoned calls failed')
+
+    def __run_workers(self, size, interval):
+        pool = WorkerPool(process_next_outbox_entry,
+                          size=size,
+                          poll_interval=interval or DEFAULT_POLL_INTERVAL,
+                          reclaim=self.__reclaim)
+        pool.start()
+        self.stdout.write(f'{size} workers started')
+        try:
+            while pool.is_running():
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            pool.stop()
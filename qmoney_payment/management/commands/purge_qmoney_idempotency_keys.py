@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from qmoney_payment.models.qmoney_payment_idempotency_key import QMoneyPaymentIdempotencyKey
+
+
+class Command(BaseCommand):
+    help = 'Delete the idempotency keys of the QMoney payment mutations which have expired'
+
+    def handle(self, *args, **options):
+        count = QMoneyPaymentIdempotencyKey.purge_expired()
+        self.stdout.write(f'{count} expired idempotency keys purged')
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from qmoney_payment.models.qmoney_payment import QMoneyPayment
+from qmoney_payment.models.qmoney_payment_policy_summary import QMoneyPaymentPolicySummary, rebuild_policy_summaries
+
+
+class Command(BaseCommand):
+    help = 'Recompute the per-policy summaries of the QMoney payments from scratch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size',
+                            type=int,
+                            default=1000,
+                            help='Number of summaries inserted at once')
+
+    def handle(self, *args, **options):
+        count = rebuild_policy_summaries(QMoneyPayment,
+                                         QMoneyPaymentPolicySummary,
+                                         options['batch_size'])
+        self.stdout.write(f'{count} policy summaries rebuilt')
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+
+from qmoney_payment.reconciliation import reconcile_stale_payments, DEFAULT_BATCH_SIZE, DEFAULT_CONCURRENCY, DEFAULT_NAME, DEFAULT_STALE_AFTER
+
+
+class Command(BaseCommand):
+    help = 'Resolve with QMoney the payments left waiting for a confirmation, resuming the previous run if it was interrupted'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--stale-after',
+            type=float,
+            default=DEFAULT_STALE_AFTER,
+            help='Seconds after which a waiting payment is revisited')
+        parser.add_argument('--batch-size',
+                            type=int,
+                            default=DEFAULT_BATCH_SIZE,
+                            help='Number of payments resolved at once')
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=DEFAULT_CONCURRENCY,
+            help='Maximum number of simultaneous calls to QMoney')
+        parser.add_argument(
+            '--max-batches',
+            type=int,
+            default=None,
+            help='Stop after the given number of batches, to be resumed later')
+        parser.add_argument('--name',
+                            default=DEFAULT_NAME,
+                            help='Name of the run to resume')
+
+    def handle(self, *args, **options):
+        reconciliation = reconcile_stale_payments(options['name'],
+                                                  options['stale_after'],
+                                                  options['batch_size'],
+                                                  options['concurrency'],
+                                                  options['max_batches'])
+        state = 'finished' if reconciliation.is_finished() else 'paused'
+        self.stdout.write(
+            f'{reconciliation.examined} payments examined, {reconciliation.proceeded} proceeded, {reconciliation.canceled} canceled ({state})'
+        )
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from qmoney_payment.mutation_log_sink import mutation_log_sink
+
+
+class Command(BaseCommand):
+    help = 'Write the mutation logs left in the spool files of the processes stopped before writing them'
+
+    def handle(self, *args, **options):
+        count = mutation_log_sink().recover()
+        self.stdout.write(f'{count} spooled mutation logs recovered')
@@ -0,0 +1,45 @@
+from django.db import migrations, models
+
+UNPROCEEDED = ~models.Q(status__in=['PROCEEDED', 'CANCELED'])
+
+
+def raise_if_duplicated_unproceeded_payments(apps, _schema_editor):
+    # Before the constraint, concurrent requests could create more than one
+    # unproceeded payment per policy. Which one is to be kept is left to the
+    # operators: the migration fails with them until they are resolved, e.g.
+    # by canceling the others.
+    qmoney_payment_model = apps.get_model('qmoney_payment', 'QMoneyPayment')
+    policies = qmoney_payment_model.objects.filter(UNPROCEEDED).values(
+        'policy').annotate(count=models.Count('uuid')).filter(
+            count__gt=1).values_list('policy', flat=True)
+    duplicates = [
+        f'policy {policy}: ' + ', '.join(
+            f'{uuid} ({status})'
+            for uuid, status in qmoney_payment_model.objects.filter(
+                UNPROCEEDED, policy=policy).order_by('uuid').values_list(
+                    'uuid', 'status')) for policy in policies
+    ]
+    if duplicates:
+        raise RuntimeError(
+            'Some policies have more than one QMoney payment neither '
+            'PROCEEDED nor CANCELED, keep one per policy, e.g. by canceling '
+            'the others, then migrate again:\n' + '\n'.join(duplicates))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qmoney_payment', '0003_add_rights'),
+    ]
+
+    operations = [
+        migrations.RunPython(raise_if_duplicated_unproceeded_payments,
+                             migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='qmoneypayment',
+            constraint=models.UniqueConstraint(
+                condition=UNPROCEEDED,
+                fields=('policy', ),
+                name='qmoney_payment_one_unproceeded_per_policy'),
+        ),
+    ]
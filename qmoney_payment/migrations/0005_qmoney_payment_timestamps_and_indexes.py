@@ -0,0 +1,130 @@
+import datetime
+import re
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Q
+from django.utils import timezone
+
+from qmoney_payment.models.mutation_log import (
+    APP_NAME as MUTATION_LOG_APP_NAME, MODEL_NAME as MUTATION_LOG_MODEL_NAME,
+    is_from_mutation_log_app)
+from qmoney_payment.models.policy import get_fully_qualified_name_of_policy_model
+
+# The labels of the mutation logs of one payment, as of this migration
+PAYMENT_MUTATION_LABEL = re.compile(
+    r'^(?:Proceed|Cancel) QMoney Payment \(([0-9a-f-]{36})')
+
+
+def aware(value):
+    if settings.USE_TZ and timezone.is_naive(value):
+        return timezone.make_aware(value, datetime.timezone.utc)
+    return value
+
+
+def traces_of_payments_in_mutation_logs(apps):
+    try:
+        mutation_log_model = apps.get_model(MUTATION_LOG_APP_NAME,
+                                            MUTATION_LOG_MODEL_NAME)
+    except LookupError:
+        return {}
+    traces = {}
+    logs = mutation_log_model.objects.filter(
+        Q(client_mutation_label__startswith='Proceed QMoney Payment (')
+        | Q(client_mutation_label__startswith='Cancel QMoney Payment (')
+    ).values_list('client_mutation_label', 'request_date_time')
+    for label, request_date_time in logs.iterator():
+        match = PAYMENT_MUTATION_LABEL.match(label or '')
+        if match is None or request_date_time is None:
+            continue
+        traces.setdefault(match.group(1), []).append(aware(request_date_time))
+    return traces
+
+
+def backfill_timestamps(apps, _schema_editor):
+    # from what is left of the existing payments: the day they were paid
+    # and the time they were proceeded or canceled. Without any of them,
+    # the time of this migration is the only one known
+    qmoney_payment_model = apps.get_model('qmoney_payment', 'QMoneyPayment')
+    premium_model = qmoney_payment_model._meta.get_field(
+        'premium').related_model
+    traces = traces_of_payments_in_mutation_logs(apps)
+    payments = list(qmoney_payment_model.objects.only('uuid', 'premium'))
+    pay_dates = dict(
+        premium_model.objects.filter(pk__in={
+            payment.premium_id
+            for payment in payments if payment.premium_id is not None
+        }).values_list('pk', 'pay_date'))
+    now = timezone.now()
+    for payment in payments:
+        known = list(traces.get(str(payment.uuid), []))
+        pay_date = pay_dates.get(payment.premium_id)
+        if pay_date is not None:
+            known.append(
+                aware(datetime.datetime.combine(pay_date,
+                                                datetime.time.min)))
+        payment.created_at = min(known, default=now)
+        payment.updated_at = max(known, default=now)
+    qmoney_payment_model.objects.bulk_update(payments,
+                                             ['created_at', 'updated_at'],
+                                             batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qmoney_payment', '0004_one_unproceeded_payment_per_policy'),
+    ]
+
+    if is_from_mutation_log_app():
+        dependencies.append(('core', '0003_control_mutationlog'))
+
+    operations = [
+        migrations.AddField(
+            model_name='qmoneypayment',
+            name='created_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='qmoneypayment',
+            name='updated_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(backfill_timestamps, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='qmoneypayment',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+        migrations.AlterField(
+            model_name='qmoneypayment',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='qmoneypayment',
+            index=models.Index(fields=['policy', 'status'],
+                               name='qmoney_payment_policy_idx'),
+        ),
+        migrations.AlterField(
+            model_name='qmoneypayment',
+            name='policy',
+            field=models.ForeignKey(
+                blank=True,
+                db_index=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                to=get_fully_qualified_name_of_policy_model()),
+        ),
+        migrations.AddIndex(
+            model_name='qmoneypayment',
+            index=models.Index(fields=['status', 'created_at'],
+                               name='qmoney_payment_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='qmoneypayment',
+            index=models.Index(fields=['external_transaction_id'],
+                               name='qmoney_payment_external_idx'),
+        ),
+    ]
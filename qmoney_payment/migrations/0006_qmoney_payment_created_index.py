@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qmoney_payment', '0005_qmoney_payment_timestamps_and_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='qmoneypayment',
+            index=models.Index(fields=['created_at', 'uuid'],
+                               name='qmoney_payment_created_idx'),
+        ),
+    ]
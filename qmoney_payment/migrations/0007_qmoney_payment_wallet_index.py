@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qmoney_payment', '0006_qmoney_payment_created_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='qmoneypayment',
+            index=models.Index(fields=['payer_wallet', 'created_at'],
+                               name='qmoney_payment_wallet_idx'),
+        ),
+    ]
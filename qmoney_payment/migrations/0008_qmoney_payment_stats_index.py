@@ -0,0 +1,17 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qmoney_payment', '0007_qmoney_payment_wallet_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='qmoneypayment',
+            index=models.Index(fields=['created_at', 'status'],
+                               include=['policy', 'amount'],
+                               name='qmoney_payment_stats_idx'),
+        ),
+    ]
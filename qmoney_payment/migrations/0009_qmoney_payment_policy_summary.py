@@ -0,0 +1,64 @@
+import itertools
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, Max, Q, Sum
+from django.db.models.functions import Coalesce
+
+from qmoney_payment.models.policy import get_fully_qualified_name_of_policy_model
+
+CLOSED_STATUSES = ('PROCEEDED', 'CANCELED')
+
+
+def summarize_existing_payments(apps, _schema_editor):
+    # as of this migration, whatever the summaries become afterwards
+    qmoney_payment_model = apps.get_model('qmoney_payment', 'QMoneyPayment')
+    summary_model = apps.get_model('qmoney_payment',
+                                   'QMoneyPaymentPolicySummary')
+    rows = qmoney_payment_model.objects.filter(
+        policy__isnull=False).values('policy').annotate(
+            open_count=Count('uuid', filter=~Q(status__in=CLOSED_STATUSES)),
+            proceeded_count=Count('uuid', filter=Q(status='PROCEEDED')),
+            proceeded_amount=Coalesce(
+                Sum('amount', filter=Q(status='PROCEEDED')), 0),
+            last_status_change_at=Max('updated_at')).order_by()
+    summaries = (summary_model(policy_id=row.pop('policy'), **row)
+                 for row in rows.iterator())
+    while True:
+        batch = list(itertools.islice(summaries, 1000))
+        if not batch:
+            return
+        summary_model.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qmoney_payment', '0008_qmoney_payment_stats_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QMoneyPaymentPolicySummary',
+            fields=[
+                ('policy',
+                 models.OneToOneField(
+                     on_delete=django.db.models.deletion.CASCADE,
+                     primary_key=True,
+                     related_name='qmoney_payment_summary',
+                     serialize=False,
+                     to=get_fully_qualified_name_of_policy_model())),
+                ('open_count', models.IntegerField(default=0)),
+                ('proceeded_count', models.IntegerField(default=0)),
+                ('proceeded_amount', models.BigIntegerField(default=0)),
+                ('last_status_change_at',
+                 models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'tblQmoneyPaymentPolicySummary',
+                'managed': True,
+            },
+        ),
+        migrations.RunPython(summarize_existing_payments,
+                             migrations.RunPython.noop),
+    ]
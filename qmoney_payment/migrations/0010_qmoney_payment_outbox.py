@@ -0,0 +1,60 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qmoney_payment', '0009_qmoney_payment_policy_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QMoneyPaymentOutbox',
+            fields=[
+                ('id',
+                 models.BigAutoField(auto_created=True,
+                                     primary_key=True,
+                                     serialize=False,
+                                     verbose_name='ID')),
+                ('operation',
+                 models.CharField(choices=[('PROCEED', 'Proceed')],
+                                  max_length=32)),
+                ('payload', models.JSONField(blank=True, default=dict)),
+                ('user_id',
+                 models.CharField(blank=True, max_length=36, null=True)),
+                ('status',
+                 models.CharField(choices=[('PENDING', 'Pending'),
+                                           ('PROCESSING', 'Processing'),
+                                           ('DONE', 'Done'),
+                                           ('FAILED', 'Failed')],
+                                  default='PENDING',
+                                  max_length=32)),
+                ('attempts', models.IntegerField(default=0)),
+                ('message', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('qmoney_payment',
+                 models.ForeignKey(
+                     on_delete=django.db.models.deletion.CASCADE,
+                     related_name='outbox',
+                     to='qmoney_payment.qmoneypayment')),
+            ],
+            options={
+                'db_table': 'tblQmoneyPaymentOutbox',
+                'managed': True,
+            },
+        ),
+        migrations.AddIndex(
+            model_name='qmoneypaymentoutbox',
+            index=models.Index(fields=['status', 'created_at'],
+                               name='qmoney_payment_outbox_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='qmoneypaymentoutbox',
+            constraint=models.UniqueConstraint(
+                condition=models.Q(status__in=['PENDING', 'PROCESSING']),
+                fields=('qmoney_payment', ),
+                name='qmoney_payment_outbox_one_ongoing_per_payment'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qmoney_payment', '0010_qmoney_payment_outbox'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='qmoneypaymentoutbox',
+            name='operation',
+            field=models.CharField(choices=[('PROCEED', 'Proceed'),
+                                            ('REQUEST', 'Request')],
+                                   max_length=32),
+        ),
+    ]
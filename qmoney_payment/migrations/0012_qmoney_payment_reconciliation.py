@@ -0,0 +1,34 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qmoney_payment', '0011_qmoney_payment_outbox_request'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QMoneyPaymentReconciliation',
+            fields=[
+                ('name',
+                 models.CharField(max_length=64,
+                                  primary_key=True,
+                                  serialize=False)),
+                ('stale_before', models.DateTimeField(blank=True,
+                                                      null=True)),
+                ('last_created_at',
+                 models.DateTimeField(blank=True, null=True)),
+                ('last_uuid', models.UUIDField(blank=True, null=True)),
+                ('examined', models.IntegerField(default=0)),
+                ('proceeded', models.IntegerField(default=0)),
+                ('canceled', models.IntegerField(default=0)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'tblQmoneyPaymentReconciliation',
+                'managed': True,
+            },
+        ),
+    ]
@@ -0,0 +1,52 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qmoney_payment', '0012_qmoney_payment_reconciliation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QMoneyPaymentIdempotencyKey',
+            fields=[
+                ('id',
+                 models.BigAutoField(auto_created=True,
+                                     primary_key=True,
+                                     serialize=False,
+                                     verbose_name='ID')),
+                ('key', models.CharField(max_length=255)),
+                ('operation', models.CharField(max_length=32)),
+                ('user_id', models.CharField(max_length=36)),
+                ('fingerprint', models.CharField(max_length=64)),
+                ('ok', models.BooleanField(blank=True, null=True)),
+                ('message', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField()),
+                ('qmoney_payment',
+                 models.ForeignKey(
+                     blank=True,
+                     null=True,
+                     on_delete=django.db.models.deletion.SET_NULL,
+                     related_name='+',
+                     to='qmoney_payment.qmoneypayment')),
+            ],
+            options={
+                'db_table': 'tblQmoneyPaymentIdempotencyKey',
+                'managed': True,
+            },
+        ),
+        migrations.AddIndex(
+            model_name='qmoneypaymentidempotencykey',
+            index=models.Index(fields=['expires_at'],
+                               name='qmoney_payment_idempotency_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='qmoneypaymentidempotencykey',
+            constraint=models.UniqueConstraint(
+                fields=('user_id', 'operation', 'key'),
+                name='qmoney_payment_idempotency_key_unique'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qmoney_payment', '0013_qmoney_payment_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='qmoneypaymentoutbox',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='qmoneypaymentoutbox',
+            index=models.Index(fields=['status', 'claimed_at'],
+                               name='qmoney_outbox_claimed_idx'),
+        ),
+    ]
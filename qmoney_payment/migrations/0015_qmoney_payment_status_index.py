@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qmoney_payment', '0014_qmoney_payment_outbox_claimed_at'),
+    ]
+
+    operations = [
+        # the payments waiting for an OTP since their last update
+        migrations.RemoveIndex(
+            model_name='qmoneypayment',
+            name='qmoney_payment_status_idx',
+        ),
+        migrations.AddIndex(
+            model_name='qmoneypayment',
+            index=models.Index(fields=['status', 'updated_at'],
+                               name='qmoney_payment_status_idx'),
+        ),
+    ]
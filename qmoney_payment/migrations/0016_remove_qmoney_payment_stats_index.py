@@ -0,0 +1,17 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('qmoney_payment', '0015_qmoney_payment_status_index'),
+    ]
+
+    operations = [
+        # the period of the statistics is looked up with the created index,
+        # not worth a second index to maintain on each write
+        migrations.RemoveIndex(
+            model_name='qmoneypayment',
+            name='qmoney_payment_stats_idx',
+        ),
+    ]
@@ -1 +1,5 @@
-from .qmoney_payment import QMoneyPayment  # noqa: F401
\ No newline at end of file
+from .qmoney_payment import QMoneyPayment  # noqa: F401
+from .qmoney_payment_policy_summary import QMoneyPaymentPolicySummary  # noqa: F401
+from .qmoney_payment_outbox import QMoneyPaymentOutbox  # noqa: F401
+from .qmoney_payment_reconciliation import QMoneyPaymentReconciliation  # noqa: F401
+from .qmoney_payment_idempotency_key import QMoneyPaymentIdempotencyKey  # noqa: F401
@@ -2,15 +2,17 @@ import uuid
 
 from django.apps import apps
 from django.core.validators import MinValueValidator, ValidationError
-from django.db import models
-from django.db.models import Count, Q
-# from django.db import transaction as django_db_transaction
+from django.db import IntegrityError, connection, models
+from django.db import transaction as django_db_transaction
+from django.db.models import Q
+from django.utils import timezone
 from django.utils.translation import gettext as _
 
 from qmoney_payment.apps import QMoneyPaymentConfig
 from qmoney_payment.api.payment_transaction import PaymentTransaction
 from qmoney_payment.models.policy import get_policy_model
 from qmoney_payment.models.premium import get_premium_model
+from qmoney_payment.models.qmoney_payment_policy_summary import QMoneyPaymentPolicySummary
 
 
 class QMoneyPayment(models.Model):
@@ -29,7 +31,9 @@ class QMoneyPayment(models.Model):
         on_delete=models.CASCADE,
         # probably to enforce
         blank=True,
-        null=True)
+        null=True,
+        # covered by the (policy, status) index
+        db_index=False)
     premium = models.ForeignKey(get_premium_model(),
                                 on_delete=models.CASCADE,
                                 blank=True,
@@ -41,10 +45,14 @@ class QMoneyPayment(models.Model):
                               default=Status.I,
                               max_length=32)
     transaction = None
+    # the (policy_id, status, amount) last counted in the policy summary
+    __summarized = None
 
     # TODO Decide the precision: unity, dime, centime
     amount = models.IntegerField(default=0, validators=[MinValueValidator(0)])
     payer_wallet = models.CharField(max_length=200)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     @property
     def policy_uuid(self):
@@ -104,27 +112,150 @@ class QMoneyPayment(models.Model):
                                               self.external_transaction_id)
         return self.transaction
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.__summarized = instance.__summary_state()
+        return instance
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self.__summarized = self.__summary_state()
+
     def save(self, *args, **kwargs):
-        if self.policy is not None and self.status != QMoneyPayment.Status.C:
-            policy_from_db = get_policy_model(
-            ).objects.filter(id=self.policy.id).annotate(
-                ongoing_unproceeded_transactions=Count(
-                    'qmoneypayment__policy__pk',
-                    filter=~Q(qmoneypayment__status__exact=self.Status.P)
-                    & ~Q(qmoneypayment__status__exact=self.Status.C))).first()
-            max_unproceeded_transactions = self.MAX_SIMULTANEOUS_UNPROCEEDED_TRANSACTIONS
-            if not self._state.adding:
-                max_unproceeded_transactions += 1
-            if policy_from_db is not None and policy_from_db.ongoing_unproceeded_transactions >= max_unproceeded_transactions:
-                raise ValidationError(
-                    # Translators: This message will replace named-string max
-                    _('models.qmoney_payment.save.error.validation.maximum_transactions_reached'
-                      ).format(
-                          max=self.MAX_SIMULTANEOUS_UNPROCEEDED_TRANSACTIONS))
         self.transaction = None
-        return super().save(*args, **kwargs)
+        previous = self.__previous_summary_state()
+        if not connection.features.supports_partial_indexes:
+            # the constraint below can't be created, check it by hand
+            self.__raise_if_maximum_transactions_reached(previous)
+        may_violate_constraint = self.policy_id is not None and self.__is_unproceeded(
+        )
+        try:
+            # in a savepoint when the save is part of a transaction and may
+            # violate the constraint, so that the violation doesn't break it
+            with django_db_transaction.atomic(
+                    savepoint=may_violate_constraint):
+                super().save(*args, **kwargs)
+                current = self.__summary_state()
+                QMoneyPaymentPolicySummary.record_transition(
+                    previous, current, self.updated_at)
+        except IntegrityError as error:
+            if may_violate_constraint and self.__has_other_unproceeded_transactions(
+            ):
+                raise self.__maximum_transactions_reached() from error
+            raise
+        self.__summarized = current
+
+    def delete(self, *args, **kwargs):
+        previous = self.__previous_summary_state()
+        with django_db_transaction.atomic():
+            deleted = super().delete(*args, **kwargs)
+            QMoneyPaymentPolicySummary.record_transition(
+                previous, None, timezone.now())
+        self.__summarized = None
+        return deleted
+
+    @classmethod
+    def bulk_set_status(cls, queryset, status):
+        # One UPDATE for all the payments of the queryset, bypassing save(),
+        # with the summaries of their policies updated accordingly
+        with django_db_transaction.atomic():
+            rows = list(
+                queryset.select_for_update().values_list(
+                    'uuid', 'policy_id', 'status', 'amount'))
+            if not rows:
+                return 0
+            now = timezone.now()
+            cls.objects.filter(uuid__in=[row[0] for row in rows]).update(
+                status=status, updated_at=now)
+            QMoneyPaymentPolicySummary.record_transitions(
+                [((policy_id, previous_status, amount),
+                  (policy_id, status, amount))
+                 for _uuid, policy_id, previous_status, amount in rows], now)
+        return len(rows)
+
+    @classmethod
+    def bulk_create_all(cls, qmoney_payments):
+        # One INSERT for all the payments, bypassing save(), with the
+        # summaries of their policies updated accordingly. None is created if
+        # one of them violates the constraint below.
+        with django_db_transaction.atomic():
+            cls.objects.bulk_create(qmoney_payments)
+            QMoneyPaymentPolicySummary.record_transitions(
+                [(None, payment.__summary_state())
+                 for payment in qmoney_payments], timezone.now())
+        for payment in qmoney_payments:
+            payment.__summarized = payment.__summary_state()
+        return qmoney_payments
+
+    def __summary_state(self):
+        if not {'policy_id', 'status', 'amount'} <= self.__dict__.keys():
+            # deferred fields
+            return None
+        return (self.policy_id, self.status, self.amount)
+
+    def __previous_summary_state(self):
+        if self._state.adding:
+            return None
+        if self.__summarized is not None:
+            return self.__summarized
+        return QMoneyPayment.objects.filter(pk=self.pk).values_list(
+            'policy_id', 'status', 'amount').first()
+
+    def __is_unproceeded(self):
+        return self.status not in (QMoneyPayment.Status.P,
+                                   QMoneyPayment.Status.C)
+
+    def __has_other_unproceeded_transactions(self):
+        return QMoneyPayment.objects.filter(policy_id=self.policy_id).exclude(
+            status__in=[QMoneyPayment.Status.P, QMoneyPayment.Status.C
+                        ]).exclude(pk=self.pk).exists()
+
+    def __maximum_transactions_reached(self):
+        return ValidationError(
+            # Translators: This message will replace named-string max
+            _('models.qmoney_payment.save.error.validation.maximum_transactions_reached'
+              ).format(max=self.MAX_SIMULTANEOUS_UNPROCEEDED_TRANSACTIONS))
+
+    def __raise_if_maximum_transactions_reached(self, previous):
+        if self.policy_id is None or not self.__is_unproceeded():
+            return
+        others = QMoneyPaymentPolicySummary.open_count_of(self.policy_id)
+        if previous is not None and previous[0] == self.policy_id and previous[
+                1] not in (QMoneyPayment.Status.P, QMoneyPayment.Status.C):
+            # already counted
+            others -= 1
+        if others >= self.MAX_SIMULTANEOUS_UNPROCEEDED_TRANSACTIONS:
+            raise self.__maximum_transactions_reached()
 
     class Meta:
         managed = True
         db_table = 'tblQmoneyPayment'
         app_label = 'qmoney_payment'
+        constraints = [
+            # enforces MAX_SIMULTANEOUS_UNPROCEEDED_TRANSACTIONS, i.e. at most
+            # one payment neither proceeded nor canceled per policy, also
+            # between concurrent requests
+            models.UniqueConstraint(
+                fields=['policy'],
+                condition=~Q(status__in=['PROCEEDED', 'CANCELED']),
+                name='qmoney_payment_one_unproceeded_per_policy'),
+        ]
+        indexes = [
+            # the payments of a policy, optionally of some statuses
+            models.Index(fields=['policy', 'status'],
+                         name='qmoney_payment_policy_idx'),
+            # the payments of some statuses, e.g. waiting for too long
+            models.Index(fields=['status', 'updated_at'],
+                         name='qmoney_payment_status_idx'),
+            # the payment of a QMoney transaction
+            models.Index(fields=['external_transaction_id'],
+                         name='qmoney_payment_external_idx'),
+            # the payments of a payer, filtered in the listing
+            models.Index(fields=['payer_wallet', 'created_at'],
+                         name='qmoney_payment_wallet_idx'),
+            # the ordering of the keyset pagination of the payments, also the
+            # period of the statistics
+            models.Index(fields=['created_at', 'uuid'],
+                         name='qmoney_payment_created_idx'),
+        ]
@@ -0,0 +1,101 @@
+import datetime
+
+from django.db import IntegrityError, models, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from qmoney_payment.models.qmoney_payment import QMoneyPayment
+
+
+class QMoneyPaymentIdempotencyKey(models.Model):
+    # The outcome of a mutation sent with an idempotency key, returned as it
+    # is when the same mutation is sent again with the same key (e.g. retried
+    # on a poor network) until it expires, instead of making it again.
+    key = models.CharField(max_length=255)
+    operation = models.CharField(max_length=32)
+    user_id = models.CharField(max_length=36)
+    # of the arguments of the mutation, a key can't be reused with others
+    fingerprint = models.CharField(max_length=64)
+    qmoney_payment = models.ForeignKey(QMoneyPayment,
+                                       on_delete=models.SET_NULL,
+                                       blank=True,
+                                       null=True,
+                                       related_name='+')
+    # None as long as the mutation is being made
+    ok = models.BooleanField(blank=True, null=True)
+    message = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+
+    @classmethod
+    def claim(cls, key, operation, user_id, fingerprint, ttl, lease=None):
+        # Returns the key and whether it has been claimed by the caller, who
+        # has then to make the mutation and record its outcome. A key still
+        # pending `lease` seconds after being claimed can be claimed again.
+        values = {
+            'fingerprint': fingerprint,
+            'expires_at': timezone.now() + datetime.timedelta(seconds=ttl)
+        }
+        lookup = {'key': key, 'operation': operation, 'user_id': user_id}
+        try:
+            with transaction.atomic():
+                return cls.objects.create(**lookup, **values), True
+        except IntegrityError:
+            pass
+        existing = cls.objects.filter(**lookup).first()
+        if existing is not None and not existing.is_expired(
+        ) and not existing.is_abandoned(lease):
+            return existing, False
+        # expired, abandoned, or deleted meanwhile
+        now = timezone.now()
+        replaceable = Q(expires_at__lte=now)
+        if lease is not None:
+            replaceable |= Q(ok=None,
+                             created_at__lte=now -
+                             datetime.timedelta(seconds=lease))
+        cls.objects.filter(replaceable, **lookup).delete()
+        try:
+            with transaction.atomic():
+                return cls.objects.create(**lookup, **values), True
+        except IntegrityError:
+            # claimed meanwhile by a concurrent retry
+            return cls.objects.get(**lookup), False
+
+    @classmethod
+    def purge_expired(cls):
+        deleted, _deleted_per_model = cls.objects.filter(
+            expires_at__lte=timezone.now()).delete()
+        return deleted
+
+    def is_expired(self):
+        return self.expires_at <= timezone.now()
+
+    def is_pending(self):
+        return self.ok is None
+
+    def is_abandoned(self, lease):
+        return lease is not None and self.is_pending(
+        ) and self.created_at <= timezone.now() - datetime.timedelta(
+            seconds=lease)
+
+    def record(self, ok, qmoney_payment=None, message=''):
+        self.ok = ok
+        self.qmoney_payment = qmoney_payment
+        self.message = message
+        self.save(update_fields=['ok', 'qmoney_payment', 'message'])
+
+    class Meta:
+        managed = True
+        db_table = 'tblQmoneyPaymentIdempotencyKey'
+        app_label = 'qmoney_payment'
+        constraints = [
+            # also the index the keys are looked up with
+            models.UniqueConstraint(
+                fields=['user_id', 'operation', 'key'],
+                name='qmoney_payment_idempotency_key_unique'),
+        ]
+        indexes = [
+            # the expired keys to purge
+            models.Index(fields=['expires_at'],
+                         name='qmoney_payment_idempotency_idx'),
+        ]
@@ -0,0 +1,54 @@
+from django.db import models
+from django.db.models import Q
+
+from qmoney_payment.models.qmoney_payment import QMoneyPayment
+
+
+class QMoneyPaymentOutbox(models.Model):
+    # A call to the QMoney gateway to be made for a payment. It is committed
+    # before the call, which is then made outside of any DB transaction by
+    # whoever claims it, and its result is applied in a short transaction.
+    # The requests made in the background are queued the same way.
+    Operation = models.TextChoices('Operation', ['PROCEED', 'REQUEST'])
+    Status = models.TextChoices('Status',
+                                ['PENDING', 'PROCESSING', 'DONE', 'FAILED'])
+
+    qmoney_payment = models.ForeignKey(QMoneyPayment,
+                                       on_delete=models.CASCADE,
+                                       related_name='outbox')
+    operation = models.CharField(choices=Operation.choices, max_length=32)
+    # the arguments of the call, emptied once it has been made
+    payload = models.JSONField(default=dict, blank=True)
+    # who asked for it, as the premium of a proceeded payment is created on
+    # their behalf
+    user_id = models.CharField(max_length=36, blank=True, null=True)
+    status = models.CharField(choices=Status.choices,
+                              default=Status.PENDING,
+                              max_length=32)
+    attempts = models.IntegerField(default=0)
+    # when it was last claimed, it is reclaimed once its lease has expired,
+    # e.g. when the process making the call has been killed
+    claimed_at = models.DateTimeField(blank=True, null=True)
+    message = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        managed = True
+        db_table = 'tblQmoneyPaymentOutbox'
+        app_label = 'qmoney_payment'
+        constraints = [
+            # a payment isn't sent twice to the gateway at the same time
+            models.UniqueConstraint(
+                fields=['qmoney_payment'],
+                condition=Q(status__in=['PENDING', 'PROCESSING']),
+                name='qmoney_payment_outbox_one_ongoing_per_payment'),
+        ]
+        indexes = [
+            # the oldest entries to process
+            models.Index(fields=['status', 'created_at'],
+                         name='qmoney_payment_outbox_idx'),
+            # the entries being processed for too long
+            models.Index(fields=['status', 'claimed_at'],
+                         name='qmoney_outbox_claimed_idx'),
+        ]
@@ -0,0 +1,132 @@
+import collections
+import itertools
+
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, F, Max, Q, Sum
+from django.db.models.functions import Coalesce
+
+from qmoney_payment.models.policy import get_policy_model
+
+PROCEEDED = 'PROCEEDED'
+CLOSED_STATUSES = ('PROCEEDED', 'CANCELED')
+
+
+def contribution_of(status, amount):
+    # what a payment of the given status adds to the summary of its policy
+    return {
+        'open_count': 0 if status in CLOSED_STATUSES else 1,
+        'proceeded_count': 1 if status == PROCEEDED else 0,
+        'proceeded_amount': amount if status == PROCEEDED else 0,
+    }
+
+
+def summaries_of(qmoney_payment_model, summary_model):
+    rows = qmoney_payment_model.objects.filter(
+        policy__isnull=False).values('policy').annotate(
+            open_count=Count('uuid', filter=~Q(status__in=CLOSED_STATUSES)),
+            proceeded_count=Count('uuid', filter=Q(status=PROCEEDED)),
+            proceeded_amount=Coalesce(
+                Sum('amount', filter=Q(status=PROCEEDED)), 0),
+            # the time of the last status change is not recorded, the one of
+            # the last update is the closest
+            last_status_change_at=Max('updated_at')).order_by()
+    for row in rows.iterator():
+        yield summary_model(policy_id=row.pop('policy'), **row)
+
+
+def rebuild_policy_summaries(qmoney_payment_model,
+                             summary_model,
+                             batch_size=1000):
+    summaries = summaries_of(qmoney_payment_model, summary_model)
+    count = 0
+    with transaction.atomic():
+        summary_model.objects.all().delete()
+        while True:
+            batch = list(itertools.islice(summaries, batch_size))
+            if not batch:
+                return count
+            summary_model.objects.bulk_create(batch)
+            count += len(batch)
+
+
+class QMoneyPaymentPolicySummary(models.Model):
+    # The payments of a policy, kept up to date by QMoneyPayment.save() in
+    # the same transaction, not to count them each time they are needed.
+    # It can be recomputed from scratch with the management command
+    # rebuild_qmoney_payment_summaries.
+    policy = models.OneToOneField(get_policy_model(),
+                                  on_delete=models.CASCADE,
+                                  primary_key=True,
+                                  related_name='qmoney_payment_summary')
+    open_count = models.IntegerField(default=0)
+    proceeded_count = models.IntegerField(default=0)
+    proceeded_amount = models.BigIntegerField(default=0)
+    last_status_change_at = models.DateTimeField(blank=True, null=True)
+
+    @classmethod
+    def open_count_of(cls, policy_id):
+        return cls.objects.filter(policy_id=policy_id).values_list(
+            'open_count', flat=True).first() or 0
+
+    @classmethod
+    def record_transition(cls, previous, current, changed_at):
+        # previous and current are the (policy_id, status, amount) of a
+        # payment before and after it is saved, None when it doesn't exist
+        cls.record_transitions([(previous, current)], changed_at)
+
+    @classmethod
+    def record_transitions(cls, transitions, changed_at):
+        # the (previous, current) of payments changed at once, e.g. by a bulk
+        # update
+        changes = collections.defaultdict(collections.Counter)
+        status_changed = set()
+        for previous, current in transitions:
+            if previous is not None and previous[0] is not None:
+                changes[previous[0]].subtract(contribution_of(*previous[1:]))
+            if current is not None and current[0] is not None:
+                changes[current[0]].update(contribution_of(*current[1:]))
+            if previous is None or current is None or previous[1] != current[
+                    1]:
+                status_changed.update(state[0]
+                                      for state in (previous, current)
+                                      if state is not None)
+        # the policies changed the same way, e.g. all the ones of payments
+        # expired at once, are updated together
+        groups = collections.defaultdict(list)
+        for policy_id, deltas in changes.items():
+            deltas = tuple(
+                sorted((name, delta) for name, delta in deltas.items()
+                       if delta))
+            if deltas or policy_id in status_changed:
+                groups[(deltas, policy_id in status_changed)].append(policy_id)
+        for (deltas, changed), policy_ids in groups.items():
+            cls.__apply(policy_ids, dict(deltas),
+                        changed_at if changed else None)
+
+    @classmethod
+    def __apply(cls, policy_ids, deltas, changed_at):
+        values = {name: F(name) + delta for name, delta in deltas.items()}
+        if changed_at is not None:
+            values['last_status_change_at'] = changed_at
+        updated = cls.objects.filter(policy_id__in=policy_ids).update(**values)
+        if updated == len(policy_ids):
+            return
+        missing = set(policy_ids)
+        if updated:
+            missing -= set(
+                cls.objects.filter(policy_id__in=policy_ids).values_list(
+                    'policy_id', flat=True))
+        for policy_id in missing:
+            try:
+                with transaction.atomic():
+                    cls.objects.create(policy_id=policy_id,
+                                       last_status_change_at=changed_at,
+                                       **deltas)
+            except IntegrityError:
+                # created meanwhile by a concurrent transaction
+                cls.objects.filter(policy_id=policy_id).update(**values)
+
+    class Meta:
+        managed = True
+        db_table = 'tblQmoneyPaymentPolicySummary'
+        app_label = 'qmoney_payment'
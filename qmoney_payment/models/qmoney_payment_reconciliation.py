@@ -0,0 +1,25 @@
+from django.db import models
+
+
+class QMoneyPaymentReconciliation(models.Model):
+    # The progress of a reconciliation of the payments left waiting, saved
+    # after each batch so that an interrupted run resumes after the last
+    # payment it has examined instead of starting over.
+    name = models.CharField(max_length=64, primary_key=True)
+    # the payments created before are the stale ones of the run
+    stale_before = models.DateTimeField(blank=True, null=True)
+    last_created_at = models.DateTimeField(blank=True, null=True)
+    last_uuid = models.UUIDField(blank=True, null=True)
+    examined = models.IntegerField(default=0)
+    proceeded = models.IntegerField(default=0)
+    canceled = models.IntegerField(default=0)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    def is_finished(self):
+        return self.finished_at is not None
+
+    class Meta:
+        managed = True
+        db_table = 'tblQmoneyPaymentReconciliation'
+        app_label = 'qmoney_payment'
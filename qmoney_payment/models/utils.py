@@ -2,8 +2,14 @@ import importlib
 
 from django.apps import apps
 from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 from django.utils.translation import gettext as _
 
+# The models resolved by get_openimis_model, by (module, name), as they are
+# looked up on the hot paths, e.g. by every save of a payment
+resolved_models = {}
+
 
 def get_fully_qualified_name_of_model(model):
     return f'{model._meta.app_label}.{model._meta.model_name}'
@@ -19,6 +25,24 @@ def import_class(from_module, name):
 
 
 def get_openimis_model(openimis_module, name):
+    model = resolved_models.get((openimis_module, name))
+    if model is not None:
+        return model
+    model = resolve_openimis_model(openimis_module, name)
+    if apps.ready:
+        # before, the model of an app not loaded yet could be found later
+        resolved_models[(openimis_module, name)] = model
+    return model
+
+
+@receiver(setting_changed)
+def forget_resolved_models(setting, **_kwargs):
+    # e.g. the tests overriding the custom models
+    if setting == 'CUSTOM_MODELS':
+        resolved_models.clear()
+
+
+def resolve_openimis_model(openimis_module, name):
     try:
         model = apps.get_model(openimis_module, name, require_ready=False)
         return model
@@ -30,4 +54,4 @@ def get_openimis_model(openimis_module, name):
                 _('models.utils.get_openimis_model.error.model_fqn_empty').
                 format(name=name)) from error
         model = import_class(model_fqn[0], model_fqn[1])
-        return model
\ No newline at end of file
+        return model
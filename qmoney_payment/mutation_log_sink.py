@@ -0,0 +1,244 @@
+import atexit
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from django.apps import apps
+from django.db import DatabaseError, connection
+
+from qmoney_payment.apps import QMoneyPaymentConfig
+from qmoney_payment.models.mutation_log import get_mutation_log_model
+
+DEFAULT_BATCH_SIZE = 1
+DEFAULT_FLUSH_INTERVAL = 5
+SPOOL_PREFIX = 'qmoney_payment_mutation_log.'
+SPOOL_SUFFIX = '.spool'
+# in the name of a spool file claimed by the process recovering it
+CLAIM_INFIX = '.recovered-by-'
+
+logger = logging.getLogger(__name__)
+
+
+def mutation_log_sink():
+    config = apps.get_app_config(QMoneyPaymentConfig.name)
+    if config.mutation_log_sink is None:
+        config.mutation_log_sink = MutationLogSink.from_settings(
+            config.settings['mutation_log'])
+    return config.mutation_log_sink
+
+
+def write(entries):
+    model = get_mutation_log_model()
+    if len(entries) == 1:
+        # without the transaction of a bulk create
+        model.objects.create(**entries[0])
+        return
+    model.objects.bulk_create([model(**fields) for fields in entries])
+
+
+def read(spool):
+    return [json.loads(line) for line in spool if line.strip()]
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class MutationLogEntry:
+    # The log of one mutation, written once it is finished, in its final
+    # status, instead of being created then updated
+
+    def __init__(self, sink, json_content, user_id, client_mutation_label):
+        self.sink = sink
+        self.fields = {
+            # as it would have been stored by the text field
+            'json_content': str(json_content),
+            'user_id': user_id,
+            'client_mutation_label': client_mutation_label,
+        }
+
+    def mark_as_successful(self):
+        if 'status' in self.fields:
+            return
+        self.fields['status'] = get_mutation_log_model().SUCCESS
+        self.sink.add(self.fields)
+
+    def mark_as_failed(self, error):
+        if 'status' in self.fields:
+            return
+        self.fields['status'] = get_mutation_log_model().ERROR
+        self.fields['error'] = error
+        self.sink.add(self.fields)
+
+
+class MutationLogSink:
+    # Writes the mutation logs by batches of `batch_size`, or every
+    # `flush_interval` seconds, and when the process exits. Until then, the
+    # logs of a process are appended to its own spool file, from which they
+    # are recovered if the process stops without writing them. With a batch
+    # size of 1, each log is written at once.
+
+    def __init__(self,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 spool_dir=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_dir = spool_dir or tempfile.gettempdir()
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.spool = None
+        self.pid = None
+        self.is_recovered = False
+        self.stopping = threading.Event()
+
+    @classmethod
+    def from_settings(cls, settings):
+        conversions = {
+            'batch_size': int,
+            'flush_interval': float,
+            'spool_dir': str,
+        }
+        values = {
+            name: convert(settings[name])
+            for name, convert in conversions.items()
+            if settings.get(name) not in (None, '')
+        }
+        return cls(**values)
+
+    def entry(self, json_content, user_id, client_mutation_label):
+        return MutationLogEntry(self, json_content, user_id,
+                                client_mutation_label)
+
+    def is_buffered(self):
+        return self.batch_size > 1
+
+    def spool_path(self, pid):
+        return os.path.join(self.spool_dir,
+                            f'{SPOOL_PREFIX}{pid}{SPOOL_SUFFIX}')
+
+    def add(self, fields):
+        if not self.is_buffered():
+            write([fields])
+            return
+        with self.lock:
+            is_starting = self.__start()
+            self.buffer.append(fields)
+            self.spool.write(json.dumps(fields, default=str) + '\n')
+            self.spool.flush()
+            is_full = len(self.buffer) >= self.batch_size
+        if is_starting:
+            # out of the lock, not to hold the mutations meanwhile
+            self.__recover()
+        if is_full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            entries, self.buffer = self.buffer, []
+            if not entries:
+                return 0
+            try:
+                write(entries)
+            except Exception as error:
+                # kept, in the spool as well, for the next flush
+                self.buffer[:0] = entries
+                if not isinstance(error, DatabaseError):
+                    raise
+                logger.exception('%s mutation logs not written yet',
+                                 len(entries))
+                return 0
+            self.spool.seek(0)
+            self.spool.truncate()
+        return len(entries)
+
+    def close(self):
+        self.stopping.set()
+        self.flush()
+        with self.lock:
+            if self.spool is not None and not self.buffer:
+                self.spool.close()
+                os.remove(self.spool.name)
+                self.spool = None
+
+    def recover(self):
+        # the logs left in the spool files of the processes which are gone,
+        # each file being claimed first so that the processes recovering at
+        # the same time, e.g. all the workers restarted after a crash, don't
+        # write its logs twice
+        count = 0
+        for path in glob.glob(self.spool_path('*')):
+            owner = os.path.basename(path)[len(SPOOL_PREFIX):-len(
+                SPOOL_SUFFIX)]
+            # the one recovering it, if any, else the one which wrote it
+            pid = owner.rsplit(CLAIM_INFIX, 1)[-1]
+            if not pid.isdigit() or is_alive(int(pid)):
+                continue
+            claimed = self.spool_path(
+                f'{owner.split(CLAIM_INFIX)[0]}{CLAIM_INFIX}{os.getpid()}')
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                # claimed by another process
+                continue
+            try:
+                with open(claimed, encoding='utf-8') as spool:
+                    entries = read(spool)
+                if entries:
+                    write(entries)
+            except Exception:
+                # released, to be recovered again by this process or another
+                os.rename(claimed, path)
+                raise
+            os.remove(claimed)
+            count += len(entries)
+        return count
+
+    def __start(self):
+        if self.spool is not None and self.pid == os.getpid():
+            return False
+        # first log of the process, a forked one starts afresh
+        self.pid = os.getpid()
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.spool = open(  # pylint: disable=consider-using-with
+            self.spool_path(self.pid), 'a+', encoding='utf-8')
+        # left by a previous process of the same PID
+        self.spool.seek(0)
+        self.buffer = read(self.spool)
+        self.is_recovered = False
+        self.stopping.clear()
+        threading.Thread(target=self.__flush_periodically,
+                         name='qmoney-payment-mutation-log',
+                         daemon=True).start()
+        atexit.register(self.close)
+        return True
+
+    def __recover(self):
+        try:
+            self.recover()
+        except (DatabaseError, OSError, ValueError):
+            logger.exception('Spooled mutation logs not recovered')
+            return
+        self.is_recovered = True
+
+    def __flush_periodically(self):
+        try:
+            while not self.stopping.wait(self.flush_interval):
+                try:
+                    self.flush()
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception('Mutation logs not flushed')
+                if not self.is_recovered:
+                    # retried until the database is back
+                    self.__recover()
+        finally:
+            connection.close()
@@ -0,0 +1,168 @@
+import base64
+import binascii
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.utils.translation import gettext as _
+
+from graphene.relay import PageInfo
+from graphene_django.filter import DjangoFilterConnectionField
+
+from core import ExtendedConnection
+
+KEYSET_CURSOR_PREFIX = 'keyset:'
+
+
+def keyset_condition(ordering, values, after=True):
+    # the rows after (or before) the given values of the ordering, e.g. for
+    # (a, -b): a >= x and (a > x or (a = x and b < y)). The bound on the
+    # leading column lets the planner seek an index on the ordering instead
+    # of scanning it from the start to filter the disjunction.
+    condition = Q()
+    for position, name in enumerate(ordering):
+        equal = {
+            previous.lstrip('-'): value
+            for previous, value in zip(ordering[:position], values)
+        }
+        lookup = 'gt' if name.startswith('-') != after else 'lt'
+        condition |= Q(**equal,
+                       **{f'{name.lstrip("-")}__{lookup}': values[position]})
+    leading = ordering[0]
+    lookup = 'gte' if leading.startswith('-') != after else 'lte'
+    return Q(**{f'{leading.lstrip("-")}__{lookup}': values[0]}) & condition
+
+
+def is_keyset_cursor(cursor):
+    try:
+        return base64.b64decode(cursor.encode()).decode().startswith(
+            KEYSET_CURSOR_PREFIX)
+    except (binascii.Error, UnicodeDecodeError):
+        return False
+
+
+class KeysetConnection(ExtendedConnection):
+    # Counting all the rows is as expensive as an offset, so the total count
+    # of a keyset page is only computed when it is asked for.
+
+    class Meta:
+        abstract = True
+
+    def resolve_total_count(self, info, **kwargs):
+        total_count = super().resolve_total_count(info, **kwargs)
+        if total_count is None:
+            total_count = self.length = self.iterable.count()
+        return total_count
+
+
+class KeysetConnectionField(DjangoFilterConnectionField):
+    # A connection paginated on a unique ordering rather than on an offset:
+    # a page is the rows following (or preceding) the ones of its cursor, so
+    # a deep page costs as much as the first one when the ordering is
+    # indexed, and does not shift when rows are added in between requests.
+    # The ordering of the queryset, e.g. from an `order_by` filter, is kept
+    # and made unique with the primary key. The offset pagination is still
+    # used when an offset, or a cursor given by it, is given.
+    ordering = ('created_at', )
+
+    @classmethod
+    def resolve_connection(cls, connection, args, iterable, max_limit=None):
+        cursors = [
+            args[name] for name in ('after', 'before')
+            if args.get(name) is not None
+        ]
+        if args.get('offset') is not None or not all(
+                is_keyset_cursor(cursor) for cursor in cursors):
+            return super().resolve_connection(connection, args, iterable,
+                                              max_limit)
+        args.pop('offset', None)
+
+        ordering = cls.unique_ordering_of(iterable)
+        queryset = iterable.order_by(*ordering)
+        after = args.get('after')
+        before = args.get('before')
+        if after is not None:
+            queryset = queryset.filter(
+                keyset_condition(
+                    ordering, cls.from_cursor(queryset.model, ordering,
+                                              after)))
+        if before is not None:
+            queryset = queryset.filter(
+                keyset_condition(ordering,
+                                 cls.from_cursor(queryset.model, ordering,
+                                                 before),
+                                 after=False))
+
+        first = args.get('first')
+        last = args.get('last')
+        if first is None and last is None:
+            first = max_limit
+        has_previous_page = after is not None
+        has_next_page = before is not None
+        if first is not None or last is None:
+            nodes = list(queryset if first is None else queryset[:first + 1])
+            if first is not None and len(nodes) > first:
+                nodes = nodes[:first]
+                has_next_page = True
+            if last is not None and len(nodes) > last:
+                nodes = nodes[len(nodes) - last:]
+                has_previous_page = True
+        else:
+            nodes = list(queryset.reverse()[:last + 1])
+            if len(nodes) > last:
+                nodes = nodes[:last]
+                has_previous_page = True
+            nodes.reverse()
+
+        edges = [
+            connection.Edge(node=node, cursor=cls.to_cursor(node, ordering))
+            for node in nodes
+        ]
+        page = connection(edges=edges,
+                          page_info=PageInfo(
+                              start_cursor=edges[0].cursor if edges else None,
+                              end_cursor=edges[-1].cursor if edges else None,
+                              has_previous_page=has_previous_page,
+                              has_next_page=has_next_page,
+                          ))
+        page.iterable = iterable
+        page.length = None
+        return page
+
+    @classmethod
+    def unique_ordering_of(cls, queryset):
+        ordering = [
+            name for name in queryset.query.order_by
+            if isinstance(name, str) and name != '?'
+        ] or list(cls.ordering)
+        primary_key = queryset.model._meta.pk.name
+        if primary_key not in [name.lstrip('-') for name in ordering]:
+            ordering.append(primary_key)
+        return tuple(ordering)
+
+    @classmethod
+    def to_cursor(cls, node, ordering):
+        values = [
+            node._meta.get_field(name.lstrip('-')).value_to_string(node)
+            for name in ordering
+        ]
+        return base64.b64encode(
+            (KEYSET_CURSOR_PREFIX +
+             json.dumps([list(ordering), values])).encode()).decode()
+
+    @classmethod
+    def from_cursor(cls, model, ordering, cursor):
+        # a cursor is only valid for the ordering of the page it comes from
+        try:
+            cursor_ordering, values = json.loads(
+                base64.b64decode(
+                    cursor.encode()).decode()[len(KEYSET_CURSOR_PREFIX):])
+            if tuple(cursor_ordering) != ordering or len(values) != len(
+                    ordering):
+                raise ValueError(cursor)
+            return [
+                model._meta.get_field(name.lstrip('-')).to_python(value)
+                for name, value in zip(ordering, values)
+            ]
+        except (ValueError, TypeError, ValidationError) as error:
+            raise ValidationError(_('query.error.invalid_cursor')) from error
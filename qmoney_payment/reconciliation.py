@@ -0,0 +1,160 @@
+import collections
+import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils import timezone
+
+from qmoney_payment.api.payment_transaction import PaymentTransaction
+from qmoney_payment.models.qmoney_payment import QMoneyPayment
+from qmoney_payment.models.qmoney_payment_outbox import QMoneyPaymentOutbox
+from qmoney_payment.models.qmoney_payment_reconciliation import QMoneyPaymentReconciliation
+from qmoney_payment.pagination import keyset_condition
+from qmoney_payment.services import create_premiums_for, reclaim_abandoned_outbox_entries
+
+DEFAULT_NAME = 'default'
+DEFAULT_STALE_AFTER = 3600
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_CONCURRENCY = 8
+
+# the payments which block their policy until they are revisited
+STALE_STATUSES = (QMoneyPayment.Status.W, QMoneyPayment.Status.U)
+ORDERING = ('created_at', 'uuid')
+
+logger = logging.getLogger(__name__)
+
+
+def reconcile_stale_payments(name=DEFAULT_NAME,
+                             stale_after=DEFAULT_STALE_AFTER,
+                             batch_size=DEFAULT_BATCH_SIZE,
+                             concurrency=DEFAULT_CONCURRENCY,
+                             max_batches=None):
+    # Asks QMoney the state of the transactions of the payments waiting for
+    # more than `stale_after` seconds, then proceeds the ones paid (creating
+    # their premium) and cancels the ones which won't ever be. It can be
+    # scheduled as it is; a run interrupted, or stopped after `max_batches`,
+    # is resumed by the next one of the same name.
+    # the payments whose call has been abandoned are reconciled as well
+    reclaim_abandoned_outbox_entries()
+    reconciliation = start_or_resume(name, stale_after)
+    batches = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while max_batches is None or batches < max_batches:
+            payments = next_stale_batch(reconciliation, batch_size)
+            if not payments:
+                reconciliation.finished_at = timezone.now()
+                reconciliation.save()
+                break
+            states = list(executor.map(fetch_gateway_state, payments))
+            apply_gateway_states(reconciliation, payments, states)
+            batches += 1
+    return reconciliation
+
+
+def start_or_resume(name, stale_after):
+    reconciliation, _created = QMoneyPaymentReconciliation.objects.get_or_create(
+        name=name)
+    if reconciliation.stale_before is not None and not reconciliation.is_finished(
+    ):
+        return reconciliation
+    now = timezone.now()
+    reconciliation.stale_before = now - datetime.timedelta(seconds=stale_after)
+    reconciliation.last_created_at = None
+    reconciliation.last_uuid = None
+    reconciliation.examined = 0
+    reconciliation.proceeded = 0
+    reconciliation.canceled = 0
+    reconciliation.started_at = now
+    reconciliation.finished_at = None
+    reconciliation.save()
+    return reconciliation
+
+
+def next_stale_batch(reconciliation, batch_size):
+    queryset = QMoneyPayment.objects.filter(
+        status__in=STALE_STATUSES,
+        created_at__lt=reconciliation.stale_before).exclude(
+            # being proceeded meanwhile
+            outbox__status__in=[
+                QMoneyPaymentOutbox.Status.PENDING,
+                QMoneyPaymentOutbox.Status.PROCESSING
+            ]).order_by(*ORDERING)
+    if reconciliation.last_uuid is not None:
+        queryset = queryset.filter(
+            keyset_condition(
+                ORDERING,
+                (reconciliation.last_created_at, reconciliation.last_uuid)))
+    return list(queryset[:batch_size])
+
+
+def fetch_gateway_state(qmoney_payment):
+    # Called concurrently, it only calls QMoney and doesn't touch the DB
+    if qmoney_payment.external_transaction_id is None:
+        # never requested to QMoney, there is nothing to proceed
+        return PaymentTransaction.State.FAILED
+    payment_transaction = qmoney_payment.payment_transaction()
+    try:
+        payment_transaction.fetch_state()
+    except Exception:  # pylint: disable=broad-except
+        logger.exception('State of QMoney transaction %s not fetched',
+                         qmoney_payment.external_transaction_id)
+        return PaymentTransaction.State.UNKNOWN
+    return payment_transaction.state()
+
+
+@transaction.atomic
+def apply_gateway_states(reconciliation, payments, states):
+    # The transitions of a batch and the progress are committed together
+    paid = [
+        payment for payment, state in zip(payments, states)
+        if state is PaymentTransaction.State.PROCEEDED
+    ]
+    closed = [
+        payment.uuid for payment, state in zip(payments, states)
+        if state in (PaymentTransaction.State.FAILED,
+                     PaymentTransaction.State.CANCELED)
+    ]
+    reconciliation.canceled += QMoneyPayment.bulk_set_status(
+        QMoneyPayment.objects.filter(uuid__in=closed,
+                                     status__in=STALE_STATUSES),
+        QMoneyPayment.Status.C)
+    reconciliation.proceeded += proceed_paid(paid)
+    reconciliation.examined += len(payments)
+    reconciliation.last_created_at = payments[-1].created_at
+    reconciliation.last_uuid = payments[-1].uuid
+    reconciliation.save()
+
+
+def proceed_paid(payments):
+    # the ones still waiting are proceeded together, their premiums created
+    # at once for each user who tried to proceed them
+    uuids = [payment.uuid for payment in payments]
+    proceeded = QMoneyPayment.bulk_set_status(
+        QMoneyPayment.objects.filter(uuid__in=uuids,
+                                     status__in=STALE_STATUSES),
+        QMoneyPayment.Status.P)
+    if not proceeded:
+        return 0
+    payments_of_user = collections.defaultdict(list)
+    for qmoney_payment in QMoneyPayment.objects.select_related(
+            'policy').filter(uuid__in=uuids,
+                             status=QMoneyPayment.Status.P,
+                             premium=None):
+        payments_of_user[user_of_last_proceed(qmoney_payment)].append(
+            qmoney_payment)
+    for user, qmoney_payments in payments_of_user.items():
+        create_premiums_for(qmoney_payments, user)
+    return proceeded
+
+
+def user_of_last_proceed(qmoney_payment):
+    # the premium is created on behalf of who tried to proceed it, if known
+    user_id = qmoney_payment.outbox.filter(
+        operation=QMoneyPaymentOutbox.Operation.PROCEED).exclude(
+            user_id=None).order_by('-created_at').values_list(
+                'user_id', flat=True).first()
+    if user_id is None:
+        return None
+    return get_user_model().objects.filter(pk=user_id).first()
@@ -1,20 +1,50 @@
+import functools
+import hashlib
+import json
+
 from django.apps import apps
 from django.contrib.auth.models import AnonymousUser
 from django.core.exceptions import ValidationError, PermissionDenied
 from django.utils.translation import gettext as _
 
+import django_filters
 import graphene
 from graphene_django import DjangoObjectType
-from graphene_django.filter import DjangoFilterConnectionField
 from graphql import GraphQLError
-
-from core import ExtendedConnection
+from graphql.language.ast import Field, FragmentSpread
 
 from .apps import QMoneyPaymentConfig
 from .models.qmoney_payment import QMoneyPayment
+from .models.qmoney_payment_idempotency_key import QMoneyPaymentIdempotencyKey
+from .models.qmoney_payment_policy_summary import QMoneyPaymentPolicySummary
 from .models.policy import get_policy_model
-from .models.mutation_log import get_mutation_log_model
-from .services import cancel, proceed, request
+from .mutation_log_sink import mutation_log_sink
+from .pagination import KeysetConnection, KeysetConnectionField
+from .services import (cancel, enqueue_request, idempotency_ttl,
+                       is_request_queue_full, max_batch_size, outbox_lease,
+                       proceed, proceed_payments, request, request_payments,
+                       statistics)
+
+
+class QMoneyPaymentFilter(django_filters.FilterSet):
+    order_by = django_filters.OrderingFilter(fields=(
+        'created_at',
+        'updated_at',
+        'amount',
+        'status',
+        'payer_wallet',
+    ))
+
+    class Meta:
+        model = QMoneyPayment
+        fields = {
+            'status': ['exact', 'in'],
+            'payer_wallet': ['exact'],
+            'amount': ['exact', 'gte', 'lte'],
+            'external_transaction_id': ['exact'],
+            'created_at': ['gte', 'lte'],
+            'updated_at': ['gte', 'lte'],
+        }
 
 
 class QMoneyPaymentGQLType(DjangoObjectType):
@@ -26,8 +56,8 @@ class QMoneyPaymentGQLType(DjangoObjectType):
     class Meta:
         model = QMoneyPayment
         interfaces = (graphene.relay.Node, )
-        filter_fields = []
-        connection_class = ExtendedConnection
+        filterset_class = QMoneyPaymentFilter
+        connection_class = KeysetConnection
 
     def resolve_policy_uuid(parent, _info):
         if parent is None:
@@ -40,6 +70,72 @@ class QMoneyPaymentGQLType(DjangoObjectType):
         return parent.premium_uuid
 
 
+class QMoneyPaymentPolicySummaryGQLType(DjangoObjectType):
+
+    policy_uuid = graphene.UUID()
+
+    class Meta:
+        model = QMoneyPaymentPolicySummary
+        fields = ('open_count', 'proceeded_count', 'proceeded_amount',
+                  'last_status_change_at')
+
+    def resolve_policy_uuid(parent, _info):
+        return parent.policy.uuid
+
+
+class QMoneyPaymentStatisticsGroup(graphene.Enum):
+    STATUS = 'status'
+    POLICY = 'policy'
+    DAY = 'day'
+    HOUR = 'hour'
+
+
+class QMoneyPaymentStatisticsGQLType(graphene.ObjectType):
+    status = graphene.String()
+    policy_uuid = graphene.UUID()
+    period = graphene.DateTime()
+    count = graphene.Int()
+    total_amount = graphene.Int()
+
+    def resolve_policy_uuid(parent, _info):
+        return parent.get('policy__uuid')
+
+
+# The GraphQL fields which are resolved from a related model, and the
+# relation to join to not query it once per payment
+RELATED_MODEL_OF_FIELD = {
+    'policy': 'policy',
+    'policyUuid': 'policy',
+    'premium': 'premium',
+    'premiumUuid': 'premium',
+}
+
+
+def requested_field_names(info):
+    names = set()
+    nodes = list(info.field_asts)
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, FragmentSpread):
+            node = info.fragments[node.name.value]
+        elif isinstance(node, Field):
+            names.add(node.name.value)
+        if node.selection_set is not None:
+            nodes.extend(node.selection_set.selections)
+    return names
+
+
+def select_related_to_requested_fields(queryset, info):
+    related = {
+        RELATED_MODEL_OF_FIELD[name]
+        for name in requested_field_names(info)
+        if name in RELATED_MODEL_OF_FIELD
+    }
+    if not related:
+        return queryset
+    return queryset.select_related(*sorted(related))
+
+
 def raise_if_not_authenticated(user):
     if isinstance(user, AnonymousUser) or not user.id:
         raise ValidationError(_('mutation.authentication_required'))
@@ -55,34 +151,132 @@ def raise_if_is_not_authorized_to(user, gql_action):
         raise PermissionDenied(_('unauthorized')) from error
 
 
+def fingerprint_of(arguments):
+    return hashlib.sha256(
+        json.dumps(arguments, sort_keys=True,
+                   default=str).encode()).hexdigest()
+
+
+class RetryableGraphQLError(GraphQLError):
+    # the mutation can be sent again later with the same idempotency key,
+    # e.g. once the queue isn't full anymore, its outcome isn't replayed
+    pass
+
+
+def idempotent(operation, gql_action=None):
+    # For the mutations taking an `idempotency_key`: sent again with the same
+    # key by the same user, the outcome of the first one is returned without
+    # making it again, e.g. without calling QMoney twice
+    def decorator(mutate):
+
+        @functools.wraps(mutate)
+        def mutate_once(root, info, idempotency_key=None, **arguments):
+            if idempotency_key is None:
+                return mutate(root, info, **arguments)
+            user = info.context.user
+            raise_if_not_authenticated(user)
+            raise_if_is_not_authorized_to(user, gql_action or operation)
+            fingerprint = fingerprint_of(arguments)
+            # a key still pending after a call to QMoney can take has been
+            # abandoned, e.g. by a killed process
+            key, claimed = QMoneyPaymentIdempotencyKey.claim(
+                idempotency_key, operation, str(user.id), fingerprint,
+                idempotency_ttl(), outbox_lease())
+            if not claimed:
+                return replay(key, fingerprint, info.return_type.graphene_type)
+            try:
+                result = mutate(root, info, **arguments)
+            except Exception:
+                # nothing to replay, it can be sent again
+                key.delete()
+                raise
+            if isinstance(result, RetryableGraphQLError):
+                key.delete()
+            elif isinstance(result, GraphQLError):
+                key.record(False, message=result.message)
+            else:
+                key.record(result.ok, result.qmoney_payment)
+            return result
+
+        return mutate_once
+
+    return decorator
+
+
+def replay(key, fingerprint, mutation):
+    if key.fingerprint != fingerprint:
+        return GraphQLError(_('mutation.error.idempotency_key.reused'))
+    if key.is_pending():
+        return GraphQLError(_('mutation.error.idempotency_key.in_progress'))
+    if not key.ok:
+        return GraphQLError(key.message)
+    return mutation(qmoney_payment=key.qmoney_payment, ok=key.ok)
+
+
 class Query(graphene.ObjectType):
     qmoney_payment = graphene.Field(
         QMoneyPaymentGQLType,
         uuid=graphene.UUID(),
     )
 
-    qmoney_payments = DjangoFilterConnectionField(
+    qmoney_payments = KeysetConnectionField(
         QMoneyPaymentGQLType,
         policy_uuid=graphene.UUID(),
     )
 
+    qmoney_payment_policy_summary = graphene.Field(
+        QMoneyPaymentPolicySummaryGQLType,
+        policy_uuid=graphene.UUID(),
+    )
+
+    qmoney_payment_statistics = graphene.List(
+        QMoneyPaymentStatisticsGQLType,
+        group_by=graphene.List(QMoneyPaymentStatisticsGroup),
+        created_at_gte=graphene.DateTime(),
+        created_at_lte=graphene.DateTime(),
+    )
+
     def resolve_qmoney_payment(root, info, uuid):
         user = info.context.user
         raise_if_not_authenticated(user)
         raise_if_is_not_authorized_to(user, 'get')
 
         try:
-            return QMoneyPayment.objects.get(uuid=uuid)
+            return select_related_to_requested_fields(
+                QMoneyPayment.objects, info).get(uuid=uuid)
         except QMoneyPayment.DoesNotExist:
             return None
 
-    def resolve_qmoney_payments(root, info, policy_uuid=None):
+    def resolve_qmoney_payments(root, info, policy_uuid=None, **_kwargs):
         user = info.context.user
         raise_if_not_authenticated(user)
         raise_if_is_not_authorized_to(user, 'list')
+        queryset = select_related_to_requested_fields(
+            QMoneyPayment.objects.all(), info)
         if policy_uuid is not None:
-            return QMoneyPayment.objects.filter(policy__uuid=policy_uuid)
-        return QMoneyPayment.objects.all()
+            return queryset.filter(policy__uuid=policy_uuid)
+        return queryset
+
+    def resolve_qmoney_payment_policy_summary(root, info, policy_uuid):
+        user = info.context.user
+        raise_if_not_authenticated(user)
+        raise_if_is_not_authorized_to(user, 'list')
+
+        try:
+            return QMoneyPaymentPolicySummary.objects.select_related(
+                'policy').get(policy__uuid=policy_uuid)
+        except QMoneyPaymentPolicySummary.DoesNotExist:
+            return None
+
+    def resolve_qmoney_payment_statistics(root,
+                                          info,
+                                          group_by=None,
+                                          created_at_gte=None,
+                                          created_at_lte=None):
+        user = info.context.user
+        raise_if_not_authenticated(user)
+        raise_if_is_not_authorized_to(user, 'list')
+        return statistics(group_by or [], created_at_gte, created_at_lte)
 
 
 class ProceedQMoneyPayment(graphene.Mutation):
@@ -90,16 +284,18 @@ class ProceedQMoneyPayment(graphene.Mutation):
     class Arguments:
         uuid = graphene.UUID()
         otp = graphene.String()
+        idempotency_key = graphene.String()
 
     ok = graphene.Boolean()
     qmoney_payment = graphene.Field(lambda: QMoneyPaymentGQLType)
 
+    @idempotent('proceed')
     def mutate(root, info, uuid, otp):
         user = info.context.user
         raise_if_not_authenticated(user)
         raise_if_is_not_authorized_to(user, 'proceed')
         json_of_parameters = {'uuid': uuid, 'otp': otp}
-        mutation_log = get_mutation_log_model().objects.create(
+        mutation_log = mutation_log_sink().entry(
             json_content=json_of_parameters,
             user_id=user.id,
             client_mutation_label=f'Proceed QMoney Payment ({uuid}, otp: {otp})'
@@ -112,12 +308,20 @@ class ProceedQMoneyPayment(graphene.Mutation):
             return GraphQLError(error_message)
 
         response = proceed(one_qmoney_payment, otp, user)
+        if response is None:
+            # proceeded by someone else meanwhile
+            error_message = _(
+                'models.qmoney_payment.proceed.error.in_progress')
+            mutation_log.mark_as_failed(error_message)
+            return RetryableGraphQLError(error_message)
         if not response['ok']:
             error_message = _(
                 # Translators: This message will replace named-string status and reason
                 'mutation.error.qmoney_payment.proceed_error').format(
                     status=response['status'], reason=response['message'])
             mutation_log.mark_as_failed(error_message)
+            if response.get('retryable'):
+                return RetryableGraphQLError(error_message)
             return GraphQLError(error_message)
         ok = True
         mutation_log.mark_as_successful()
@@ -128,16 +332,18 @@ class CancelQMoneyPayment(graphene.Mutation):
 
     class Arguments:
         uuid = graphene.UUID()
+        idempotency_key = graphene.String()
 
     ok = graphene.Boolean()
     qmoney_payment = graphene.Field(lambda: QMoneyPaymentGQLType)
 
+    @idempotent('cancel', gql_action='proceed')
     def mutate(root, info, uuid):
         user = info.context.user
         raise_if_not_authenticated(user)
         raise_if_is_not_authorized_to(user, 'proceed')
         json_of_parameters = {'uuid': uuid}
-        mutation_log = get_mutation_log_model().objects.create(
+        mutation_log = mutation_log_sink().entry(
             json_content=json_of_parameters,
             user_id=user.id,
             client_mutation_label=f'Cancel QMoney Payment ({uuid})')
@@ -168,11 +374,19 @@ class RequestQMoneyPayment(graphene.Mutation):
         policy_uuid = graphene.UUID()
         amount = graphene.Int()
         payer_wallet = graphene.String()
+        in_background = graphene.Boolean()
+        idempotency_key = graphene.String()
 
     ok = graphene.Boolean()
     qmoney_payment = graphene.Field(lambda: QMoneyPaymentGQLType)
 
-    def mutate(root, info, amount, payer_wallet, policy_uuid):
+    @idempotent('request')
+    def mutate(root,
+               info,
+               amount,
+               payer_wallet,
+               policy_uuid,
+               in_background=False):
         user = info.context.user
         raise_if_not_authenticated(user)
         raise_if_is_not_authorized_to(user, 'request')
@@ -182,7 +396,7 @@ class RequestQMoneyPayment(graphene.Mutation):
             'payer_wallet': payer_wallet,
             'policy_uuid': policy_uuid
         }
-        mutation_log = get_mutation_log_model().objects.create(
+        mutation_log = mutation_log_sink().entry(
             json_content=json_of_parameters,
             user_id=user.id,
             client_mutation_label=
@@ -195,10 +409,18 @@ class RequestQMoneyPayment(graphene.Mutation):
             mutation_log.mark_as_failed(error_message)
             return GraphQLError(error_message)
 
+        if in_background and is_request_queue_full():
+            error_message = _('mutation.error.qmoney_payment.queue_full')
+            mutation_log.mark_as_failed(error_message)
+            return RetryableGraphQLError(error_message)
+
         try:
             one_qmoney_payment = QMoneyPayment.objects.create(
                 policy=policy, amount=amount, payer_wallet=payer_wallet)
-            response = request(one_qmoney_payment)
+            if in_background:
+                response = enqueue_request(one_qmoney_payment)
+            else:
+                response = request(one_qmoney_payment)
         except ValidationError as error:
             error_message = error.message
             mutation_log.mark_as_failed(error_message)
@@ -217,7 +439,156 @@ class RequestQMoneyPayment(graphene.Mutation):
         return RequestQMoneyPayment(qmoney_payment=one_qmoney_payment, ok=ok)
 
 
+class QMoneyPaymentRequestInput(graphene.InputObjectType):
+    policy_uuid = graphene.UUID(required=True)
+    amount = graphene.Int(required=True)
+    payer_wallet = graphene.String(required=True)
+
+
+class QMoneyPaymentRequestResultGQLType(graphene.ObjectType):
+    policy_uuid = graphene.UUID()
+    ok = graphene.Boolean()
+    message = graphene.String()
+    qmoney_payment = graphene.Field(lambda: QMoneyPaymentGQLType)
+
+
+class RequestQMoneyPayments(graphene.Mutation):
+
+    class Arguments:
+        payments = graphene.List(graphene.NonNull(QMoneyPaymentRequestInput),
+                                 required=True)
+
+    ok = graphene.Boolean()
+    results = graphene.List(QMoneyPaymentRequestResultGQLType)
+
+    def mutate(root, info, payments):
+        user = info.context.user
+        raise_if_not_authenticated(user)
+        raise_if_is_not_authorized_to(user, 'request')
+
+        json_of_parameters = {
+            'payments': [{
+                'amount': payment['amount'],
+                'payer_wallet': payment['payer_wallet'],
+                'policy_uuid': payment['policy_uuid']
+            } for payment in payments]
+        }
+        mutation_log = mutation_log_sink().entry(
+            json_content=json_of_parameters,
+            user_id=user.id,
+            client_mutation_label=
+            f'Request QMoney Payments ({len(payments)} payments)')
+        if len(payments) > max_batch_size():
+            error_message = _(
+                # Translators: This message will replace named-string max
+                'mutation.error.qmoney_payment.batch_too_large').format(
+                    max=max_batch_size())
+            mutation_log.mark_as_failed(error_message)
+            return GraphQLError(error_message)
+
+        results = []
+        for payment, response in zip(payments, request_payments(payments)):
+            message = response.get('message')
+            if not response['ok'] and 'status' in response:
+                message = _(
+                    # Translators: This message will replace named-string status and reason
+                    'mutation.error.qmoney_payment.request_error').format(
+                        status=response['status'], reason=message)
+            results.append({
+                'policy_uuid': payment['policy_uuid'],
+                'ok': response['ok'],
+                'message': None if response['ok'] else message,
+                'qmoney_payment': response.get('qmoney_payment')
+            })
+
+        failed = sum(1 for result in results if not result['ok'])
+        if failed:
+            mutation_log.mark_as_failed(
+                _(
+                    # Translators: This message will replace named-string failed and total
+                    'mutation.error.qmoney_payment.batch_partially_failed').
+                format(failed=failed, total=len(results)))
+        else:
+            mutation_log.mark_as_successful()
+        return RequestQMoneyPayments(ok=not failed, results=results)
+
+
+class QMoneyPaymentProceedInput(graphene.InputObjectType):
+    uuid = graphene.UUID(required=True)
+    otp = graphene.String(required=True)
+
+
+class QMoneyPaymentProceedResultGQLType(graphene.ObjectType):
+    uuid = graphene.UUID()
+    ok = graphene.Boolean()
+    message = graphene.String()
+    qmoney_payment = graphene.Field(lambda: QMoneyPaymentGQLType)
+
+
+class ProceedQMoneyPayments(graphene.Mutation):
+
+    class Arguments:
+        payments = graphene.List(graphene.NonNull(QMoneyPaymentProceedInput),
+                                 required=True)
+
+    ok = graphene.Boolean()
+    results = graphene.List(QMoneyPaymentProceedResultGQLType)
+
+    def mutate(root, info, payments):
+        user = info.context.user
+        raise_if_not_authenticated(user)
+        raise_if_is_not_authorized_to(user, 'proceed')
+
+        json_of_parameters = {
+            'payments': [{
+                'uuid': payment['uuid'],
+                'otp': payment['otp']
+            } for payment in payments]
+        }
+        mutation_log = mutation_log_sink().entry(
+            json_content=json_of_parameters,
+            user_id=user.id,
+            client_mutation_label=
+            f'Proceed QMoney Payments ({len(payments)} payments)')
+        if len(payments) > max_batch_size():
+            error_message = _(
+                # Translators: This message will replace named-string max
+                'mutation.error.qmoney_payment.batch_too_large').format(
+                    max=max_batch_size())
+            mutation_log.mark_as_failed(error_message)
+            return GraphQLError(error_message)
+
+        results = []
+        for payment, response in zip(payments,
+                                     proceed_payments(payments, user)):
+            message = response.get('message')
+            if not response['ok'] and 'status' in response:
+                message = _(
+                    # Translators: This message will replace named-string status and reason
+                    'mutation.error.qmoney_payment.proceed_error').format(
+                        status=response['status'], reason=message)
+            results.append({
+                'uuid': payment['uuid'],
+                'ok': response['ok'],
+                'message': None if response['ok'] else message,
+                'qmoney_payment': response.get('qmoney_payment')
+            })
+
+        failed = sum(1 for result in results if not result['ok'])
+        if failed:
+            mutation_log.mark_as_failed(
+                _(
+                    # Translators: This message will replace named-string failed and total
+                    'mutation.error.qmoney_payment.batch_proceed_partially_failed'
+                ).format(failed=failed, total=len(results)))
+        else:
+            mutation_log.mark_as_successful()
+        return ProceedQMoneyPayments(ok=not failed, results=results)
+
+
 class Mutation(graphene.ObjectType):
     request_qmoney_payment = RequestQMoneyPayment.Field()
+    request_qmoney_payments = RequestQMoneyPayments.Field()
     proceed_qmoney_payment = ProceedQMoneyPayment.Field()
+    proceed_qmoney_payments = ProceedQMoneyPayments.Field()
     cancel_qmoney_payment = CancelQMoneyPayment.Field()
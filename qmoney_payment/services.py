@@ -1,17 +1,38 @@
+import collections
 import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor
 
 from django.apps import apps
-from django.db import transaction
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, Exists, F, OuterRef, Q, Sum
+from django.db.models.functions import Coalesce, Trunc
+from django.utils import timezone
 from django.utils.module_loading import import_string
 from django.utils.translation import gettext as _
 
 from qmoney_payment.apps import QMoneyPaymentConfig
+from qmoney_payment.models.qmoney_payment import QMoneyPayment
+from qmoney_payment.models.qmoney_payment_outbox import QMoneyPaymentOutbox
 from qmoney_payment.models.premium import get_premium_model, is_from_premium_app
 from qmoney_payment.models.policy import get_policy_model
+from qmoney_payment.workers import WorkerPool
 
+DEFAULT_WAITING_TTL = 1800
+DEFAULT_EXPIRY_BATCH_SIZE = 1000
+DEFAULT_IDEMPOTENCY_TTL = 86400
+DEFAULT_REQUEST_CONCURRENCY = 8
+DEFAULT_MAX_BATCH_SIZE = 100
+# longer than a call to QMoney can take, retries and login included
+DEFAULT_OUTBOX_LEASE = 300
 
-@transaction.atomic
-def proceed(qmoney_payment, otp, user):
+logger = logging.getLogger(__name__)
+
+
+def proceed_error_of(qmoney_payment):
+    # the outcome of a payment which can't be proceeded (again)
     if qmoney_payment.is_proceeded():
         # maybe "raise an info" to say it's already done
         return {'ok': True, 'status': qmoney_payment.status}
@@ -28,34 +49,322 @@ def proceed(qmoney_payment, otp, user):
             'status': qmoney_payment.status,
             'message': _('models.qmoney_payment.proceed.error.canceled')
         }
+    return None
+
+
+def proceed(qmoney_payment, otp, user):
+    error = proceed_error_of(qmoney_payment)
+    if error is not None:
+        return error
+
+    # The call to QMoney can take up to the read timeout, so no transaction
+    # is kept open during it: the call is recorded and committed first, then
+    # made, then its result is applied. It is recorded already claimed, so
+    # that the workers leave it to this request.
+    try:
+        with transaction.atomic():
+            entry = QMoneyPaymentOutbox.objects.create(
+                qmoney_payment=qmoney_payment,
+                operation=QMoneyPaymentOutbox.Operation.PROCEED,
+                payload={'otp': otp},
+                user_id=None if user.id is None else str(user.id),
+                status=QMoneyPaymentOutbox.Status.PROCESSING,
+                attempts=1,
+                claimed_at=timezone.now())
+    except IntegrityError:
+        return proceed_in_progress(qmoney_payment)
+    return make_proceed_of(entry, qmoney_payment, user)
+
 
+def proceed_in_progress(qmoney_payment):
+    return {
+        'ok': False,
+        'status': qmoney_payment.status,
+        'message': _('models.qmoney_payment.proceed.error.in_progress'),
+        # it may succeed once the ongoing one is finished
+        'retryable': True
+    }
+
+
+def process_outbox_entry(entry, qmoney_payment=None, user=None):
+    # Returns None when the entry is, or has been, processed by someone else
+    claimed = QMoneyPaymentOutbox.objects.filter(
+        pk=entry.pk, status=QMoneyPaymentOutbox.Status.PENDING).update(
+            status=QMoneyPaymentOutbox.Status.PROCESSING,
+            attempts=F('attempts') + 1,
+            claimed_at=timezone.now())
+    if not claimed:
+        return None
+    if qmoney_payment is None:
+        qmoney_payment = entry.qmoney_payment
+    # it may have been changed, e.g. canceled, while the entry was pending
+    qmoney_payment.refresh_from_db()
+    if entry.operation == QMoneyPaymentOutbox.Operation.REQUEST:
+        return make_request_of(entry, qmoney_payment)
+    error = proceed_error_of(qmoney_payment)
+    if error is not None:
+        return finish_outbox_entry(entry, error)
+    if user is None:
+        user = get_user_model().objects.filter(pk=entry.user_id).first()
+    return make_proceed_of(entry, qmoney_payment, user)
+
+
+def make_proceed_of(entry, qmoney_payment, user):
     # TODO manage the case the object has already been created, reuse ?
     merchant = apps.get_app_config(QMoneyPaymentConfig.name).merchant
 
-    ok, reason = merchant.proceed(qmoney_payment.payment_transaction(), otp)
+    try:
+        ok, reason = merchant.proceed(qmoney_payment.payment_transaction(),
+                                      entry.payload.get('otp'))
+    except Exception as error:  # pylint: disable=broad-except
+        # the entry is finished so that the payment can be proceeded again,
+        # or reconciled if the code has been verified nonetheless
+        logger.exception('QMoney payment %s could not be proceeded',
+                         qmoney_payment.uuid)
+        return finish_outbox_entry(entry,
+                                   proceed_failure(qmoney_payment, error))
+    return apply_proceed_result(entry, qmoney_payment, user, ok, reason)
+
+
+@transaction.atomic
+def apply_proceed_result(entry, qmoney_payment, user, ok, reason):
     if ok:
         qmoney_payment.set_status_after_proceed()
         create_premium_for(qmoney_payment, user)
+        result = {'ok': True, 'status': qmoney_payment.status}
     else:
-        return {
-            'ok':
-            False,
-            'status':
-            qmoney_payment.status,
-            'message':
-            # Translators: This message will replace named-string reason
-            _('models.qmoney_payment.proceed.error.failed').format(
-                reason=reason)
-            # Add more details
-        }
-    return {'ok': True, 'status': qmoney_payment.status}
+        # Add more details
+        result = proceed_failure(qmoney_payment, reason)
+    return finish_outbox_entry(entry, result)
 
 
-def request(qmoney_payment):
-    if qmoney_payment.is_waiting_for_confirmation():
-        # Should probably not happen as the object is always created by the
-        # mutation before requesting
-        return {'ok': True, 'status': qmoney_payment.status}
+def proceed_failure(qmoney_payment, reason):
+    return {
+        'ok':
+        False,
+        'status':
+        qmoney_payment.status,
+        'message':
+        # Translators: This message will replace named-string reason
+        _('models.qmoney_payment.proceed.error.failed').format(reason=reason)
+    }
+
+
+def proceed_payments(items, user):
+    # Proceeds the payments of several (uuid, otp) at once: the payments are
+    # loaded in one query, their codes verified by QMoney concurrently, then
+    # the proceeded ones updated together. Returns the outcome of each item,
+    # in the same order.
+    qmoney_payments = {
+        str(payment.uuid): payment
+        for payment in QMoneyPayment.objects.select_related('policy').filter(
+            uuid__in={str(item['uuid']) for item in items})
+    }
+    results = [None] * len(items)
+    to_proceed = {}
+    for index, item in enumerate(items):
+        qmoney_payment = qmoney_payments.get(str(item['uuid']))
+        if qmoney_payment is None:
+            results[index] = {
+                'ok': False,
+                'message': _('mutation.error.qmoney_payment.uuid_not_found')
+            }
+            continue
+        error = proceed_error_of(qmoney_payment)
+        if error is None and qmoney_payment.uuid in to_proceed:
+            error = proceed_in_progress(qmoney_payment)
+        if error is not None:
+            results[index] = dict(error, qmoney_payment=qmoney_payment)
+            continue
+        to_proceed[qmoney_payment.uuid] = (index, qmoney_payment,
+                                           item['otp'])
+
+    for uuid, error in start_proceeding(to_proceed.values(), user).items():
+        index, qmoney_payment, _otp = to_proceed.pop(uuid)
+        results[index] = dict(error, qmoney_payment=qmoney_payment)
+    if not to_proceed:
+        return results
+
+    indexes, payments, otps = zip(*to_proceed.values())
+    # as in proceed(), no transaction is kept open during the calls
+    with ThreadPoolExecutor(
+            max_workers=min(request_concurrency(), len(payments))) as executor:
+        outcomes = list(executor.map(verify_code, payments, otps))
+    for index, result in zip(indexes,
+                             apply_proceed_results(payments, outcomes, user)):
+        results[index] = result
+    return results
+
+
+def start_proceeding(items, user):
+    # Records the calls about to be made, by payment the error of the ones
+    # which are already being proceeded. They are claimed at once, and
+    # failed as abandoned if the process is killed before finishing them.
+    claimed_at = timezone.now()
+    entries = [
+        QMoneyPaymentOutbox(qmoney_payment=qmoney_payment,
+                            operation=QMoneyPaymentOutbox.Operation.PROCEED,
+                            user_id=None if user.id is None else str(user.id),
+                            status=QMoneyPaymentOutbox.Status.PROCESSING,
+                            attempts=1,
+                            claimed_at=claimed_at)
+        for _index, qmoney_payment, _otp in items
+    ]
+    try:
+        with transaction.atomic():
+            QMoneyPaymentOutbox.objects.bulk_create(entries)
+        return {}
+    except IntegrityError:
+        pass
+    errors = {}
+    for entry in entries:
+        try:
+            with transaction.atomic():
+                entry.save()
+        except IntegrityError:
+            errors[entry.qmoney_payment.uuid] = proceed_in_progress(
+                entry.qmoney_payment)
+    return errors
+
+
+def verify_code(qmoney_payment, otp):
+    # Called concurrently, it only calls QMoney and doesn't touch the DB
+    merchant = apps.get_app_config(QMoneyPaymentConfig.name).merchant
+    try:
+        return merchant.proceed(qmoney_payment.payment_transaction(), otp)
+    except Exception as error:  # pylint: disable=broad-except
+        logger.exception('QMoney payment %s could not be proceeded',
+                         qmoney_payment.uuid)
+        return False, str(error)
+
+
+@transaction.atomic
+def apply_proceed_results(qmoney_payments, outcomes, user):
+    paid = [
+        qmoney_payment.uuid
+        for qmoney_payment, (ok, _reason) in zip(qmoney_payments, outcomes)
+        if ok
+    ]
+    # the ones proceeded meanwhile, e.g. by proceed(), already have their
+    # premium: only the ones moved by this batch get one
+    moved = list(
+        QMoneyPayment.objects.select_for_update().filter(
+            uuid__in=paid,
+            status=QMoneyPayment.Status.W).values_list('uuid', flat=True))
+    QMoneyPayment.bulk_set_status(QMoneyPayment.objects.filter(uuid__in=moved),
+                                  QMoneyPayment.Status.P)
+    proceeded = {
+        qmoney_payment.uuid: qmoney_payment
+        for qmoney_payment in QMoneyPayment.objects.select_related(
+            'policy').filter(uuid__in=paid, status=QMoneyPayment.Status.P)
+    }
+    create_premiums_for([proceeded[uuid] for uuid in moved], user)
+
+    results = []
+    for qmoney_payment, (ok, reason) in zip(qmoney_payments, outcomes):
+        if ok and qmoney_payment.uuid in proceeded:
+            qmoney_payment = proceeded[qmoney_payment.uuid]
+            results.append({
+                'ok': True,
+                'status': qmoney_payment.status,
+                'qmoney_payment': qmoney_payment
+            })
+        else:
+            results.append(
+                dict(proceed_failure(qmoney_payment, reason),
+                     qmoney_payment=qmoney_payment))
+    finish_outbox_entries(qmoney_payments, results)
+    return results
+
+
+def finish_outbox_entries(qmoney_payments, results):
+    # the entries being processed of the payments, the ones finished the
+    # same way being updated together
+    groups = collections.defaultdict(list)
+    for qmoney_payment, result in zip(qmoney_payments, results):
+        status = QMoneyPaymentOutbox.Status.DONE if result[
+            'ok'] else QMoneyPaymentOutbox.Status.FAILED
+        groups[(status, result.get('message', ''))].append(qmoney_payment.uuid)
+    now = timezone.now()
+    for (status, message), uuids in groups.items():
+        QMoneyPaymentOutbox.objects.filter(
+            qmoney_payment__in=uuids,
+            operation=QMoneyPaymentOutbox.Operation.PROCEED,
+            status=QMoneyPaymentOutbox.Status.PROCESSING).update(
+                status=status, message=message, payload={}, updated_at=now)
+
+
+def finish_outbox_entry(entry, result):
+    entry.status = QMoneyPaymentOutbox.Status.DONE if result[
+        'ok'] else QMoneyPaymentOutbox.Status.FAILED
+    entry.message = result.get('message', '')
+    # the OTP is not kept once used
+    entry.payload = {}
+    entry.save(update_fields=['status', 'message', 'payload', 'updated_at'])
+    return result
+
+
+def reclaim_abandoned_outbox_entries(lease=None):
+    # The entries still being processed once their lease has expired have
+    # been abandoned, e.g. by a killed process, they are failed so that they
+    # don't block their payment anymore. Whether the code of a payment has
+    # been verified is then left to the reconciliation.
+    if lease is None:
+        lease = outbox_lease()
+    claimed_before = timezone.now() - datetime.timedelta(seconds=lease)
+    with transaction.atomic():
+        abandoned = list(
+            QMoneyPaymentOutbox.objects.select_for_update().filter(
+                status=QMoneyPaymentOutbox.Status.PROCESSING).filter(
+                    Q(claimed_at__lt=claimed_before) |
+                    # claimed before the claims were timed
+                    Q(claimed_at=None, updated_at__lt=claimed_before)).
+            values_list('pk', 'operation', 'qmoney_payment_id'))
+        if not abandoned:
+            return 0
+        QMoneyPaymentOutbox.objects.filter(
+            pk__in=[pk for pk, _operation, _uuid in abandoned]).update(
+                status=QMoneyPaymentOutbox.Status.FAILED,
+                message=_('models.qmoney_payment_outbox.error.abandoned'),
+                payload={},
+                updated_at=timezone.now())
+        # the payments whose request hasn't been made, or not recorded, can't
+        # be proceeded and would block their policy
+        QMoneyPayment.bulk_set_status(
+            QMoneyPayment.objects.filter(
+                uuid__in=[
+                    uuid for _pk, operation, uuid in abandoned
+                    if operation == QMoneyPaymentOutbox.Operation.REQUEST
+                ],
+                status=QMoneyPayment.Status.I), QMoneyPayment.Status.C)
+    return len(abandoned)
+
+
+def process_next_outbox_entry(candidates=10):
+    # Returns None when there isn't any pending entry left to claim
+    entries = QMoneyPaymentOutbox.objects.filter(
+        status=QMoneyPaymentOutbox.Status.PENDING).select_related(
+            'qmoney_payment').order_by('created_at')[:candidates]
+    for entry in entries:
+        result = process_outbox_entry(entry)
+        if result is not None:
+            return result
+    return None
+
+
+def process_pending_outbox_entries(limit=None):
+    entries = QMoneyPaymentOutbox.objects.filter(
+        status=QMoneyPaymentOutbox.Status.PENDING).select_related(
+            'qmoney_payment').order_by('created_at')
+    if limit is not None:
+        entries = entries[:limit]
+    return [
+        result for result in map(process_outbox_entry, entries)
+        if result is not None
+    ]
+
+
+def request_error_of(qmoney_payment):
     if qmoney_payment.is_proceeded():
         # Should probably not happen as the object is always created by the
         # mutation before requesting
@@ -83,14 +392,31 @@ def request(qmoney_payment):
             _('models.qmoney_payment.request.error.policy_not_idle').format(
                 policy_uuid=qmoney_payment.policy_uuid)
         }
+    return None
+
+
+def request(qmoney_payment):
+    if qmoney_payment.is_waiting_for_confirmation():
+        # Should probably not happen as the object is always created by the
+        # mutation before requesting
+        return {'ok': True, 'status': qmoney_payment.status}
+    error = request_error_of(qmoney_payment)
+    if error is not None:
+        return error
 
     # TODO manage the case the object has already been created, reuse ?
+    return apply_request_result(qmoney_payment,
+                                request_to_gateway(qmoney_payment))
+
+
+def request_to_gateway(qmoney_payment):
     config = apps.get_app_config(QMoneyPaymentConfig.name)
+    return config.merchant.request_payment(config.session,
+                                           qmoney_payment.payer_wallet,
+                                           qmoney_payment.amount)
 
-    transaction = config.merchant.request_payment(config.session,
-                                                  qmoney_payment.payer_wallet,
-                                                  qmoney_payment.amount)
 
+def apply_request_result(qmoney_payment, transaction):
     if not qmoney_payment.set_status_after_request(transaction):
         # TODO to manage, buuuuut except network error, it should be always ok due to the API :/
         # maybe with the get transaction state of their API ?
@@ -102,6 +428,186 @@ def request(qmoney_payment):
     return {'ok': True, 'status': qmoney_payment.status}
 
 
+def request_payments(items):
+    # Requests the payments of several policies at once: the policies are
+    # looked up in one query, the payments created in one insert and
+    # requested to QMoney concurrently. Returns the outcome of each item, in
+    # the same order.
+    policy_uuids = {str(item['policy_uuid']).lower() for item in items}
+    policies = {
+        str(policy.uuid).lower(): policy
+        for policy in get_policy_model().objects.filter(
+            uuid__in=policy_uuids)
+    }
+    unproceeded = set(
+        QMoneyPayment.objects.filter(
+            policy__in=policies.values()).exclude(status__in=[
+                QMoneyPayment.Status.P, QMoneyPayment.Status.C
+            ]).values_list('policy_id', flat=True))
+    results = [None] * len(items)
+    to_create = {}
+    for index, item in enumerate(items):
+        policy = policies.get(str(item['policy_uuid']).lower())
+        if policy is None:
+            results[index] = {
+                'ok': False,
+                'message': _('mutation.error.policy.uuid_not_found')
+            }
+        elif policy.id in unproceeded:
+            results[index] = {
+                'ok':
+                False,
+                'message':
+                # Translators: This message will replace named-string max
+                _('models.qmoney_payment.save.error.validation.maximum_transactions_reached'
+                  ).format(
+                      max=QMoneyPayment.MAX_SIMULTANEOUS_UNPROCEEDED_TRANSACTIONS)
+            }
+        else:
+            unproceeded.add(policy.id)
+            to_create[index] = QMoneyPayment(
+                policy=policy,
+                amount=item['amount'],
+                payer_wallet=item['payer_wallet'])
+
+    for index, qmoney_payment in create_payments(to_create).items():
+        if isinstance(qmoney_payment, ValidationError):
+            results[index] = {'ok': False, 'message': qmoney_payment.message}
+        else:
+            to_create[index] = qmoney_payment
+    requested = {
+        index: qmoney_payment
+        for index, qmoney_payment in to_create.items()
+        if results[index] is None
+    }
+    for index, result in zip(requested, request_all(requested.values())):
+        results[index] = dict(result, qmoney_payment=requested[index])
+    return results
+
+
+def create_payments(qmoney_payments):
+    # by index, the payment created or the error preventing it
+    if connection.features.supports_partial_indexes:
+        # else the constraint is only checked by save()
+        try:
+            QMoneyPayment.bulk_create_all(list(qmoney_payments.values()))
+            return qmoney_payments
+        except IntegrityError:
+            # one has been created meanwhile for one of the policies
+            pass
+    created = {}
+    for index, qmoney_payment in qmoney_payments.items():
+        try:
+            qmoney_payment.save()
+            created[index] = qmoney_payment
+        except ValidationError as error:
+            created[index] = error
+    return created
+
+
+def request_all(qmoney_payments):
+    # The calls to QMoney are made by a bounded pool of threads, the
+    # payments saved in the calling one
+    qmoney_payments = list(qmoney_payments)
+    errors = [request_error_of(payment) for payment in qmoney_payments]
+    to_request = [
+        payment for payment, error in zip(qmoney_payments, errors)
+        if error is None
+    ]
+    transactions = {}
+    if to_request:
+        with ThreadPoolExecutor(max_workers=min(
+                request_concurrency(), len(to_request))) as executor:
+            transactions = dict(
+                zip(map(id, to_request),
+                    executor.map(request_to_gateway_or_none, to_request)))
+    results = []
+    for qmoney_payment, error in zip(qmoney_payments, errors):
+        if error is not None:
+            results.append(error)
+            continue
+        transaction = transactions[id(qmoney_payment)]
+        if transaction is None:
+            qmoney_payment.status = QMoneyPayment.Status.F
+            qmoney_payment.save()
+            results.append({
+                'ok': False,
+                'status': qmoney_payment.status,
+                'message': _('models.qmoney_payment.request.error.failed')
+            })
+            continue
+        results.append(apply_request_result(qmoney_payment, transaction))
+    return results
+
+
+def request_to_gateway_or_none(qmoney_payment):
+    try:
+        return request_to_gateway(qmoney_payment)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception('QMoney payment %s could not be requested',
+                         qmoney_payment.uuid)
+        return None
+
+
+def worker_pool():
+    config = apps.get_app_config(QMoneyPaymentConfig.name)
+    if config.worker_pool is None:
+        config.worker_pool = WorkerPool.from_settings(
+            process_next_outbox_entry,
+            config.settings['workers'],
+            reclaim=reclaim_abandoned_outbox_entries)
+    return config.worker_pool
+
+
+def is_request_queue_full():
+    return QMoneyPaymentOutbox.objects.filter(
+        operation=QMoneyPaymentOutbox.Operation.REQUEST,
+        status=QMoneyPaymentOutbox.Status.PENDING).count(
+        ) >= worker_pool().queue_depth
+
+
+def enqueue_request(qmoney_payment):
+    # The payment is returned as it is, initiated, and requested by the
+    # workers, that is its status has to be polled
+    if qmoney_payment.is_waiting_for_confirmation():
+        return {'ok': True, 'status': qmoney_payment.status}
+    error = request_error_of(qmoney_payment)
+    if error is not None:
+        return error
+    QMoneyPaymentOutbox.objects.create(
+        qmoney_payment=qmoney_payment,
+        operation=QMoneyPaymentOutbox.Operation.REQUEST)
+    transaction.on_commit(worker_pool().notify)
+    return {'ok': True, 'status': qmoney_payment.status}
+
+
+def make_request_of(entry, qmoney_payment):
+    if not qmoney_payment.is_initiated():
+        # no longer pending a request, it is left as it is
+        result = {
+            'ok': qmoney_payment.is_waiting_for_confirmation(),
+            'status': qmoney_payment.status
+        }
+        if qmoney_payment.is_canceled() or qmoney_payment.is_proceeded():
+            result = request_error_of(qmoney_payment)
+        return finish_outbox_entry(entry, result)
+    try:
+        result = request(qmoney_payment)
+    except Exception as error:  # pylint: disable=broad-except
+        # nobody is waiting for it to raise, so the payment is failed to
+        # stop its polling
+        qmoney_payment.status = QMoneyPayment.Status.F
+        qmoney_payment.save()
+        result = {
+            'ok': False,
+            'status': qmoney_payment.status,
+            'message': _('models.qmoney_payment.request.error.failed')
+        }
+        logger.exception('QMoney payment %s could not be requested: %s',
+                         qmoney_payment.uuid, error)
+    return finish_outbox_entry(entry, result)
+
+
 @transaction.atomic
 def cancel(qmoney_payment):
     if qmoney_payment.payment_transaction().is_proceeded():
@@ -117,20 +623,76 @@ def cancel(qmoney_payment):
     return {'ok': True, 'status': qmoney_payment.status}
 
 
-@transaction.atomic
-def create_premium_for(qmoney_payment, user):
-    if not qmoney_payment.is_proceeded():
-        return (False, _('service.create_premium_for.error'))
+def expire_waiting_payments(ttl=None, batch_size=DEFAULT_EXPIRY_BATCH_SIZE):
+    # The payments waiting for an OTP for longer than the TTL, i.e. not
+    # updated since their request, are canceled batch by batch, each one in a
+    # single UPDATE, to free their policy. The ones whose OTP is being
+    # verified are left as they are, as they may be paid.
+    if ttl is None:
+        ttl = waiting_ttl()
+    expired_before = timezone.now() - datetime.timedelta(seconds=ttl)
+    being_proceeded = QMoneyPaymentOutbox.objects.filter(
+        qmoney_payment=OuterRef('pk'),
+        operation=QMoneyPaymentOutbox.Operation.PROCEED,
+        status__in=[
+            QMoneyPaymentOutbox.Status.PENDING,
+            QMoneyPaymentOutbox.Status.PROCESSING
+        ])
+    waiting = QMoneyPayment.objects.filter(
+        ~Exists(being_proceeded),
+        status=QMoneyPayment.Status.W,
+        updated_at__lt=expired_before).order_by('updated_at')
+    expired = 0
+    while True:
+        count = QMoneyPayment.bulk_set_status(waiting[:batch_size],
+                                              QMoneyPayment.Status.C)
+        expired += count
+        if count < batch_size:
+            return expired
+
+
+def outbox_lease():
+    return setting('outbox_lease', DEFAULT_OUTBOX_LEASE)
+
 
-    now = datetime.date.today()
-    data = {
+def waiting_ttl():
+    return setting('waiting_ttl', DEFAULT_WAITING_TTL)
+
+
+def idempotency_ttl():
+    return setting('idempotency_ttl', DEFAULT_IDEMPOTENCY_TTL)
+
+
+def request_concurrency():
+    return setting('request_concurrency', DEFAULT_REQUEST_CONCURRENCY, int)
+
+
+def max_batch_size():
+    return setting('max_batch_size', DEFAULT_MAX_BATCH_SIZE, int)
+
+
+def setting(name, default, convert=float):
+    value = apps.get_app_config(QMoneyPaymentConfig.name).settings.get(name)
+    return default if value in (None, '') else convert(value)
+
+
+def premium_data_of(qmoney_payment):
+    return {
         'receipt': qmoney_payment.uuid,
         'amount': qmoney_payment.amount,
         'pay_type': 'M',
-        'pay_date': now,
+        'pay_date': datetime.date.today(),
         'is_offline': False
     }
 
+
+@transaction.atomic
+def create_premium_for(qmoney_payment, user):
+    if not qmoney_payment.is_proceeded():
+        return (False, _('service.create_premium_for.error'))
+
+    data = premium_data_of(qmoney_payment)
+
     if is_from_premium_app():
         update_or_create_premium = import_string(
             'contribution.gql_mutations.update_or_create_premium')
@@ -148,3 +710,108 @@ def create_premium_for(qmoney_payment, user):
     qmoney_payment.premium = premium
     qmoney_payment.save()
     return (True, premium)
+
+
+@transaction.atomic
+def create_premiums_for(qmoney_payments, user):
+    # The counterpart of create_premium_for for the payments proceeded
+    # together: the premiums are inserted at once, their policies activated
+    # by one UPDATE and the payments linked to them by another one. Returns
+    # the premiums, in the order of the proceeded payments given, of the
+    # ones which didn't have one yet.
+    qmoney_payments = [
+        qmoney_payment for qmoney_payment in qmoney_payments
+        if qmoney_payment.is_proceeded()
+    ]
+    if not qmoney_payments:
+        return []
+    # locked, so that a payment given twice, or concurrently, gets only one
+    without_premium = set(
+        QMoneyPayment.objects.select_for_update().filter(
+            uuid__in=[qmoney_payment.uuid for qmoney_payment in qmoney_payments],
+            status=QMoneyPayment.Status.P,
+            premium__isnull=True).values_list('uuid', flat=True))
+    qmoney_payments = list({
+        qmoney_payment.uuid: qmoney_payment
+        for qmoney_payment in qmoney_payments
+        if qmoney_payment.uuid in without_premium
+    }.values())
+    if not qmoney_payments:
+        return []
+
+    if is_from_premium_app():
+        # one by one, the contribution module updating the policies as well
+        update_or_create_premium = import_string(
+            'contribution.gql_mutations.update_or_create_premium')
+        premiums = [
+            update_or_create_premium(
+                dict(premium_data_of(qmoney_payment),
+                     policy_uuid=qmoney_payment.policy.uuid), user)
+            for qmoney_payment in qmoney_payments
+        ]
+    else:
+        premiums = [
+            get_premium_model()(policy=qmoney_payment.policy,
+                                **premium_data_of(qmoney_payment))
+            for qmoney_payment in qmoney_payments
+        ]
+        bulk_create_premiums(premiums)
+        policies = {
+            qmoney_payment.policy.pk: qmoney_payment.policy
+            for qmoney_payment in qmoney_payments
+        }
+        get_policy_model().objects.filter(pk__in=policies.keys()).update(
+            status=get_policy_model().STATUS_ACTIVE)
+        for policy in policies.values():
+            policy.status = get_policy_model().STATUS_ACTIVE
+
+    # the premium isn't part of the policy summary, save() isn't needed
+    now = timezone.now()
+    for qmoney_payment, premium in zip(qmoney_payments, premiums):
+        qmoney_payment.premium = premium
+        qmoney_payment.updated_at = now
+    QMoneyPayment.objects.bulk_update(qmoney_payments,
+                                      ['premium', 'updated_at'])
+    return premiums
+
+
+def bulk_create_premiums(premiums):
+    get_premium_model().objects.bulk_create(premiums)
+    if all(premium.pk is not None for premium in premiums):
+        return
+    # the backend doesn't return the ids of the rows inserted at once
+    ids = dict(
+        get_premium_model().objects.filter(
+            uuid__in=[str(premium.uuid) for premium in premiums]).values_list(
+                'uuid', 'pk'))
+    for premium in premiums:
+        premium.pk = ids[str(premium.uuid)]
+
+
+def statistics(group_by=(), created_at_gte=None, created_at_lte=None):
+    # the number and the total amount of the payments, grouped by any of
+    # status, policy and day or hour of creation, all computed by the database
+    queryset = QMoneyPayment.objects.all()
+    if created_at_gte is not None:
+        queryset = queryset.filter(created_at__gte=created_at_gte)
+    if created_at_lte is not None:
+        queryset = queryset.filter(created_at__lte=created_at_lte)
+
+    keys = []
+    if 'status' in group_by:
+        keys.append('status')
+    if 'policy' in group_by:
+        keys.append('policy__uuid')
+    period = 'hour' if 'hour' in group_by else 'day' if 'day' in group_by else None
+    if period is not None:
+        queryset = queryset.annotate(period=Trunc('created_at', period))
+        keys.append('period')
+
+    aggregates = {
+        'count': Count('uuid'),
+        'total_amount': Coalesce(Sum('amount'), 0),
+    }
+    if not keys:
+        return [queryset.aggregate(**aggregates)]
+    return list(
+        queryset.values(*keys).annotate(**aggregates).order_by(*keys))
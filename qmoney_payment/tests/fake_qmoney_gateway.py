@@ -0,0 +1,437 @@
+import argparse
+import base64
+import itertools
+import json
+import random
+import socket
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A fake QMoney gateway served on localhost. It implements the payload
+# contract of /login, /getMoney and /verifyCode as observed on the QMoney
+# staging instance (see the test_qmoney_api_* tests), and an assumed one of
+# /getTransactionStatus (not observed yet), so that the API client
+# can be exercised and benchmarked without any network access.
+#
+# The latency of each endpoint follows a configurable distribution and a
+# share of the calls can fail, either with a 503 or by dropping the
+# connection before answering. Everything random is drawn from a seeded
+# generator so that a run can be reproduced. The OTP of a transaction is
+# "delivered" through `otp_for` or `GET /otp/<transaction id>` instead of
+# an email. It can also be run on its own, for instance:
+#
+#   python -m qmoney_payment.tests.fake_qmoney_gateway --port 8765 \
+#       --latency getMoney=lognormal:0.2,0.5 --error-rate 0.01
+
+UNAUTHORIZED = {
+    'error': 'unauthorized',
+    'error_description':
+    'Full authentication is required to access this resource'
+}
+
+INVALID_TOKEN = {
+    'error': 'invalid_token',
+    'error_description': 'Cannot convert access token to JSON'
+}
+
+SERVICE_UNAVAILABLE = b'<html><body><h1>503 Service Unavailable</h1></body></html>'
+
+ENDPOINTS = ('login', 'getMoney', 'verifyCode', 'getTransactionStatus')
+
+
+class Latency:
+    # A distribution of delays in seconds, given as `fixed:<seconds>`,
+    # `uniform:<min>,<max>`, `exponential:<mean>` or
+    # `lognormal:<median>,<sigma>`.
+    DISTRIBUTIONS = ('fixed', 'uniform', 'exponential', 'lognormal')
+
+    def __init__(self, distribution='fixed', *parameters):
+        if distribution not in Latency.DISTRIBUTIONS:
+            raise ValueError(f'Unknown latency distribution {distribution}')
+        self.distribution = distribution
+        self.parameters = [float(parameter) for parameter in parameters]
+
+    @classmethod
+    def parse(cls, spec):
+        if isinstance(spec, Latency):
+            return spec
+        if isinstance(spec, (int, float)):
+            return cls('fixed', spec)
+        distribution, _separator, parameters = spec.partition(':')
+        return cls(distribution, *[
+            parameter for parameter in parameters.split(',') if parameter
+        ])
+
+    def sample(self, generator):
+        if self.distribution == 'fixed':
+            return self.parameters[0] if self.parameters else 0
+        if self.distribution == 'uniform':
+            return generator.uniform(*self.parameters)
+        if self.distribution == 'exponential':
+            return generator.expovariate(1 / self.parameters[0])
+        median, sigma = self.parameters
+        return median * generator.lognormvariate(0, sigma)
+
+    def __repr__(self):
+        parameters = ','.join(f'{value:g}' for value in self.parameters)
+        return f'{self.distribution}:{parameters}'
+
+
+def per_endpoint(value, default):
+    # a single value applies to every endpoint
+    if isinstance(value, dict):
+        return {
+            endpoint: value.get(endpoint, default)
+            for endpoint in ENDPOINTS
+        }
+    value = default if value is None else value
+    return {endpoint: value for endpoint in ENDPOINTS}
+
+
+class FakeQMoneyGatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.gateway.count_connection()
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length > 0 else b''
+        try:
+            payload = json.loads(body) if body else {}
+        except ValueError:
+            payload = None
+        status, response = self.server.gateway.handle(
+            self.path, self.headers.get('Authorization', ''), payload)
+        if status is None:
+            # drop the connection without answering
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        if isinstance(response, bytes):
+            self.send_content(status, 'text/html', response)
+        else:
+            self.send_content(status, 'application/json',
+                              json.dumps(response).encode('utf-8'))
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        otp = self.server.gateway.otp_for(self.path.rstrip('/').rsplit(
+            '/', 1)[-1]) if self.path.startswith('/otp/') else None
+        if otp is None:
+            self.send_content(404, 'application/json', b'{}')
+            return
+        self.send_content(200, 'application/json',
+                          json.dumps({
+                              'otp': otp
+                          }).encode('utf-8'))
+
+    def send_content(self, status, content_type, content):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class FakeQMoneyGateway:
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self,
+            username='username',
+            password='password',
+            login_token='token',
+            host='127.0.0.1',
+            port=0,
+            token_ttl=None,
+            latency=None,
+            error_rate=None,
+            drop_rate=None,
+            otp=None,
+            seed=None):
+        self.username = username
+        self.password = password
+        self.login_token = login_token
+        self.token_ttl = token_ttl
+        self.latencies = {
+            endpoint: Latency.parse(spec)
+            for endpoint, spec in per_endpoint(latency, 0).items()
+        }
+        self.error_rates = per_endpoint(error_rate, 0)
+        self.drop_rates = per_endpoint(drop_rate, 0)
+        self.otp = otp
+        self.random = random.Random(seed)
+        self.access_tokens = {}
+        self.transactions = {}
+        # the status of each transaction returned by getTransactionStatus
+        self.statuses = {}
+        self.calls = Counter()
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.otp_sequence = itertools.count(100000)
+        self.server = ThreadingHTTPServer((host, port),
+                                          FakeQMoneyGatewayHandler)
+        self.server.daemon_threads = True
+        self.server.gateway = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def count_connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def revoke_access_tokens(self):
+        with self.lock:
+            self.access_tokens.clear()
+
+    def otp_for(self, transaction_id):
+        return self.transactions.get(transaction_id)
+
+    def next_otp(self):
+        if self.otp is not None:
+            return self.otp
+        return str(next(self.otp_sequence))
+
+    def draw(self, endpoint):
+        # the delay and the failure, if any, of a call to the endpoint
+        with self.lock:
+            delay = self.latencies[endpoint].sample(self.random)
+            outcome = self.random.random()
+        if outcome < self.drop_rates[endpoint]:
+            return delay, 'drop'
+        if outcome < self.drop_rates[endpoint] + self.error_rates[endpoint]:
+            return delay, 'error'
+        return delay, None
+
+    def handle(self, path, authorization, payload):
+        endpoint = path.rstrip('/').rsplit('/', 1)[-1]
+        with self.lock:
+            self.calls[endpoint] += 1
+        handler = getattr(self, f'handle_{endpoint}', None)
+        if handler is None:
+            return 404, {'error': 'Not Found', 'status': 404}
+        delay, failure = self.draw(endpoint)
+        if delay > 0:
+            time.sleep(delay)
+        if failure == 'drop':
+            return None, None
+        if failure == 'error':
+            return 503, SERVICE_UNAVAILABLE
+        if payload is None:
+            return 400, {'error': 'Bad Request', 'status': 400}
+        return handler(authorization, payload)
+
+    def is_authorized_by_basic_token(self, authorization):
+        return authorization == f'Basic {self.login_token}'
+
+    def is_authorized_by_bearer_token(self, authorization):
+        if not authorization.startswith('Bearer '):
+            return None
+        expires_at = self.access_tokens.get(authorization[len('Bearer '):],
+                                            0)
+        return expires_at is None or expires_at > time.time()
+
+    def handle_login(self, authorization, payload):
+        if not self.is_authorized_by_basic_token(authorization):
+            return 401, UNAUTHORIZED
+        for name, key in (('GrantType', 'grantType'),
+                          ('UserName', 'username'), ('Password',
+                                                     'password')):
+            if key not in payload:
+                return 200, {
+                    'responseCode': -150008,
+                    'responseMessage':
+                    f'Mandatory parameter is missing : {name}'
+                }
+        if payload['grantType'] != 'password':
+            return 200, {
+                'responseCode': '-5100006',
+                'responseMessage': 'Invalid Nonce Block Node'
+            }
+        if (payload['username'], payload['password']) != (self.username,
+                                                          self.password):
+            return 200, {
+                'responseCode': '-5100002',
+                'responseMessage': 'Invalid username or password'
+            }
+        access_token = base64.b64encode(uuid.uuid4().bytes).decode('ascii')
+        with self.lock:
+            self.access_tokens[access_token] = None if self.token_ttl is None else time.time(
+            ) + self.token_ttl
+        data = {
+            'access_token': access_token,
+            'twoFactorEnable': 'false',
+            'accessTokenExpiry': '-1'
+        }
+        if self.token_ttl is not None:
+            data['expires_in'] = self.token_ttl
+        return 200, {
+            'responseCode': '1',
+            'responseMessage': 'Success',
+            'data': data
+        }
+
+    def handle_getMoney(self, authorization, _payload):  # pylint: disable=invalid-name
+        authorized = self.is_authorized_by_bearer_token(authorization)
+        if authorized is None:
+            return 401, UNAUTHORIZED
+        if not authorized:
+            return 401, INVALID_TOKEN
+        transaction_id = f'txn_{uuid.uuid4().hex}'
+        with self.lock:
+            self.transactions[transaction_id] = self.next_otp()
+            self.statuses[transaction_id] = 'PENDING'
+        return 200, {
+            'responseCode': '1',
+            'responseMessage': 'OTP Send Successfully',
+            'data': {
+                'transactionId': transaction_id
+            }
+        }
+
+    def handle_verifyCode(self, authorization, payload):  # pylint: disable=invalid-name
+        authorized = self.is_authorized_by_bearer_token(authorization)
+        if authorized is None:
+            return 401, UNAUTHORIZED
+        if not authorized:
+            return 401, INVALID_TOKEN
+        transaction_id = payload.get('transactionId')
+        if transaction_id is None:
+            return 200, {
+                'responseCode': -20002,
+                'responseMessage': 'Mandatory parmater missing : transactionId'
+            }
+        with self.lock:
+            otp = self.transactions.get(transaction_id)
+            if otp is not None and otp == payload.get('otp'):
+                del self.transactions[transaction_id]
+                self.statuses[transaction_id] = 'SUCCESS'
+        if otp is None:
+            return 200, {
+                'responseCode': -150001,
+                'responseMessage':
+                f'Adapter Session Not Found session id : {transaction_id} event : CLIENT_ADAPTER_VERIFYOTP_REQUEST '
+            }
+        if otp != payload.get('otp'):
+            return 200, {
+                'responseCode': '-150005',
+                'responseMessage':
+                f'Two factor OTP validation fail for transactionId : {transaction_id}'
+            }
+        return 200, {
+            'responseCode': '1',
+            'responseMessage': 'Success',
+            'data': {
+                'transactionId': transaction_id
+            }
+        }
+
+    def handle_getTransactionStatus(self, authorization, payload):  # pylint: disable=invalid-name
+        authorized = self.is_authorized_by_bearer_token(authorization)
+        if authorized is None:
+            return 401, UNAUTHORIZED
+        if not authorized:
+            return 401, INVALID_TOKEN
+        transaction_id = payload.get('transactionId')
+        with self.lock:
+            status = self.statuses.get(transaction_id)
+        if status is None:
+            return 200, {
+                'responseCode': -150001,
+                'responseMessage':
+                f'Transaction Not Found transaction id : {transaction_id}'
+            }
+        return 200, {
+            'responseCode': '1',
+            'responseMessage': 'Success',
+            'data': {
+                'transactionId': transaction_id,
+                'status': status
+            }
+        }
+
+
+def parse_per_endpoint(values, convert):
+    # `--option 0.1` applies to every endpoint, `--option getMoney=0.1` only
+    # to one of them
+    if not values:
+        return None
+    parsed = {}
+    for value in values:
+        endpoint, separator, setting = value.partition('=')
+        if not separator:
+            return convert(value)
+        parsed[endpoint] = convert(setting)
+    return parsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve a fake QMoney gateway on localhost')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--username', default='username')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--login-token', default='token')
+    parser.add_argument('--token-ttl', type=float)
+    parser.add_argument('--latency', action='append')
+    parser.add_argument('--error-rate', action='append')
+    parser.add_argument('--drop-rate', action='append')
+    parser.add_argument('--otp')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    gateway = FakeQMoneyGateway(args.username,
+                                args.password,
+                                args.login_token,
+                                args.host,
+                                args.port,
+                                args.token_ttl,
+                                latency=parse_per_endpoint(
+                                    args.latency, Latency.parse),
+                                error_rate=parse_per_endpoint(
+                                    args.error_rate, float),
+                                drop_rate=parse_per_endpoint(
+                                    args.drop_rate, float),
+                                otp=args.otp,
+                                seed=args.seed)
+    print(f'Fake QMoney gateway listening on {gateway.url}', flush=True)
+    try:
+        gateway.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        gateway.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
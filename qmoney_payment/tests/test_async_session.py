@@ -0,0 +1,81 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+from qmoney_payment.api.async_merchant import AsyncMerchant
+from qmoney_payment.api.async_session import AsyncSession
+from qmoney_payment.api.async_transport import AsyncTransport
+from qmoney_payment.api.client import Client as QMoneyClient
+from qmoney_payment.api.payment_transaction import PaymentTransaction
+
+from .fake_qmoney_gateway import FakeQMoneyGateway
+
+
+class TestAsyncSession(IsolatedAsyncioTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls._gateway = FakeQMoneyGateway().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._gateway.stop()
+
+    async def asyncSetUp(self):
+        self._session = QMoneyClient.async_session(self._gateway.url,
+                                                   self._gateway.username,
+                                                   self._gateway.password,
+                                                   self._gateway.login_token)
+
+    async def asyncTearDown(self):
+        await self._session.close()
+
+    async def test_requesting_and_proceeding_a_payment(self):
+        merchant = self._session.merchant('payee', '1234')
+        assert isinstance(merchant, AsyncMerchant)
+
+        payment_transaction = await merchant.request_payment(
+            self._session, 'payer', 1)
+        assert payment_transaction.state(
+        ) == PaymentTransaction.State.WAITING_FOR_CONFIRMATION
+
+        otp = self._gateway.otp_for(payment_transaction.transaction_id)
+        ok, _response = await merchant.proceed(payment_transaction, otp)
+        assert ok
+        assert payment_transaction.is_proceeded()
+
+    async def test_failing_at_proceeding_a_payment_with_a_wrong_otp(self):
+        merchant = self._session.merchant('payee', '1234')
+        payment_transaction = await merchant.request_payment(
+            self._session, 'payer', 1)
+
+        ok, response = await merchant.proceed(payment_transaction, 'wrong')
+        assert not ok
+        assert response.response_code == '-150005'
+        assert 'Two factor OTP validation fail' in response.message
+        assert payment_transaction.is_failed()
+
+    async def test_multiplexing_many_calls_with_a_single_login(self):
+        session = AsyncSession(self._gateway.url, self._gateway.username,
+                               self._gateway.password,
+                               self._gateway.login_token,
+                               AsyncTransport(pool_maxsize=8))
+        logins_before = self._gateway.calls['login']
+
+        responses = await asyncio.gather(*[
+            session.get_money('payer', 'payee', 1, '1234') for _ in range(50)
+        ])
+        await session.close()
+
+        transaction_ids = [response.transaction_id for response in responses]
+        assert None not in transaction_ids
+        assert len(set(transaction_ids)) == 50
+        assert self._gateway.calls['login'] - logins_before == 1
+
+    async def test_retrying_once_after_a_401(self):
+        await self._session.login()
+        self._gateway.revoke_access_tokens()
+        logins_before = self._gateway.calls['login']
+
+        response = await self._session.get_money('payer', 'payee', 1, '1234')
+        assert response.ok
+        assert self._gateway.calls['login'] - logins_before == 1
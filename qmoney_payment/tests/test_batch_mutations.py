@@ -0,0 +1,278 @@
+import uuid
+
+from django.apps import apps
+from django.db import connection
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+
+import graphene
+from graphene.test import Client
+
+from qmoney_payment.api.client import Client as QMoneyClient
+from qmoney_payment.models.qmoney_payment import QMoneyPayment
+from qmoney_payment.models.qmoney_payment_outbox import QMoneyPaymentOutbox
+from qmoney_payment.models.mutation_log import get_mutation_log_model
+from qmoney_payment.models.policy import get_policy_model
+from qmoney_payment.models.premium import get_premium_model
+from qmoney_payment.schema import Query, Mutation
+from qmoney_payment.services import apply_proceed_results, proceed, request_payments
+
+from .helpers import Struct, is_standalone_django_app_tests
+from .fake_mutation_log import FakeMutationLog
+from .fake_policy import FakePolicy
+from .fake_premium import FakePremium
+from .fake_qmoney_gateway import FakeQMoneyGateway
+from .fakemodel_helpers import setup_table_for, teardown_table_for
+
+OTP = '123456'
+
+QUERY = '''
+mutation {
+  requestQmoneyPayments(payments: [%s]) {
+    ok
+    results {
+      policyUuid
+      ok
+      message
+      qmoneyPayment {
+        status
+      }
+    }
+  }
+}
+'''
+
+PROCEED_QUERY = '''
+mutation {
+  proceedQmoneyPayments(payments: [%s]) {
+    ok
+    results {
+      uuid
+      ok
+      message
+      qmoneyPayment {
+        status
+        premiumUuid
+      }
+    }
+  }
+}
+'''
+
+
+def payment_input(policy_uuid, amount=10, payer_wallet='payer'):
+    return '{policyUuid: "%s", amount: %i, payerWallet: "%s"}' % (
+        policy_uuid, amount, payer_wallet)
+
+
+def proceed_input(qmoney_payment_uuid, otp=OTP):
+    return '{uuid: "%s", otp: "%s"}' % (qmoney_payment_uuid, otp)
+
+
+class TestQMoneyPaymentBatchMutations(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        if is_standalone_django_app_tests():
+            setup_table_for(FakeMutationLog)
+            setup_table_for(FakePolicy)
+            setup_table_for(FakePremium)
+        cls._gateway = FakeQMoneyGateway(otp=OTP).start()
+        cls._config = apps.get_app_config('qmoney_payment')
+        cls._previous_session = cls._config.session
+        cls._previous_merchant = cls._config.merchant
+        cls._config.session = QMoneyClient.session(cls._gateway.url,
+                                                   cls._gateway.username,
+                                                   cls._gateway.password,
+                                                   cls._gateway.login_token)
+        cls._config.merchant = cls._config.session.merchant('payee', '1234')
+        cls._gql_client = Client(
+            graphene.Schema(query=Query, mutation=Mutation))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._config.session = cls._previous_session
+        cls._config.merchant = cls._previous_merchant
+        cls._gateway.stop()
+        if is_standalone_django_app_tests():
+            teardown_table_for(FakePremium)
+            teardown_table_for(FakePolicy)
+            teardown_table_for(FakeMutationLog)
+
+    def setUp(self):
+        self._policies = [
+            get_policy_model().objects.create(
+                status=get_policy_model().STATUS_IDLE) for _ in range(3)
+        ]
+        self._request_context = RequestFactory().post('/graphql')
+        self._request_context.user = Struct(id=1,
+                                            id_for_audit='1',
+                                            username='batch',
+                                            is_authenticated=True,
+                                            has_perms=lambda list: True)
+        self._gateway.calls.clear()
+
+    def tearDown(self):
+        get_premium_model().objects.filter(policy__in=self._policies).delete()
+        QMoneyPayment.objects.filter(policy__in=self._policies).delete()
+        for policy in self._policies:
+            policy.delete()
+
+    def execute(self, *payments, query=QUERY):
+        return self._gql_client.execute(query % ', '.join(payments),
+                                        context_value=self._request_context)
+
+    def requested_payments(self):
+        results = request_payments([{
+            'policy_uuid': policy.uuid,
+            'amount': 10,
+            'payer_wallet': 'payer'
+        } for policy in self._policies])
+        assert all(result['ok'] for result in results)
+        return [result['qmoney_payment'] for result in results]
+
+    def test_requesting_the_payments_of_several_policies_at_once(self):
+        with CaptureQueriesContext(connection) as context:
+            actual = self.execute(
+                *[payment_input(policy.uuid) for policy in self._policies])
+
+        assert actual['data']['requestQmoneyPayments'][
+            'ok'], f'should have returned ok, but got {actual}'
+        results = actual['data']['requestQmoneyPayments']['results']
+        assert [result['policyUuid'] for result in results
+                ] == [str(policy.uuid) for policy in self._policies]
+        assert all(result['ok'] for result in results)
+        assert all(
+            result['qmoneyPayment']['status'] == 'WAITING_FOR_CONFIRMATION'
+            for result in results)
+        assert self._gateway.calls['getMoney'] == len(self._policies)
+        assert QMoneyPayment.objects.filter(
+            policy__in=self._policies,
+            status=QMoneyPayment.Status.W).count() == len(self._policies)
+        policy_table = get_policy_model()._meta.db_table
+        # looked up and inserted once for the whole batch
+        assert len([
+            query for query in context.captured_queries
+            if query['sql'].startswith('SELECT') and
+            f'FROM "{policy_table}"' in query['sql']
+        ]) == 1
+        assert len([
+            query for query in context.captured_queries
+            if query['sql'].startswith('INSERT INTO "tblQmoneyPayment" ')
+        ]) == 1
+        assert get_mutation_log_model().objects.all().first(
+        ).status == get_mutation_log_model().SUCCESS
+
+    def test_reporting_the_outcome_of_each_payment(self):
+        QMoneyPayment.objects.create(policy=self._policies[1],
+                                     amount=10,
+                                     payer_wallet='payer')
+        absent_policy_uuid = uuid.uuid4()
+
+        actual = self.execute(payment_input(self._policies[0].uuid),
+                              payment_input(self._policies[1].uuid),
+                              payment_input(absent_policy_uuid),
+                              payment_input(self._policies[0].uuid))
+
+        assert not actual['data']['requestQmoneyPayments']['ok']
+        results = actual['data']['requestQmoneyPayments']['results']
+        assert [result['ok'] for result in results
+                ] == [True, False, False, False]
+        assert results[1]['message'] == results[3]['message']
+        assert results[1]['message'].startswith(
+            'The number of ongoing unproceeded transactions have already reached the maximum allowed 1.'
+        )
+        assert results[2][
+            'message'] == 'The UUID does not correspond to any existing policy.'
+        assert results[2]['qmoneyPayment'] is None
+        assert self._gateway.calls['getMoney'] == 1
+        assert get_mutation_log_model().objects.all().first(
+        ).error == '3 of the 4 payments could not be requested.'
+
+    def test_failing_at_requesting_too_many_payments_at_once(self):
+        previous_max_batch_size = self._config.settings['max_batch_size']
+        self._config.settings['max_batch_size'] = 2
+        try:
+            actual = self.execute(
+                *[payment_input(policy.uuid) for policy in self._policies])
+        finally:
+            self._config.settings[
+                'max_batch_size'] = previous_max_batch_size
+
+        assert actual['data']['requestQmoneyPayments'] is None
+        assert actual['errors'][0][
+            'message'] == 'At most 2 payments can be requested at once.'
+        assert not QMoneyPayment.objects.filter(
+            policy__in=self._policies).exists()
+        assert self._gateway.calls['getMoney'] == 0
+
+    def test_proceeding_several_payments_at_once(self):
+        qmoney_payments = self.requested_payments()
+
+        actual = self.execute(*[
+            proceed_input(qmoney_payment.uuid)
+            for qmoney_payment in qmoney_payments
+        ],
+                              query=PROCEED_QUERY)
+
+        assert actual['data']['proceedQmoneyPayments'][
+            'ok'], f'should have returned ok, but got {actual}'
+        results = actual['data']['proceedQmoneyPayments']['results']
+        assert [result['uuid'] for result in results] == [
+            str(qmoney_payment.uuid) for qmoney_payment in qmoney_payments
+        ]
+        assert all(result['qmoneyPayment']['status'] == 'PROCEEDED' and
+                   result['qmoneyPayment']['premiumUuid'] is not None
+                   for result in results)
+        assert self._gateway.calls['verifyCode'] == len(qmoney_payments)
+        assert all(policy.status == get_policy_model().STATUS_ACTIVE
+                   for policy in get_policy_model().objects.filter(
+                       id__in=[policy.id for policy in self._policies]))
+        entries = QMoneyPaymentOutbox.objects.filter(
+            qmoney_payment__in=qmoney_payments)
+        assert [(entry.status, entry.payload) for entry in entries
+                ] == [('DONE', {})] * len(qmoney_payments)
+        # leased, in case the process had been killed during the calls
+        assert all(entry.claimed_at is not None for entry in entries)
+
+    def test_reporting_the_outcome_of_each_proceeded_payment(self):
+        qmoney_payments = self.requested_payments()
+        QMoneyPayment.objects.filter(uuid=qmoney_payments[2].uuid).update(
+            status=QMoneyPayment.Status.I)
+
+        actual = self.execute(proceed_input(qmoney_payments[0].uuid),
+                              proceed_input(qmoney_payments[1].uuid,
+                                            otp='000000'),
+                              proceed_input(qmoney_payments[2].uuid),
+                              proceed_input(uuid.uuid4()),
+                              query=PROCEED_QUERY)
+
+        assert not actual['data']['proceedQmoneyPayments']['ok']
+        results = actual['data']['proceedQmoneyPayments']['results']
+        assert [result['ok'] for result in results
+                ] == [True, False, False, False]
+        assert results[1]['qmoneyPayment']['status'] == (
+            'WAITING_FOR_CONFIRMATION')
+        assert results[3]['qmoneyPayment'] is None
+        assert self._gateway.calls['verifyCode'] == 2
+        assert list(
+            QMoneyPaymentOutbox.objects.filter(
+                qmoney_payment=qmoney_payments[1]).values_list(
+                    'status', flat=True)) == ['FAILED']
+        assert get_mutation_log_model().objects.all().first(
+        ).error == '3 of the 4 payments could not be proceeded.'
+
+    def test_creating_one_premium_for_a_payment_proceeded_meanwhile(self):
+        qmoney_payments = self.requested_payments()
+        user = self._request_context.user
+        # proceeded by another request once loaded by the batch
+        assert proceed(QMoneyPayment.objects.get(uuid=qmoney_payments[0].uuid),
+                       OTP, user)['ok']
+
+        results = apply_proceed_results(qmoney_payments[:2],
+                                        [(True, None), (True, None)], user)
+
+        assert [result['ok'] for result in results] == [True, True]
+        for qmoney_payment in qmoney_payments[:2]:
+            assert get_premium_model().objects.filter(
+                policy=qmoney_payment.policy).count() == 1
@@ -1,10 +1,12 @@
 import os
+from unittest import mock
 
 from django.apps import apps
 from django.test import TestCase
 
 from .helpers import is_standalone_django_app_tests
 
+from qmoney_payment.models import utils
 from qmoney_payment.models.policy import get_policy_model
 from qmoney_payment.models.premium import get_premium_model
 
@@ -52,3 +54,18 @@ class TestCustomModels(TestCase):
                     ) == 'A custom model for Premium has not been set up. Please provide one in settings.'
                 else:
                     assert False, 'Loading the custom Premium model should succeed as it loads the one from the contributions module in the context of the OpenIMIS app.'
+
+    def test_resolving_a_model_once(self):
+        model = get_policy_model()
+
+        with mock.patch.object(utils.apps, 'get_model') as get_model:
+            assert get_policy_model() is model
+            assert not get_model.called
+
+    def test_forgetting_the_resolved_models_when_the_custom_models_change(
+            self):
+        get_premium_model()
+        assert ('contribution', 'Premium') in utils.resolved_models
+
+        with self.settings(CUSTOM_MODELS={}):
+            assert not utils.resolved_models
@@ -0,0 +1,82 @@
+import random
+import time
+from unittest import TestCase
+
+import requests
+
+from qmoney_payment.api.gateway_response import GatewayResponse
+from qmoney_payment.api.resilience import Resilience, RetryPolicy
+from qmoney_payment.api.session import Session
+
+from .fake_qmoney_gateway import FakeQMoneyGateway, Latency, parse_per_endpoint
+
+
+def new_session(gateway, resilience=None):
+    return Session(gateway.url,
+                   gateway.username,
+                   gateway.password,
+                   gateway.login_token,
+                   resilience=resilience)
+
+
+class TestFakeQMoneyGateway(TestCase):
+
+    def test_parsing_latency_distributions(self):
+        assert Latency.parse(0.1).sample(random.Random()) == 0.1
+        assert repr(Latency.parse('uniform:0.01,0.02')) == 'uniform:0.01,0.02'
+        samples = [
+            Latency.parse('lognormal:0.05,0.5').sample(random.Random(42))
+            for _ in range(2)
+        ]
+        assert samples[0] == samples[1] > 0
+        with self.assertRaises(ValueError):
+            Latency.parse('gaussian:1')
+
+    def test_parsing_per_endpoint_options(self):
+        assert parse_per_endpoint(None, float) is None
+        assert parse_per_endpoint(['0.1'], float) == 0.1
+        assert parse_per_endpoint(['getMoney=0.1', 'login=0'],
+                                  float) == {
+                                      'getMoney': 0.1,
+                                      'login': 0
+                                  }
+
+    def test_delaying_the_responses(self):
+        with FakeQMoneyGateway(latency={'getMoney': 'fixed:0.2'}) as gateway:
+            session = new_session(gateway)
+            session.login()
+            started_at = time.perf_counter()
+            assert session.get_money('payer', 'payee', 1, '1234').ok
+            assert time.perf_counter() - started_at >= 0.2
+
+    def test_failing_a_share_of_the_calls(self):
+        with FakeQMoneyGateway(error_rate={'getMoney': 1},
+                               drop_rate={'verifyCode': 1}) as gateway:
+            session = new_session(
+                gateway, Resilience(RetryPolicy(max_attempts=1)))
+            response = session.get_money('payer', 'payee', 1, '1234')
+            assert response.kind is GatewayResponse.Kind.HTTP_ERROR
+            assert response.status_code == 503
+            response = session.verify_code('txn_unknown', '000000')
+            assert response.kind is GatewayResponse.Kind.TRANSPORT_ERROR
+
+    def test_drawing_the_same_failures_with_the_same_seed(self):
+        outcomes = []
+        for _ in range(2):
+            gateway = FakeQMoneyGateway(error_rate=0.3, seed=7)
+            outcomes.append(
+                [gateway.draw('getMoney')[1] for _ in range(50)])
+            gateway.server.server_close()
+        assert outcomes[0] == outcomes[1]
+        assert 'error' in outcomes[0] and None in outcomes[0]
+
+    def test_delivering_a_fixed_otp(self):
+        with FakeQMoneyGateway(otp='123456') as gateway:
+            session = new_session(gateway)
+            response = session.get_money('payer', 'payee', 1, '1234')
+            delivered = requests.get(
+                f'{gateway.url}/otp/{response.transaction_id}').json()
+            assert delivered == {'otp': '123456'}
+            assert session.verify_code(response.transaction_id, '123456').ok
+            assert requests.get(f'{gateway.url}/otp/{response.transaction_id}'
+                                ).status_code == 404
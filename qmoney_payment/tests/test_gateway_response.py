@@ -0,0 +1,79 @@
+import json
+from unittest import TestCase
+
+from qmoney_payment.api.gateway_response import GatewayResponse
+from qmoney_payment.api.session import Session
+
+from .fake_qmoney_gateway import FakeQMoneyGateway
+
+
+class TestGatewayResponse(TestCase):
+
+    def test_decoding_a_successful_response(self):
+        content = json.dumps({
+            'responseCode': '1',
+            'responseMessage': 'OTP Send Successfully',
+            'data': {
+                'transactionId': 'txn_1'
+            }
+        }).encode('utf-8')
+        response = GatewayResponse.from_http(200, content)
+        assert response.ok
+        assert response.transaction_id == 'txn_1'
+        assert response.message == 'OTP Send Successfully'
+        assert str(response) == content.decode('utf-8')
+
+    def test_decoding_a_rejected_response(self):
+        response = GatewayResponse.from_http(
+            200,
+            b'{"responseCode": -150005, "responseMessage": "Two factor OTP validation fail"}'
+        )
+        assert response.kind is GatewayResponse.Kind.REJECTED
+        assert response.response_code == '-150005'
+        assert response.transaction_id is None
+
+    def test_decoding_an_unauthorized_response(self):
+        response = GatewayResponse.from_http(
+            401,
+            b'{"error": "invalid_token", "error_description": "Cannot convert access token to JSON"}'
+        )
+        assert response.kind is GatewayResponse.Kind.UNAUTHORIZED
+        assert response.message == 'Cannot convert access token to JSON'
+
+    def test_decoding_an_unexpected_body(self):
+        response = GatewayResponse.from_http(200, b'<html>Bad Gateway</html>')
+        assert response.kind is GatewayResponse.Kind.DECODE_ERROR
+        assert response.text == '<html>Bad Gateway</html>'
+        response = GatewayResponse.from_http(502, b'{"error": "Bad Gateway"}')
+        assert response.kind is GatewayResponse.Kind.HTTP_ERROR
+
+    def test_using_slots(self):
+        response = GatewayResponse.from_http(200, b'{"responseCode": "1"}')
+        assert not hasattr(response, '__dict__')
+
+
+class TestSessionGatewayResponse(TestCase):
+
+    def test_reporting_an_unreachable_gateway(self):
+        with FakeQMoneyGateway() as gateway:
+            url = gateway.url
+        session = Session(url, 'username', 'password', 'token')
+        response = session.get_money('payer', 'payee', 1, '1234')
+        assert response.kind is GatewayResponse.Kind.LOGIN_FAILED
+
+    def test_reporting_a_failed_login(self):
+        with FakeQMoneyGateway() as gateway:
+            session = Session(gateway.url, gateway.username, 'wrong',
+                              gateway.login_token)
+            response = session.get_money('payer', 'payee', 1, '1234')
+            assert response.kind is GatewayResponse.Kind.LOGIN_FAILED
+            assert response.message == 'Invalid username or password'
+            assert gateway.calls['getMoney'] == 0
+
+    def test_reporting_a_rejected_call(self):
+        with FakeQMoneyGateway() as gateway:
+            session = Session(gateway.url, gateway.username, gateway.password,
+                              gateway.login_token)
+            response = session.verify_code('txn_unknown', '000000')
+            assert response.kind is GatewayResponse.Kind.REJECTED
+            assert response.response_code == '-150001'
@@ -1,4 +1,6 @@
+import base64
 import collections
+import datetime
 import os
 import time
 import uuid
@@ -9,6 +11,8 @@ from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from django.db import connection
 from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from django.utils.module_loading import import_string
 
 import graphene
@@ -17,10 +21,13 @@ from graphene.test import Client
 from simplegmail import Gmail
 
 from qmoney_payment.models.qmoney_payment import QMoneyPayment
+from qmoney_payment.models.qmoney_payment_idempotency_key import QMoneyPaymentIdempotencyKey
 from qmoney_payment.models.mutation_log import get_mutation_log_model
 from qmoney_payment.models.policy import get_policy_model
 from qmoney_payment.models.premium import get_premium_model
 from qmoney_payment.schema import Query, Mutation
+from qmoney_payment.services import create_premium_for
+from qmoney_payment.workers import WorkerPool
 
 from . import qmoney_helpers
 from .helpers import gmail_wait_and_get_recent_emails_with_qmoney_otp, current_datetime, extract_otp_from_email_messages, gmail_mark_messages_as_read, gmail_mark_as_read_recent_emails_with_qmoney_otp
@@ -97,6 +104,7 @@ class TestQMoneyPaymentGraphQL(TestCase):
             return Struct(username=username,
                           id_for_audit='1',
                           id=1,
+                          is_authenticated=True,
                           has_perms=lambda list: True)
 
         create_test_interactive_user = import_string(
@@ -110,6 +118,7 @@ class TestQMoneyPaymentGraphQL(TestCase):
             return Struct(username=username,
                           id_for_audit='2',
                           id=666,
+                          is_authenticated=True,
                           has_perms=lambda list: False)
 
         create_test_interactive_user = import_string(
@@ -382,6 +391,287 @@ class TestQMoneyPaymentGraphQL(TestCase):
         actual = self.execute_gql_with_context(query)
         assert expected == actual, f'should have been {expected}, but we got {actual}'
 
+    def create_proceeded_qmoney_payment_with_its_premium(self):
+        one_qmoney_payment = QMoneyPayment.objects.create(
+            policy=self._one_policy,
+            amount=self.DEFAULT_POLICY_VALUE,
+            payer_wallet=self._qmoney_payer,
+            status=QMoneyPayment.Status.P)
+        create_premium_for(one_qmoney_payment, self._admin_user)
+        return one_qmoney_payment
+
+    def test_listing_qmoney_payments_with_their_policy_and_premium_in_a_constant_number_of_queries(
+            self):
+        query = '''
+        query {
+          qmoneyPayments(policyUuid: "%s"){
+            edges{
+              node{
+                uuid
+                ...relations
+              }
+            }
+          }
+        }
+        fragment relations on QMoneyPaymentGQLType {
+          policyUuid
+          premiumUuid
+        }
+        ''' % (self._one_policy.uuid, )
+
+        self.create_proceeded_qmoney_payment_with_its_premium()
+        with CaptureQueriesContext(connection) as one_payment_queries:
+            actual = self.execute_gql_with_context(query)
+        assert len(actual['data']['qmoneyPayments']['edges']) == 1
+
+        for _ in range(4):
+            self.create_proceeded_qmoney_payment_with_its_premium()
+        with CaptureQueriesContext(connection) as five_payments_queries:
+            actual = self.execute_gql_with_context(query)
+        edges = actual['data']['qmoneyPayments']['edges']
+        assert len(edges) == 5
+        assert all(edge['node']['premiumUuid'] is not None for edge in edges)
+        assert len(five_payments_queries) == len(one_payment_queries)
+
+        get_premium_model().objects.filter(policy=self._one_policy).delete()
+
+    def list_qmoney_payments_page(self, pagination):
+        query = '''
+        query {
+          qmoneyPayments(policyUuid: "%s", %s){
+            totalCount
+            pageInfo{
+              hasNextPage
+              hasPreviousPage
+              startCursor
+              endCursor
+            }
+            edges{
+              node{
+                uuid
+              }
+            }
+          }
+        }
+        ''' % (self._one_policy.uuid, pagination)
+        return self.execute_gql_with_context(query)['data']['qmoneyPayments']
+
+    def test_paging_through_qmoney_payments_with_keyset_cursors(self):
+        for _ in range(5):
+            QMoneyPayment.objects.create(policy=self._one_policy,
+                                         amount=self.DEFAULT_POLICY_VALUE,
+                                         payer_wallet=self._qmoney_payer,
+                                         status=QMoneyPayment.Status.C)
+        expected = [
+            str(one_uuid) for one_uuid in QMoneyPayment.objects.filter(
+                policy=self._one_policy).order_by(
+                    'created_at', 'uuid').values_list('uuid', flat=True)
+        ]
+
+        pages = [self.list_qmoney_payments_page('first: 2')]
+        while pages[-1]['pageInfo']['hasNextPage']:
+            pages.append(
+                self.list_qmoney_payments_page(
+                    'first: 2, after: "%s"' %
+                    pages[-1]['pageInfo']['endCursor']))
+        actual = [
+            edge['node']['uuid'] for page in pages for edge in page['edges']
+        ]
+        assert actual == expected, f'should have been {expected}, but we got {actual}'
+        assert [len(page['edges']) for page in pages] == [2, 2, 1]
+        assert not pages[0]['pageInfo']['hasPreviousPage']
+        assert pages[-1]['pageInfo']['hasPreviousPage']
+        assert all(page['totalCount'] == 5 for page in pages)
+
+        page = self.list_qmoney_payments_page(
+            'last: 2, before: "%s"' % pages[-1]['pageInfo']['startCursor'])
+        assert [edge['node']['uuid'] for edge in page['edges']] == expected[2:4]
+        assert page['pageInfo']['hasPreviousPage']
+        assert page['pageInfo']['hasNextPage']
+
+        # the offset pagination is still there for the existing clients
+        page = self.list_qmoney_payments_page('first: 2, offset: 2')
+        assert [edge['node']['uuid'] for edge in page['edges']] == expected[2:4]
+
+    def test_filtering_and_sorting_qmoney_payments(self):
+        for amount, status, payer_wallet in [
+            (10, QMoneyPayment.Status.C, 'wallet-1'),
+            (30, QMoneyPayment.Status.P, 'wallet-1'),
+            (20, QMoneyPayment.Status.P, 'wallet-2'),
+            (40, QMoneyPayment.Status.W, 'wallet-1'),
+        ]:
+            QMoneyPayment.objects.create(policy=self._one_policy,
+                                         amount=amount,
+                                         payer_wallet=payer_wallet,
+                                         status=status)
+
+        def amounts(pagination):
+            page = self.list_qmoney_payments_page(pagination)
+            return [
+                QMoneyPayment.objects.get(uuid=edge['node']['uuid']).amount
+                for edge in page['edges']
+            ]
+
+        assert amounts('status_In: [CANCELED, PROCEEDED], orderBy: "amount"'
+                       ) == [10, 20, 30]
+        assert amounts(
+            'payerWallet: "wallet-1", amount_Gte: 20, orderBy: "-amount"') == [
+                40, 30
+            ]
+        assert amounts('externalTransactionId: "none"') == []
+
+        page = self.list_qmoney_payments_page('first: 3, orderBy: "-amount"')
+        assert [edge['node']['uuid'] for edge in page['edges']] == [
+            str(one_uuid) for one_uuid in QMoneyPayment.objects.filter(
+                policy=self._one_policy).order_by('-amount').values_list(
+                    'uuid', flat=True)[:3]
+        ]
+        assert amounts('first: 3, orderBy: "-amount", after: "%s"' %
+                       page['pageInfo']['endCursor']) == [10]
+
+        # a cursor is bound to the ordering of its page
+        query = '''
+        query {
+          qmoneyPayments(first: 3, orderBy: "amount", after: "%s"){
+            edges{
+              node{
+                uuid
+              }
+            }
+          }
+        }
+        ''' % (page['pageInfo']['endCursor'], )
+        assert 'cursor' in self.execute_gql_with_context(
+            query)['errors'][0]['message']
+
+    def test_computing_qmoney_payment_statistics(self):
+        for amount, status, created_at in [
+            (10, QMoneyPayment.Status.C, datetime.datetime(1999, 1, 1, 8)),
+            (30, QMoneyPayment.Status.P, datetime.datetime(1999, 1, 1, 9)),
+            (20, QMoneyPayment.Status.P, datetime.datetime(1999, 1, 2, 9)),
+            (40, QMoneyPayment.Status.P, datetime.datetime(1999, 2, 1, 9)),
+        ]:
+            one_qmoney_payment = QMoneyPayment.objects.create(
+                policy=self._one_policy,
+                amount=amount,
+                payer_wallet=self._qmoney_payer,
+                status=status)
+            QMoneyPayment.objects.filter(uuid=one_qmoney_payment.uuid).update(
+                created_at=created_at)
+        query = '''
+        query {
+          qmoneyPaymentStatistics(groupBy: [STATUS, DAY, POLICY],
+                                  createdAtGte: "1999-01-01T00:00:00",
+                                  createdAtLte: "1999-01-31T00:00:00"){
+            status
+            period
+            policyUuid
+            count
+            totalAmount
+          }
+        }
+        '''
+
+        actual = self.execute_gql_with_context(query)
+        assert 'errors' not in actual, actual
+        policy_uuid = str(self._one_policy.uuid).lower()
+        assert actual['data']['qmoneyPaymentStatistics'] == [{
+            'status': 'CANCELED',
+            'period': '1999-01-01T00:00:00',
+            'policyUuid': policy_uuid,
+            'count': 1,
+            'totalAmount': 10
+        }, {
+            'status': 'PROCEEDED',
+            'period': '1999-01-01T00:00:00',
+            'policyUuid': policy_uuid,
+            'count': 1,
+            'totalAmount': 30
+        }, {
+            'status': 'PROCEEDED',
+            'period': '1999-01-02T00:00:00',
+            'policyUuid': policy_uuid,
+            'count': 1,
+            'totalAmount': 20
+        }]
+
+        query = '''
+        query {
+          qmoneyPaymentStatistics(createdAtGte: "1999-01-01T00:00:00",
+                                  createdAtLte: "1999-12-31T00:00:00"){
+            status
+            count
+            totalAmount
+          }
+        }
+        '''
+        actual = self.execute_gql_with_context(query)
+        assert actual['data']['qmoneyPaymentStatistics'] == [{
+            'status': None,
+            'count': 4,
+            'totalAmount': 100
+        }]
+
+    def test_failing_at_computing_qmoney_payment_statistics_with_unauthorized_user(
+            self):
+        self.switch_to_user(self._guest_user)
+        query = '''
+        query {
+          qmoneyPaymentStatistics(groupBy: [STATUS]){
+            count
+          }
+        }
+        '''
+
+        actual = self.execute_gql_with_context(query)
+        assert actual['data']['qmoneyPaymentStatistics'] is None
+        assert actual['errors'][0]['message'] == 'User not authorized for this operation'
+
+    def test_retrieving_the_qmoney_payment_summary_of_a_policy(self):
+        query = '''
+        query {
+          qmoneyPaymentPolicySummary(policyUuid: "%s"){
+            policyUuid
+            openCount
+            proceededCount
+            proceededAmount
+          }
+        }
+        ''' % (self._one_policy.uuid, )
+        actual = self.execute_gql_with_context(query)
+        assert actual['data']['qmoneyPaymentPolicySummary'] is None
+
+        for status in [QMoneyPayment.Status.P, QMoneyPayment.Status.W]:
+            QMoneyPayment.objects.create(policy=self._one_policy,
+                                         amount=self.DEFAULT_POLICY_VALUE,
+                                         payer_wallet=self._qmoney_payer,
+                                         status=status)
+
+        actual = self.execute_gql_with_context(query)
+        assert actual['data']['qmoneyPaymentPolicySummary'] == {
+            'policyUuid': str(self._one_policy.uuid).lower(),
+            'openCount': 1,
+            'proceededCount': 1,
+            'proceededAmount': self.DEFAULT_POLICY_VALUE
+        }
+
+    def test_failing_at_paging_qmoney_payments_with_an_invalid_cursor(self):
+        query = '''
+        query {
+          qmoneyPayments(first: 2, after: "%s"){
+            edges{
+              node{
+                uuid
+              }
+            }
+          }
+        }
+        ''' % (base64.b64encode(b'keyset:["not a date"]').decode(), )
+
+        actual = self.execute_gql_with_context(query)
+        assert actual['data']['qmoneyPayments'] is None
+        assert 'cursor' in actual['errors'][0]['message']
+
     def test_failing_at_retrieving_one_existing_qmoney_payment_with_unauthorized_user(
             self):
         self.switch_to_user(self._anonymous_user)
@@ -563,6 +853,201 @@ class TestQMoneyPaymentGraphQL(TestCase):
         assert mutation_log.client_mutation_label == expected_client_mutation_label, f'The client mutation label is incorrect,\nwe got: {mutation_log.client_mutation_label}\nrather than {expected_client_mutation_label}'
         assert mutation_log.status == get_mutation_log_model().SUCCESS
 
+    def test_requesting_qmoney_payment_in_the_background(self):
+        amount = 10
+        query = '''
+        mutation {
+          requestQmoneyPayment(policyUuid: "%s", amount: %i, payerWallet: "%s", inBackground: true) {
+            qmoneyPayment {
+              uuid
+              status
+            }
+            ok
+          }
+        }
+        ''' % (
+            self._one_policy.uuid,
+            amount,
+            self._qmoney_payer,
+        )
+
+        actual = self.execute_gql_with_context(query)
+        assert actual['data']['requestQmoneyPayment'][
+            'ok'], f'should have returned ok, but got {actual}'
+        # returned before being requested, by the workers once committed
+        assert actual['data']['requestQmoneyPayment']['qmoneyPayment'][
+            'status'] == 'INITIATED'
+        one_qmoney_payment = QMoneyPayment.objects.get(
+            uuid=actual['data']['requestQmoneyPayment']['qmoneyPayment']
+            ['uuid'])
+        assert list(one_qmoney_payment.outbox.values_list(
+            'operation', 'status')) == [('REQUEST', 'PENDING')]
+        assert get_mutation_log_model().objects.all().first(
+        ).status == get_mutation_log_model().SUCCESS
+
+    def test_failing_at_requesting_qmoney_payment_in_the_background_when_the_queue_is_full(
+            self):
+        config = apps.get_app_config('qmoney_payment')
+        previous_worker_pool = config.worker_pool
+        config.worker_pool = WorkerPool(lambda: None, size=0, queue_depth=0)
+        query = '''
+        mutation {
+          requestQmoneyPayment(policyUuid: "%s", amount: %i, payerWallet: "%s", inBackground: true) {
+            ok
+          }
+        }
+        ''' % (
+            self._one_policy.uuid,
+            10,
+            self._qmoney_payer,
+        )
+
+        try:
+            actual = self.execute_gql_with_context(query)
+        finally:
+            config.worker_pool = previous_worker_pool
+
+        assert actual['data']['requestQmoneyPayment'] is None
+        assert actual['errors'][0][
+            'message'] == 'Too many payments are waiting to be requested. Try again later.'
+        assert not QMoneyPayment.objects.filter(
+            policy=self._one_policy).exists()
+
+    def test_requesting_qmoney_payment_once_with_an_idempotency_key(self):
+        query = '''
+        mutation {
+          requestQmoneyPayment(policyUuid: "%s", amount: 10, payerWallet: "%s", inBackground: true, idempotencyKey: "key-1") {
+            qmoneyPayment {
+              uuid
+            }
+            ok
+          }
+        }
+        ''' % (self._one_policy.uuid, self._qmoney_payer)
+
+        first = self.execute_gql_with_context(query)
+        with CaptureQueriesContext(connection) as context:
+            retried = self.execute_gql_with_context(query)
+
+        assert first['data']['requestQmoneyPayment']['ok']
+        assert retried == first
+        assert QMoneyPayment.objects.filter(
+            policy=self._one_policy).count() == 1
+        assert get_mutation_log_model().objects.count() == 1
+        # neither requested nor queued again
+        assert not any(
+            query['sql'].startswith('INSERT INTO "tblQmoneyPayment" ') or
+            'tblQmoneyPaymentOutbox' in query['sql']
+            for query in context.captured_queries)
+
+    def test_replaying_a_failure_with_an_idempotency_key(self):
+        query = '''
+        mutation {
+          requestQmoneyPayment(policyUuid: "%s", amount: 10, payerWallet: "%s", idempotencyKey: "key-2") {
+            ok
+          }
+        }
+        ''' % (uuid.uuid4(), self._qmoney_payer)
+
+        first = self.execute_gql_with_context(query)
+        retried = self.execute_gql_with_context(query)
+
+        assert first['errors'][0][
+            'message'] == 'The UUID does not correspond to any existing policy.'
+        assert retried['errors'][0]['message'] == first['errors'][0][
+            'message']
+        assert get_mutation_log_model().objects.count() == 1
+
+    def test_sending_again_after_a_retryable_error_with_an_idempotency_key(
+            self):
+        config = apps.get_app_config('qmoney_payment')
+        previous_worker_pool = config.worker_pool
+        config.worker_pool = WorkerPool(lambda: None, size=0, queue_depth=0)
+        query = '''
+        mutation {
+          requestQmoneyPayment(policyUuid: "%s", amount: 10, payerWallet: "%s", inBackground: true, idempotencyKey: "key-6") {
+            ok
+          }
+        }
+        ''' % (self._one_policy.uuid, self._qmoney_payer)
+
+        try:
+            first = self.execute_gql_with_context(query)
+            config.worker_pool = WorkerPool(lambda: None, size=0)
+            retried = self.execute_gql_with_context(query)
+        finally:
+            config.worker_pool = previous_worker_pool
+
+        assert first['errors'][0][
+            'message'] == 'Too many payments are waiting to be requested. Try again later.'
+        # not replayed once the queue isn't full anymore
+        assert retried['data']['requestQmoneyPayment']['ok']
+        assert QMoneyPayment.objects.filter(
+            policy=self._one_policy).count() == 1
+
+    def test_claiming_again_an_abandoned_idempotency_key(self):
+        key, claimed = QMoneyPaymentIdempotencyKey.claim(
+            'key-7', 'cancel', '1', 'fingerprint', 60, 30)
+        assert claimed
+
+        # still being made
+        key, claimed = QMoneyPaymentIdempotencyKey.claim(
+            'key-7', 'cancel', '1', 'fingerprint', 60, 30)
+        assert not claimed and key.is_pending()
+
+        # left pending by a killed process
+        QMoneyPaymentIdempotencyKey.objects.filter(pk=key.pk).update(
+            created_at=timezone.now() - datetime.timedelta(seconds=31))
+        key, claimed = QMoneyPaymentIdempotencyKey.claim(
+            'key-7', 'cancel', '1', 'fingerprint', 60, 30)
+        assert claimed
+        assert QMoneyPaymentIdempotencyKey.objects.filter(
+            key='key-7').count() == 1
+
+        # a recorded outcome is kept until it expires
+        key.record(True)
+        QMoneyPaymentIdempotencyKey.objects.filter(pk=key.pk).update(
+            created_at=timezone.now() - datetime.timedelta(seconds=31))
+        key, claimed = QMoneyPaymentIdempotencyKey.claim(
+            'key-7', 'cancel', '1', 'fingerprint', 60, 30)
+        assert not claimed and key.ok
+
+    def test_failing_at_reusing_an_idempotency_key_with_other_arguments(
+            self):
+        one_qmoney_payment = QMoneyPayment.objects.create(
+            policy=self._one_policy, amount=10, payer_wallet=self._qmoney_payer)
+        query = '''
+        mutation {
+          cancelQmoneyPayment(uuid: "%s", idempotencyKey: "key-3") {
+            ok
+          }
+        }
+        '''
+
+        first = self.execute_gql_with_context(query % one_qmoney_payment.uuid)
+        reused = self.execute_gql_with_context(query % uuid.uuid4())
+
+        assert first['data']['cancelQmoneyPayment']['ok']
+        assert reused['errors'][0][
+            'message'] == 'The idempotency key has already been used with other arguments.'
+
+    def test_purging_the_expired_idempotency_keys(self):
+        key, claimed = QMoneyPaymentIdempotencyKey.claim(
+            'key-4', 'cancel', '1', 'fingerprint', -1)
+        assert claimed and key.is_expired()
+
+        # an expired key can be claimed again
+        key, claimed = QMoneyPaymentIdempotencyKey.claim(
+            'key-4', 'cancel', '1', 'fingerprint', 60)
+        assert claimed and not key.is_expired()
+        QMoneyPaymentIdempotencyKey.claim('key-5', 'cancel', '1',
+                                          'fingerprint', -1)
+
+        assert QMoneyPaymentIdempotencyKey.purge_expired() == 1
+        assert list(
+            QMoneyPaymentIdempotencyKey.objects.values_list(
+                'key', flat=True)) == ['key-4']
+
     def test_canceling_an_existing_qmoney_payment(self):
         amount = 10
         one_qmoney_payment = QMoneyPayment.objects.create(
@@ -1,7 +1,14 @@
+import io
+from unittest import mock
+
+from django.core.management import call_command
 from django.core.validators import ValidationError
+from django.db import connection, transaction
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
 from qmoney_payment.models.qmoney_payment import QMoneyPayment
+from qmoney_payment.models.qmoney_payment_policy_summary import QMoneyPaymentPolicySummary
 from qmoney_payment.models.policy import get_policy_model
 
 from .helpers import is_standalone_django_app_tests
@@ -78,3 +85,105 @@ class TestQMoneyPaymentModel(TestCase):
             assert False, f'It should not be possible to create a new Qmoney Payment as there is already one unproceeded or uncancelled'
         except ValidationError as error:
             assert error.message == 'The number of ongoing unproceeded transactions have already reached the maximum allowed 1. Please proceed or cancel existing ones before requesting new payment.'
+
+    def test_failing_at_creating_a_second_unproceeded_qmoney_payment_within_a_transaction(
+            self):
+        qmoney_payer = 'abcdef'
+        with transaction.atomic():
+            QMoneyPayment.objects.create(policy=self._one_policy,
+                                         amount=10,
+                                         payer_wallet=qmoney_payer)
+            with self.assertRaises(ValidationError):
+                QMoneyPayment.objects.create(policy=self._one_policy,
+                                             amount=10,
+                                             payer_wallet=qmoney_payer)
+            # the transaction can still be used
+            assert QMoneyPayment.objects.filter(
+                policy=self._one_policy).count() == 1
+
+    def test_updating_the_status_without_counting_the_unproceeded_qmoney_payments(
+            self):
+        one_qmoney_payment = QMoneyPayment.objects.create(
+            policy=self._one_policy, amount=10, payer_wallet='abcdef')
+
+        with CaptureQueriesContext(connection) as queries:
+            one_qmoney_payment.set_status_after_proceed()
+        # the update of the payment and of the summary of its policy
+        assert [query['sql'].split()[0] for query in queries] == [
+            'UPDATE', 'UPDATE'
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            QMoneyPayment.objects.create(policy=self._one_policy,
+                                         amount=10,
+                                         payer_wallet='abcdef')
+        # the insert and the summary update, in a savepoint as the test runs
+        # in a transaction
+        assert [
+            query['sql'].split()[0]
+            for query in queries if 'SAVEPOINT' not in query['sql']
+        ] == ['INSERT', 'UPDATE']
+
+    def summary_of_one_policy(self):
+        summary = QMoneyPaymentPolicySummary.objects.get(
+            policy=self._one_policy)
+        return (summary.open_count, summary.proceeded_count,
+                summary.proceeded_amount)
+
+    def test_keeping_the_summary_of_the_policy_up_to_date(self):
+        one_qmoney_payment = QMoneyPayment.objects.create(
+            policy=self._one_policy, amount=10, payer_wallet='abcdef')
+        assert self.summary_of_one_policy() == (1, 0, 0)
+
+        one_qmoney_payment.set_status_after_proceed()
+        assert self.summary_of_one_policy() == (0, 1, 10)
+        summary = QMoneyPaymentPolicySummary.objects.get(
+            policy=self._one_policy)
+        assert summary.last_status_change_at == one_qmoney_payment.updated_at
+
+        another_qmoney_payment = QMoneyPayment.objects.create(
+            policy=self._one_policy, amount=20, payer_wallet='abcdef')
+        with CaptureQueriesContext(connection) as queries:
+            QMoneyPayment.objects.get(uuid=another_qmoney_payment.uuid).save()
+        # not a status change
+        assert not any('tblQmoneyPaymentPolicySummary' in query['sql']
+                       for query in queries)
+        assert self.summary_of_one_policy() == (1, 1, 10)
+
+        another_qmoney_payment.set_status_after_cancel()
+        assert self.summary_of_one_policy() == (0, 1, 10)
+
+        QMoneyPayment.objects.get(uuid=one_qmoney_payment.uuid).delete()
+        assert self.summary_of_one_policy() == (0, 0, 0)
+
+    def test_rebuilding_the_summaries_of_the_policies(self):
+        for status in [QMoneyPayment.Status.P, QMoneyPayment.Status.P, None]:
+            QMoneyPayment.objects.create(policy=self._one_policy,
+                                         amount=10,
+                                         payer_wallet='abcdef',
+                                         **({
+                                             'status': status
+                                         } if status else {}))
+        QMoneyPaymentPolicySummary.objects.filter(
+            policy=self._one_policy).update(open_count=5, proceeded_count=0)
+
+        output = io.StringIO()
+        call_command('rebuild_qmoney_payment_summaries',
+                     batch_size=1,
+                     stdout=output)
+        assert self.summary_of_one_policy() == (1, 2, 20)
+        assert 'policy summaries rebuilt' in output.getvalue()
+
+    def test_checking_the_unproceeded_qmoney_payments_with_the_summary_without_partial_indexes(
+            self):
+        QMoneyPayment.objects.create(policy=self._one_policy,
+                                     amount=10,
+                                     payer_wallet='abcdef')
+        with mock.patch.object(connection.features,
+                               'supports_partial_indexes', False):
+            with CaptureQueriesContext(connection) as queries:
+                with self.assertRaises(ValidationError):
+                    QMoneyPayment.objects.create(policy=self._one_policy,
+                                                 amount=10,
+                                                 payer_wallet='abcdef')
+            assert len(queries) == 1
+            assert 'tblQmoneyPaymentPolicySummary' in queries[0]['sql']
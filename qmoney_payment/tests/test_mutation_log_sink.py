@@ -0,0 +1,188 @@
+import json
+import os
+import tempfile
+from unittest import mock
+
+from django.db import DatabaseError, connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from qmoney_payment.models.mutation_log import get_mutation_log_model
+from qmoney_payment import mutation_log_sink
+from qmoney_payment.mutation_log_sink import CLAIM_INFIX, MutationLogSink
+
+from .helpers import is_standalone_django_app_tests
+from .fake_mutation_log import FakeMutationLog
+from .fakemodel_helpers import setup_table_for, teardown_table_for
+
+# above the maximum PID, so never the one of a running process
+DEAD_PID = 99999999
+
+
+class TestMutationLogSink(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        if is_standalone_django_app_tests():
+            setup_table_for(FakeMutationLog)
+
+    @classmethod
+    def tearDownClass(cls):
+        if is_standalone_django_app_tests():
+            teardown_table_for(FakeMutationLog)
+
+    def setUp(self):
+        self._spool_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._spool_dir.cleanup()
+
+    def labels(self):
+        return list(get_mutation_log_model().objects.order_by(
+            'client_mutation_label').values_list('client_mutation_label',
+                                                 flat=True))
+
+    def test_writing_each_log_at_once_in_its_final_status(self):
+        sink = MutationLogSink(spool_dir=self._spool_dir.name)
+        entry = sink.entry({'uuid': 'a'}, 1, 'Cancel')
+
+        with CaptureQueriesContext(connection) as context:
+            entry.mark_as_failed('refused')
+
+        assert len(context.captured_queries) == 1
+        mutation_log = get_mutation_log_model().objects.get()
+        assert mutation_log.status == get_mutation_log_model().ERROR
+        assert mutation_log.error == 'refused'
+        assert mutation_log.json_content == "{'uuid': 'a'}"
+        assert os.listdir(self._spool_dir.name) == []
+
+    def test_writing_a_log_once_whatever_its_marks(self):
+        sink = MutationLogSink(spool_dir=self._spool_dir.name)
+        entry = sink.entry({}, 1, 'Cancel')
+
+        entry.mark_as_failed('refused')
+        entry.mark_as_failed('refused again')
+        entry.mark_as_successful()
+
+        mutation_log = get_mutation_log_model().objects.get()
+        assert mutation_log.error == 'refused'
+
+    def test_writing_the_logs_by_batches(self):
+        sink = MutationLogSink(batch_size=3,
+                               flush_interval=60,
+                               spool_dir=self._spool_dir.name)
+        try:
+            sink.entry({}, 1, 'A').mark_as_successful()
+            sink.entry({}, 1, 'B').mark_as_successful()
+
+            assert self.labels() == []
+            with open(sink.spool_path(os.getpid()), encoding='utf-8') as spool:
+                assert len(spool.readlines()) == 2
+
+            with CaptureQueriesContext(connection) as context:
+                sink.entry({}, 1, 'C').mark_as_successful()
+
+            assert len(context.captured_queries) == 1
+            assert self.labels() == ['A', 'B', 'C']
+            assert os.path.getsize(sink.spool_path(os.getpid())) == 0
+
+            sink.entry({}, 1, 'D').mark_as_successful()
+        finally:
+            sink.close()
+
+        # written when closed
+        assert self.labels() == ['A', 'B', 'C', 'D']
+        assert os.listdir(self._spool_dir.name) == []
+
+    def test_keeping_the_logs_not_written_whatever_the_error(self):
+        sink = MutationLogSink(batch_size=3,
+                               flush_interval=60,
+                               spool_dir=self._spool_dir.name)
+        try:
+            sink.entry({}, 1, 'A').mark_as_successful()
+            with mock.patch.object(mutation_log_sink,
+                                   'write',
+                                   side_effect=RuntimeError):
+                with self.assertRaises(RuntimeError):
+                    sink.flush()
+
+            assert self.labels() == []
+            assert sink.flush() == 1
+            assert self.labels() == ['A']
+        finally:
+            sink.close()
+
+    def test_recovering_the_spools_out_of_the_lock(self):
+        sink = MutationLogSink(batch_size=3,
+                               flush_interval=60,
+                               spool_dir=self._spool_dir.name)
+        is_locked = []
+        try:
+            with mock.patch.object(
+                    MutationLogSink,
+                    'recover',
+                    side_effect=lambda: is_locked.append(sink.lock.locked())):
+                sink.entry({}, 1, 'A').mark_as_successful()
+        finally:
+            sink.close()
+
+        assert is_locked == [False]
+
+    def write_spool(self, path, *labels):
+        with open(path, 'w', encoding='utf-8') as spool:
+            for label in labels:
+                spool.write(
+                    json.dumps({
+                        'json_content': '{}',
+                        'user_id': 1,
+                        'client_mutation_label': label,
+                        'status': get_mutation_log_model().SUCCESS
+                    }) + '\n')
+
+    def test_recovering_the_logs_of_a_stopped_process(self):
+        sink = MutationLogSink(batch_size=10, spool_dir=self._spool_dir.name)
+        self.write_spool(sink.spool_path(DEAD_PID), 'A', 'B')
+
+        assert sink.recover() == 2
+        assert self.labels() == ['A', 'B']
+        assert os.listdir(self._spool_dir.name) == []
+
+    def test_recovering_a_spool_once_while_others_recover_it(self):
+        sink = MutationLogSink(batch_size=10, spool_dir=self._spool_dir.name)
+        self.write_spool(sink.spool_path(DEAD_PID), 'A')
+        # being recovered by a running process
+        self.write_spool(
+            sink.spool_path(f'{DEAD_PID + 1}{CLAIM_INFIX}{os.getpid()}'), 'B')
+        # left by a process which died while recovering it
+        self.write_spool(
+            sink.spool_path(f'{DEAD_PID + 2}{CLAIM_INFIX}{DEAD_PID}'), 'C')
+        paths = mutation_log_sink.glob.glob(sink.spool_path('*'))
+
+        with mock.patch.object(mutation_log_sink.glob,
+                               'glob',
+                               return_value=[sink.spool_path(DEAD_PID + 3)] +
+                               paths):
+            # the first one claimed meanwhile by another process
+            assert sink.recover() == 2
+
+        assert self.labels() == ['A', 'C']
+        assert os.listdir(self._spool_dir.name) == [
+            os.path.basename(
+                sink.spool_path(f'{DEAD_PID + 1}{CLAIM_INFIX}{os.getpid()}'))
+        ]
+
+    def test_releasing_a_spool_not_recovered(self):
+        sink = MutationLogSink(batch_size=10, spool_dir=self._spool_dir.name)
+        self.write_spool(sink.spool_path(DEAD_PID), 'A')
+
+        with mock.patch.object(mutation_log_sink,
+                               'write',
+                               side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                sink.recover()
+
+        assert os.listdir(self._spool_dir.name) == [
+            os.path.basename(sink.spool_path(DEAD_PID))
+        ]
+        assert sink.recover() == 1
+        assert self.labels() == ['A']
@@ -0,0 +1,317 @@
+import datetime
+import io
+import threading
+
+from django.apps import apps
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.utils import timezone
+
+from qmoney_payment.api.client import Client as QMoneyClient
+from qmoney_payment.models.qmoney_payment import QMoneyPayment
+from qmoney_payment.models.qmoney_payment_outbox import QMoneyPaymentOutbox
+from qmoney_payment.models.policy import get_policy_model
+from qmoney_payment.models.premium import get_premium_model
+from qmoney_payment.services import enqueue_request, proceed, process_next_outbox_entry, process_outbox_entry, process_pending_outbox_entries, reclaim_abandoned_outbox_entries, request
+
+from qmoney_payment.workers import WorkerPool
+
+from .helpers import Struct, is_standalone_django_app_tests
+from .fake_policy import FakePolicy
+from .fake_premium import FakePremium
+from .fake_qmoney_gateway import FakeQMoneyGateway
+from .fakemodel_helpers import setup_table_for, teardown_table_for
+
+OTP = '123456'
+
+
+class TestQMoneyPaymentOutbox(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        if is_standalone_django_app_tests():
+            setup_table_for(FakePolicy)
+            setup_table_for(FakePremium)
+        cls._gateway = FakeQMoneyGateway(otp=OTP).start()
+        cls._config = apps.get_app_config('qmoney_payment')
+        cls._previous_session = cls._config.session
+        cls._previous_merchant = cls._config.merchant
+        cls._config.session = QMoneyClient.session(cls._gateway.url,
+                                                   cls._gateway.username,
+                                                   cls._gateway.password,
+                                                   cls._gateway.login_token)
+        cls._config.merchant = cls._config.session.merchant('payee', '1234')
+        cls._user = Struct(id=1, id_for_audit='1', username='outbox')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._config.session = cls._previous_session
+        cls._config.merchant = cls._previous_merchant
+        cls._gateway.stop()
+        if is_standalone_django_app_tests():
+            teardown_table_for(FakePremium)
+            teardown_table_for(FakePolicy)
+
+    def setUp(self):
+        self._one_policy = get_policy_model().objects.create(
+            status=get_policy_model().STATUS_IDLE)
+        self._one_qmoney_payment = QMoneyPayment.objects.create(
+            policy=self._one_policy, amount=10, payer_wallet='payer')
+        assert request(self._one_qmoney_payment)['ok']
+
+    def tearDown(self):
+        get_premium_model().objects.filter(policy=self._one_policy).delete()
+        self._one_policy.delete()
+
+    def test_proceeding_without_a_transaction_open_during_the_gateway_call(
+            self):
+        merchant = self._config.merchant
+        savepoints_during_the_call = []
+
+        def proceed_and_record(payment_transaction, otp):
+            savepoints_during_the_call.append(
+                len(connection.savepoint_ids))
+            return type(merchant).proceed(merchant, payment_transaction, otp)
+
+        merchant.proceed = proceed_and_record
+        try:
+            savepoints = len(connection.savepoint_ids)
+            result = proceed(self._one_qmoney_payment, OTP, self._user)
+        finally:
+            del merchant.proceed
+
+        assert result == {'ok': True, 'status': QMoneyPayment.Status.P}
+        # only the ones of the test case
+        assert savepoints_during_the_call == [savepoints]
+        entry = QMoneyPaymentOutbox.objects.get(
+            qmoney_payment=self._one_qmoney_payment)
+        assert entry.status == QMoneyPaymentOutbox.Status.DONE
+        assert entry.attempts == 1
+        assert entry.payload == {}
+        assert self._one_qmoney_payment.premium is not None
+
+    def test_recording_a_refused_proceed(self):
+        result = proceed(self._one_qmoney_payment, 'wrong', self._user)
+
+        assert not result['ok']
+        assert result['status'] == QMoneyPayment.Status.W
+        entry = QMoneyPaymentOutbox.objects.get(
+            qmoney_payment=self._one_qmoney_payment)
+        assert entry.status == QMoneyPaymentOutbox.Status.FAILED
+        assert entry.message == result['message']
+
+    def test_failing_at_proceeding_a_qmoney_payment_being_proceeded(self):
+        QMoneyPaymentOutbox.objects.create(
+            qmoney_payment=self._one_qmoney_payment,
+            operation=QMoneyPaymentOutbox.Operation.PROCEED,
+            payload={'otp': OTP})
+
+        verify_code_calls = self._gateway.calls['verifyCode']
+        result = proceed(self._one_qmoney_payment, OTP, self._user)
+
+        assert result == {
+            'ok': False,
+            'status': QMoneyPayment.Status.W,
+            'message': 'The payment is already being proceeded.',
+            'retryable': True
+        }
+        assert self._gateway.calls['verifyCode'] == verify_code_calls
+
+    def test_proceeding_again_after_a_failing_gateway_call(self):
+        merchant = self._config.merchant
+
+        def fail(_payment_transaction, _otp):
+            raise ConnectionError('connection reset')
+
+        merchant.proceed = fail
+        try:
+            result = proceed(self._one_qmoney_payment, OTP, self._user)
+        finally:
+            del merchant.proceed
+
+        assert not result['ok']
+        assert 'connection reset' in result['message']
+        assert list(
+            QMoneyPaymentOutbox.objects.filter(
+                qmoney_payment=self._one_qmoney_payment).values_list(
+                    'status', flat=True)) == ['FAILED']
+        assert proceed(self._one_qmoney_payment, OTP, self._user)['ok']
+
+    def test_leaving_the_call_of_a_proceed_to_its_request(self):
+        merchant = self._config.merchant
+        worker_results = []
+
+        def work_then_proceed(payment_transaction, otp):
+            # a worker looking for calls to make meanwhile
+            worker_results.append(process_next_outbox_entry())
+            return type(merchant).proceed(merchant, payment_transaction, otp)
+
+        merchant.proceed = work_then_proceed
+        try:
+            result = proceed(self._one_qmoney_payment, OTP, self._user)
+        finally:
+            del merchant.proceed
+
+        assert worker_results == [None]
+        assert result == {'ok': True, 'status': QMoneyPayment.Status.P}
+
+    def test_failing_the_abandoned_calls(self):
+        abandoned = QMoneyPaymentOutbox.objects.create(
+            qmoney_payment=self._one_qmoney_payment,
+            operation=QMoneyPaymentOutbox.Operation.PROCEED,
+            status=QMoneyPaymentOutbox.Status.PROCESSING,
+            payload={'otp': OTP},
+            claimed_at=timezone.now() - datetime.timedelta(hours=1))
+
+        assert reclaim_abandoned_outbox_entries(lease=7200) == 0
+        assert reclaim_abandoned_outbox_entries(lease=60) == 1
+
+        abandoned.refresh_from_db()
+        assert abandoned.status == QMoneyPaymentOutbox.Status.FAILED
+        assert abandoned.payload == {}
+        assert proceed(self._one_qmoney_payment, OTP, self._user)['ok']
+
+    def test_canceling_the_payments_whose_request_has_been_abandoned(self):
+        other_policy = get_policy_model().objects.create(
+            status=get_policy_model().STATUS_IDLE)
+        other_qmoney_payment = QMoneyPayment.objects.create(
+            policy=other_policy, amount=10, payer_wallet='payer')
+        # claimed by a worker killed before requesting it
+        QMoneyPaymentOutbox.objects.create(
+            qmoney_payment=other_qmoney_payment,
+            operation=QMoneyPaymentOutbox.Operation.REQUEST,
+            status=QMoneyPaymentOutbox.Status.PROCESSING,
+            claimed_at=timezone.now() - datetime.timedelta(hours=1))
+
+        assert reclaim_abandoned_outbox_entries(lease=60) == 1
+
+        other_qmoney_payment.refresh_from_db()
+        assert other_qmoney_payment.is_canceled()
+        # the policy can be paid again
+        assert QMoneyPayment.objects.create(policy=other_policy,
+                                            amount=10,
+                                            payer_wallet='payer')
+        QMoneyPayment.objects.filter(policy=other_policy).delete()
+        other_policy.delete()
+
+    def test_failing_the_abandoned_calls_from_the_workers(self):
+        reclaimed = threading.Semaphore(0)
+        processed = []
+
+        def reclaim():
+            reclaimed.release()
+
+        def process():
+            processed.append(1)
+            return False
+
+        pool = WorkerPool(process,
+                          size=2,
+                          poll_interval=0.01,
+                          reclaim=reclaim,
+                          reclaim_interval=0.05).start()
+        try:
+            # at once, then every interval
+            assert reclaimed.acquire(timeout=5)
+            assert reclaimed.acquire(timeout=5)
+        finally:
+            pool.stop(5)
+        assert processed
+
+    def test_making_the_calls_left_pending(self):
+        QMoneyPaymentOutbox.objects.create(
+            qmoney_payment=self._one_qmoney_payment,
+            operation=QMoneyPaymentOutbox.Operation.PROCEED,
+            payload={'otp': OTP},
+            user_id='1')
+
+        output = io.StringIO()
+        call_command('process_qmoney_payment_outbox', stdout=output)
+
+        assert output.getvalue() == '1 pending calls made, 1 succeeded\n'
+        self._one_qmoney_payment.refresh_from_db()
+        assert self._one_qmoney_payment.is_proceeded()
+        assert self._one_qmoney_payment.premium is not None
+        assert process_pending_outbox_entries() == []
+
+    def test_requesting_in_the_background(self):
+        other_policy = get_policy_model().objects.create(
+            status=get_policy_model().STATUS_IDLE)
+        other_qmoney_payment = QMoneyPayment.objects.create(
+            policy=other_policy, amount=10, payer_wallet='payer')
+
+        get_money_calls = self._gateway.calls['getMoney']
+        result = enqueue_request(other_qmoney_payment)
+
+        assert result == {'ok': True, 'status': QMoneyPayment.Status.I}
+        assert self._gateway.calls['getMoney'] == get_money_calls
+
+        result = process_next_outbox_entry()
+
+        assert result == {'ok': True, 'status': QMoneyPayment.Status.W}
+        assert self._gateway.calls['getMoney'] == get_money_calls + 1
+        other_qmoney_payment.refresh_from_db()
+        assert other_qmoney_payment.is_waiting_for_confirmation()
+        entry = QMoneyPaymentOutbox.objects.get(
+            qmoney_payment=other_qmoney_payment)
+        assert entry.operation == QMoneyPaymentOutbox.Operation.REQUEST
+        assert entry.status == QMoneyPaymentOutbox.Status.DONE
+        assert process_next_outbox_entry() is None
+        other_policy.delete()
+
+    def test_leaving_a_payment_canceled_while_its_request_was_pending(self):
+        other_policy = get_policy_model().objects.create(
+            status=get_policy_model().STATUS_IDLE)
+        other_qmoney_payment = QMoneyPayment.objects.create(
+            policy=other_policy, amount=10, payer_wallet='payer')
+        enqueue_request(other_qmoney_payment)
+        entry = QMoneyPaymentOutbox.objects.select_related(
+            'qmoney_payment').get(qmoney_payment=other_qmoney_payment)
+        # canceled once the entry has been loaded by a worker
+        QMoneyPayment.objects.get(
+            uuid=other_qmoney_payment.uuid).set_status_after_cancel()
+        get_money_calls = self._gateway.calls['getMoney']
+
+        result = process_outbox_entry(entry)
+
+        assert not result['ok']
+        assert result['status'] == QMoneyPayment.Status.C
+        assert self._gateway.calls['getMoney'] == get_money_calls
+        other_qmoney_payment.refresh_from_db()
+        assert other_qmoney_payment.is_canceled()
+        entry.refresh_from_db()
+        assert entry.status == QMoneyPaymentOutbox.Status.FAILED
+        other_policy.delete()
+
+    def test_failing_a_request_made_in_the_background(self):
+        other_policy = get_policy_model().objects.create(
+            status=get_policy_model().STATUS_IDLE)
+        other_qmoney_payment = QMoneyPayment.objects.create(
+            policy=other_policy, amount=10, payer_wallet='payer')
+        enqueue_request(other_qmoney_payment)
+        merchant = self._config.merchant
+
+        def fail_to_request_payment(*_args):
+            raise ConnectionError('unreachable')
+
+        merchant.request_payment = fail_to_request_payment
+        try:
+            result = process_next_outbox_entry()
+        finally:
+            del merchant.request_payment
+
+        assert not result['ok']
+        other_qmoney_payment.refresh_from_db()
+        # not left initiated, so that its polling ends
+        assert other_qmoney_payment.status == QMoneyPayment.Status.F
+        entry = QMoneyPaymentOutbox.objects.get(
+            qmoney_payment=other_qmoney_payment)
+        assert entry.status == QMoneyPaymentOutbox.Status.FAILED
+        other_policy.delete()
+
+    def test_passing_the_system_checks(self):
+        # e.g. the names of the indexes are at most 30 characters long
+        output = io.StringIO()
+        call_command('check', 'qmoney_payment', stdout=output)
+        assert 'no issues' in output.getvalue()
@@ -0,0 +1,117 @@
+import datetime
+import unittest
+
+from django.db import connection
+from django.db.models import Count, Sum
+from django.test import TestCase
+
+from qmoney_payment.models.qmoney_payment import QMoneyPayment
+from qmoney_payment.models.policy import get_policy_model
+from qmoney_payment.pagination import keyset_condition
+
+from .helpers import is_standalone_django_app_tests
+from .fake_policy import FakePolicy
+from .fake_premium import FakePremium
+from .fakemodel_helpers import setup_table_for, teardown_table_for
+
+
+def explain(queryset):
+    if connection.vendor == 'postgresql':
+        # the tables are too small for the planner to bother with an index
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+    return queryset.explain()
+
+
+@unittest.skipUnless(connection.vendor in ('sqlite', 'postgresql'),
+                     'The plans are only checked on SQLite and PostgreSQL')
+class TestQMoneyPaymentQueryPlans(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        if is_standalone_django_app_tests():
+            setup_table_for(FakePolicy)
+            setup_table_for(FakePremium)
+
+    @classmethod
+    def tearDownClass(cls):
+        if is_standalone_django_app_tests():
+            teardown_table_for(FakePremium)
+            teardown_table_for(FakePolicy)
+
+    def setUp(self):
+        self._one_policy = get_policy_model().objects.create(
+            status=get_policy_model().STATUS_IDLE)
+
+    def assert_using_index(self, queryset, *index_names):
+        plan = explain(queryset)
+        assert any(index_name in plan for index_name in
+                   index_names), f'Expected one of {index_names} in:\n{plan}'
+
+    def assert_seeking_index(self, queryset, index_name, column):
+        # searched from the given bound, not scanned from its start
+        plan = explain(queryset)
+        if connection.vendor == 'sqlite':
+            assert any(
+                'SEARCH' in line and index_name in line and
+                f'{column}>' in line for line in plan.splitlines()
+            ), f'Expected a search of {index_name} on {column} in:\n{plan}'
+        else:
+            assert index_name in plan and any(
+                'Index Cond' in line and column in line
+                for line in plan.splitlines()
+            ), f'Expected an index condition on {column} in:\n{plan}'
+
+    def test_getting_a_qmoney_payment_by_uuid(self):
+        self.assert_using_index(
+            QMoneyPayment.objects.filter(
+                uuid='2a4e0f11-c9c7-4e2b-a1b5-2fd1d6f6d1a8'),
+            'sqlite_autoindex_tblQmoneyPayment_1', 'tblQmoneyPayment_pkey')
+
+    def test_listing_the_qmoney_payments_of_a_policy(self):
+        self.assert_using_index(
+            QMoneyPayment.objects.filter(policy__uuid=self._one_policy.uuid),
+            'qmoney_payment_policy_idx')
+
+    def test_looking_for_the_unproceeded_qmoney_payments_of_a_policy(self):
+        self.assert_using_index(
+            QMoneyPayment.objects.filter(policy_id=self._one_policy.id).exclude(
+                status__in=[QMoneyPayment.Status.P, QMoneyPayment.Status.C]),
+            'qmoney_payment_policy_idx',
+            'qmoney_payment_one_unproceeded_per_policy')
+
+    def test_looking_up_a_qmoney_payment_by_its_transaction(self):
+        self.assert_using_index(
+            QMoneyPayment.objects.filter(external_transaction_id='txn_1'),
+            'qmoney_payment_external_idx')
+
+    def test_listing_the_qmoney_payments_waiting_since_a_given_time(self):
+        self.assert_using_index(
+            QMoneyPayment.objects.filter(
+                status=QMoneyPayment.Status.W,
+                updated_at__lt=datetime.datetime(2024, 1, 1)),
+            'qmoney_payment_status_idx')
+
+    def test_paging_through_the_qmoney_payments_after_a_cursor(self):
+        after_cursor = keyset_condition(
+            ('created_at', 'uuid'),
+            (datetime.datetime(2024, 1, 1),
+             '2a4e0f11-c9c7-4e2b-a1b5-2fd1d6f6d1a8'))
+        self.assert_seeking_index(
+            QMoneyPayment.objects.filter(after_cursor).order_by(
+                'created_at', 'uuid')[:10], 'qmoney_payment_created_idx',
+            'created_at')
+
+    def test_listing_the_qmoney_payments_of_a_payer(self):
+        self.assert_using_index(
+            QMoneyPayment.objects.filter(payer_wallet='7000000').order_by(
+                'created_at', 'uuid'), 'qmoney_payment_wallet_idx')
+
+    def test_computing_the_statistics_of_the_qmoney_payments_over_a_period(self):
+        self.assert_using_index(
+            QMoneyPayment.objects.filter(
+                created_at__gte=datetime.datetime(2024, 1, 1),
+                created_at__lte=datetime.datetime(2024, 12, 31)).values(
+                    'status').annotate(count=Count('uuid'),
+                                       total_amount=Sum('amount')),
+            'qmoney_payment_created_idx')
@@ -0,0 +1,142 @@
+import datetime
+import io
+
+from django.apps import apps
+from django.core.management import call_command
+from django.test import TestCase
+
+from qmoney_payment.api.client import Client as QMoneyClient
+from qmoney_payment.models.qmoney_payment import QMoneyPayment
+from qmoney_payment.models.qmoney_payment_outbox import QMoneyPaymentOutbox
+from qmoney_payment.models.qmoney_payment_policy_summary import QMoneyPaymentPolicySummary
+from qmoney_payment.models.policy import get_policy_model
+from qmoney_payment.models.premium import get_premium_model
+from qmoney_payment.reconciliation import reconcile_stale_payments
+from qmoney_payment.services import request
+
+from .helpers import is_standalone_django_app_tests
+from .fake_policy import FakePolicy
+from .fake_premium import FakePremium
+from .fake_qmoney_gateway import FakeQMoneyGateway
+from .fakemodel_helpers import setup_table_for, teardown_table_for
+
+
+class TestQMoneyPaymentReconciliation(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        if is_standalone_django_app_tests():
+            setup_table_for(FakePolicy)
+            setup_table_for(FakePremium)
+        cls._gateway = FakeQMoneyGateway().start()
+        cls._config = apps.get_app_config('qmoney_payment')
+        cls._previous_session = cls._config.session
+        cls._previous_merchant = cls._config.merchant
+        cls._config.session = QMoneyClient.session(cls._gateway.url,
+                                                   cls._gateway.username,
+                                                   cls._gateway.password,
+                                                   cls._gateway.login_token)
+        cls._config.merchant = cls._config.session.merchant('payee', '1234')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._config.session = cls._previous_session
+        cls._config.merchant = cls._previous_merchant
+        cls._gateway.stop()
+        if is_standalone_django_app_tests():
+            teardown_table_for(FakePremium)
+            teardown_table_for(FakePolicy)
+
+    def setUp(self):
+        self._policies = []
+
+    def tearDown(self):
+        get_premium_model().objects.filter(
+            policy__in=self._policies).delete()
+        for policy in self._policies:
+            policy.delete()
+
+    def create_waiting_payment(self, gateway_status, hours_ago=2):
+        policy = get_policy_model().objects.create(
+            status=get_policy_model().STATUS_IDLE)
+        self._policies.append(policy)
+        qmoney_payment = QMoneyPayment.objects.create(policy=policy,
+                                                      amount=10,
+                                                      payer_wallet='payer')
+        assert request(qmoney_payment)['ok']
+        self._gateway.statuses[
+            qmoney_payment.external_transaction_id] = gateway_status
+        QMoneyPayment.objects.filter(uuid=qmoney_payment.uuid).update(
+            created_at=datetime.datetime.now() -
+            datetime.timedelta(hours=hours_ago))
+        return qmoney_payment
+
+    def status_of(self, qmoney_payment):
+        qmoney_payment.refresh_from_db()
+        return qmoney_payment.status
+
+    def test_resolving_the_stale_payments_with_the_gateway(self):
+        paid = self.create_waiting_payment('SUCCESS')
+        expired = self.create_waiting_payment('EXPIRED')
+        pending = self.create_waiting_payment('PENDING')
+        recent = self.create_waiting_payment('SUCCESS', hours_ago=0)
+
+        reconciliation = reconcile_stale_payments(concurrency=2)
+
+        assert reconciliation.is_finished()
+        assert (reconciliation.examined, reconciliation.proceeded,
+                reconciliation.canceled) == (3, 1, 1)
+        assert self.status_of(paid) == QMoneyPayment.Status.P
+        assert paid.premium is not None
+        assert self.status_of(expired) == QMoneyPayment.Status.C
+        assert self.status_of(pending) == QMoneyPayment.Status.W
+        assert self.status_of(recent) == QMoneyPayment.Status.W
+        summary = QMoneyPaymentPolicySummary.objects.get(
+            policy=expired.policy)
+        # the policy can be paid again
+        assert summary.open_count == 0
+        assert summary.last_status_change_at is not None
+
+    def test_reconciling_a_payment_whose_proceed_has_been_abandoned(self):
+        paid = self.create_waiting_payment('SUCCESS')
+        # by a process killed while verifying its code
+        QMoneyPaymentOutbox.objects.create(
+            qmoney_payment=paid,
+            operation=QMoneyPaymentOutbox.Operation.PROCEED,
+            status=QMoneyPaymentOutbox.Status.PROCESSING,
+            claimed_at=datetime.datetime.now() - datetime.timedelta(hours=1))
+
+        reconciliation = reconcile_stale_payments()
+
+        assert reconciliation.proceeded == 1
+        assert self.status_of(paid) == QMoneyPayment.Status.P
+        assert list(paid.outbox.values_list('status', flat=True)) == [
+            QMoneyPaymentOutbox.Status.FAILED
+        ]
+
+    def test_resuming_an_interrupted_reconciliation(self):
+        for _ in range(3):
+            self.create_waiting_payment('FAILED')
+        calls = self._gateway.calls['getTransactionStatus']
+
+        reconciliation = reconcile_stale_payments(batch_size=2,
+                                                  max_batches=1)
+
+        assert not reconciliation.is_finished()
+        assert reconciliation.examined == 2
+
+        reconciliation = reconcile_stale_payments(batch_size=2)
+
+        assert reconciliation.is_finished()
+        assert (reconciliation.examined, reconciliation.canceled) == (3, 3)
+        # none has been asked twice
+        assert self._gateway.calls['getTransactionStatus'] == calls + 3
+
+    def test_reconciling_with_the_command(self):
+        self.create_waiting_payment('SUCCESS')
+
+        output = io.StringIO()
+        call_command('reconcile_qmoney_payments', stdout=output)
+
+        assert output.getvalue(
+        ) == '1 payments examined, 1 proceeded, 0 canceled (finished)\n'
@@ -0,0 +1,199 @@
+import socket
+import time
+from unittest import TestCase
+
+from qmoney_payment.api.gateway_response import GatewayResponse
+from qmoney_payment.api.resilience import CircuitBreaker, Resilience, RetryPolicy, deadline
+from qmoney_payment.api.session import Session
+from qmoney_payment.api.transport import Transport
+
+from .test_token_manager import FakeClock
+
+Kind = GatewayResponse.Kind
+
+
+def unused_url():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return f'http://127.0.0.1:{sock.getsockname()[1]}'
+
+
+class FakeGateway:
+
+    def __init__(self, clock, responses, duration=0):
+        self.clock = clock
+        self.responses = list(responses)
+        self.duration = duration
+        self.timeouts = []
+
+    def __call__(self, timeout):
+        self.timeouts.append(timeout)
+        self.clock.now += self.duration
+        return self.responses.pop(0)
+
+
+def response(kind, status_code=200):
+    return GatewayResponse(kind, status_code)
+
+
+class TestResilience(TestCase):
+
+    def new_resilience(self, clock, **kwargs):
+        sleeps = []
+
+        def sleep(delay):
+            sleeps.append(delay)
+            clock.now += delay
+
+        resilience = Resilience(RetryPolicy(jitter=lambda: 1),
+                                clock=clock,
+                                sleep=sleep,
+                                **kwargs)
+        return resilience, sleeps
+
+    def test_retrying_a_login_with_exponential_backoff(self):
+        clock = FakeClock()
+        resilience, sleeps = self.new_resilience(clock)
+        gateway = FakeGateway(clock, [
+            response(Kind.HTTP_ERROR, 502),
+            response(Kind.TRANSPORT_ERROR, None),
+            response(Kind.OK)
+        ])
+
+        assert resilience.call('login', gateway, (10, 100)).ok
+        assert sleeps == [0.2, 0.4]
+        stats = resilience.stats()['login']
+        assert stats['attempts'] == 3
+        assert stats['retries'] == 2
+        assert stats['failures'] == 2
+
+    def test_not_retrying_a_payment_which_may_have_been_sent(self):
+        clock = FakeClock()
+        resilience, sleeps = self.new_resilience(clock)
+        gateway = FakeGateway(clock, [
+            response(Kind.TRANSPORT_ERROR, None),
+            response(Kind.OK),
+        ])
+
+        assert resilience.call('getMoney', gateway,
+                               (10, 100)).kind is Kind.TRANSPORT_ERROR
+        assert not sleeps
+
+        gateway = FakeGateway(clock, [
+            response(Kind.CONNECT_ERROR, None),
+            response(Kind.OK),
+        ])
+        assert resilience.call('getMoney', gateway, (10, 100)).ok
+        assert len(sleeps) == 1
+
+    def test_not_retrying_a_refused_payment(self):
+        clock = FakeClock()
+        resilience, _sleeps = self.new_resilience(clock)
+        gateway = FakeGateway(clock, [response(Kind.REJECTED)])
+
+        assert resilience.call('login', gateway,
+                               (10, 100)).kind is Kind.REJECTED
+        assert resilience.stats()['login']['failures'] == 0
+
+    def test_opening_the_circuit_after_repeated_failures(self):
+        clock = FakeClock()
+        resilience, _sleeps = self.new_resilience(clock,
+                                                  failure_threshold=2,
+                                                  reset_timeout=30)
+        gateway = FakeGateway(clock, [response(Kind.HTTP_ERROR, 503)] * 2 +
+                              [response(Kind.OK)])
+
+        for _ in range(2):
+            resilience.call('getMoney', gateway, (10, 100))
+        assert resilience.stats()['getMoney']['circuit'] == 'open'
+        assert resilience.call('getMoney', gateway,
+                               (10, 100)).kind is Kind.CIRCUIT_OPEN
+        assert resilience.stats()['getMoney']['short_circuited'] == 1
+        # the other endpoints are not affected
+        assert resilience.stats().get('verifyCode') is None
+
+        clock.now += 30
+        assert resilience.call('getMoney', gateway, (10, 100)).ok
+        assert resilience.stats()['getMoney']['circuit'] == 'closed'
+
+    def test_letting_a_single_probe_through_a_half_open_circuit(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=1,
+                                 reset_timeout=10,
+                                 clock=clock)
+        breaker.record_failure()
+        assert not breaker.allow()
+        clock.now += 10
+        assert breaker.allow()
+        assert not breaker.allow()
+        breaker.record_failure()
+        assert breaker.state is CircuitBreaker.State.OPEN
+
+    def test_bounding_the_attempts_by_the_deadline(self):
+        clock = FakeClock()
+        resilience, _sleeps = self.new_resilience(clock,
+                                                  deadline_seconds=15)
+        gateway = FakeGateway(clock, [response(Kind.CONNECT_ERROR, None)] * 2,
+                              duration=10)
+
+        with resilience.deadline():
+            assert resilience.call('getMoney', gateway,
+                                   (10, 100)).kind is Kind.CONNECT_ERROR
+            # the second attempt only has what is left of the deadline and
+            # there is no time left for a third one
+            assert [(round(connect, 3), round(read, 3))
+                    for connect, read in gateway.timeouts] == [(10, 15),
+                                                              (4.8, 4.8)]
+            assert resilience.call('verifyCode', gateway,
+                                   (10, 100)).kind is Kind.DEADLINE_EXCEEDED
+        assert resilience.stats()['verifyCode']['deadline_exceeded'] == 1
+
+    def test_keeping_the_tightest_deadline(self):
+        clock = FakeClock()
+        with deadline(5, clock) as outer:
+            with deadline(60, clock) as inner:
+                assert inner == outer == clock.now + 5
+
+    def test_building_from_settings(self):
+        resilience = Resilience.from_settings({
+            'max_attempts': '5',
+            'retry_base_delay': '0.5',
+            'circuit_failure_threshold': '',
+            'deadline': '0',
+        })
+        assert resilience.retry_policy.max_attempts == 5
+        assert resilience.retry_policy.base_delay == 0.5
+        assert resilience.failure_threshold == 5
+        assert resilience.deadline_seconds is None
+
+    def test_deadline_of_one_whole_call_by_default(self):
+        assert Resilience().deadline_seconds == sum(Transport().timeout())
+        resilience = Resilience.from_settings({}, (10, 200))
+        assert resilience.deadline_seconds == 210
+        resilience = Resilience.from_settings({'deadline': '30'}, (10, 200))
+        assert resilience.deadline_seconds == 30
+
+
+class TestSessionResilience(TestCase):
+
+    def test_failing_fast_when_the_gateway_is_down(self):
+        resilience = Resilience(RetryPolicy(base_delay=0.01),
+                                failure_threshold=3)
+        session = Session(unused_url(),
+                          'username',
+                          'password',
+                          'token',
+                          Transport(connect_timeout=1),
+                          resilience=resilience)
+
+        response = session.get_money('payer', 'payee', 1, '1234')
+        assert response.kind is Kind.LOGIN_FAILED
+        stats = resilience.stats()['login']
+        assert stats['attempts'] == 3
+        assert stats['circuit'] == 'open'
+
+        started_at = time.monotonic()
+        response = session.get_money('payer', 'payee', 1, '1234')
+        assert response.kind is Kind.LOGIN_FAILED
+        assert time.monotonic() - started_at < 0.5
+        assert resilience.stats()['login']['short_circuited'] == 1
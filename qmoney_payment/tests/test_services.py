@@ -1,9 +1,16 @@
+import datetime
 import os
+
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
 from qmoney_payment.models.qmoney_payment import QMoneyPayment
+from qmoney_payment.models.qmoney_payment_outbox import QMoneyPaymentOutbox
+from qmoney_payment.models.qmoney_payment_policy_summary import QMoneyPaymentPolicySummary
 from qmoney_payment.models.policy import get_policy_model, status_to_string
-from qmoney_payment.services import create_premium_for
+from qmoney_payment.models.premium import get_premium_model
+from qmoney_payment.services import create_premium_for, create_premiums_for, expire_waiting_payments
 
 from .helpers import Struct
 from .fake_policy import FakePolicy
@@ -95,3 +102,142 @@ class TestServices(TestCase):
         assert one_qmoney_payment.premium == premium, f'Premium should be set but it is not the right one {one_qmoney_payment.premium.uuid} vs {premium.uuid}'
 
         premium.delete()
+
+    def test_creating_the_premiums_of_several_payments_at_once(self):
+        policies = [self._one_policy] + [
+            get_policy_model().objects.create(
+                status=get_policy_model().STATUS_IDLE) for _ in range(2)
+        ]
+        qmoney_payments = [
+            QMoneyPayment.objects.create(policy=policy,
+                                         amount=index + 1,
+                                         status=QMoneyPayment.Status.P)
+            for index, policy in enumerate(policies)
+        ]
+        waiting = QMoneyPayment.objects.create(policy=policies[1],
+                                               amount=1,
+                                               status=QMoneyPayment.Status.W)
+
+        with CaptureQueriesContext(connection) as context:
+            premiums = create_premiums_for(qmoney_payments + [waiting],
+                                           Struct(id_for_audit='1'))
+
+        assert len(premiums) == len(qmoney_payments)
+        for qmoney_payment, premium in zip(qmoney_payments, premiums):
+            qmoney_payment.refresh_from_db()
+            assert qmoney_payment.premium == premium
+            assert premium.amount == qmoney_payment.amount
+            assert premium.receipt == qmoney_payment.uuid
+            assert premium.policy == qmoney_payment.policy
+        waiting.refresh_from_db()
+        assert waiting.premium is None
+        assert set(
+            get_policy_model().objects.filter(
+                id__in=[policy.id for policy in policies]).values_list(
+                    'status',
+                    flat=True)) == {get_policy_model().STATUS_ACTIVE}
+        # the payments without premium locked, one INSERT, one UPDATE of the
+        # policies, one of the payments
+        assert len([
+            query for query in context.captured_queries
+            if not query['sql'].startswith(('SAVEPOINT', 'RELEASE'))
+        ]) <= 5
+
+        for premium in premiums:
+            premium.delete()
+        for policy in policies[1:]:
+            policy.delete()
+
+    def test_creating_one_premium_for_a_payment_proceeded_twice(self):
+        other_policy = get_policy_model().objects.create(
+            status=get_policy_model().STATUS_IDLE)
+        proceeded = QMoneyPayment.objects.create(policy=self._one_policy,
+                                                 amount=1,
+                                                 status=QMoneyPayment.Status.P)
+        other = QMoneyPayment.objects.create(policy=other_policy,
+                                             amount=1,
+                                             status=QMoneyPayment.Status.P)
+        user = Struct(id_for_audit='1')
+        # loaded before its premium is created
+        stale = QMoneyPayment.objects.get(uuid=proceeded.uuid)
+        ok, premium = create_premium_for(proceeded, user)
+        assert ok
+
+        premiums = create_premiums_for([stale, other, other], user)
+
+        assert len(premiums) == 1
+        assert get_premium_model().objects.filter(
+            policy=self._one_policy).count() == 1
+        assert get_premium_model().objects.filter(
+            policy=other_policy).count() == 1
+        proceeded.refresh_from_db()
+        assert proceeded.premium == premium
+
+        premiums[0].delete()
+        premium.delete()
+        other_policy.delete()
+
+    def create_waiting_payment(self, policy=None, hours_ago=2):
+        if policy is None:
+            policy = get_policy_model().objects.create(
+                status=get_policy_model().STATUS_IDLE)
+        one_qmoney_payment = QMoneyPayment.objects.create(
+            policy=policy, amount=1, status=QMoneyPayment.Status.W)
+        QMoneyPayment.objects.filter(uuid=one_qmoney_payment.uuid).update(
+            updated_at=datetime.datetime.now() -
+            datetime.timedelta(hours=hours_ago))
+        return one_qmoney_payment
+
+    def test_expiring_the_qmoney_payments_waiting_for_too_long(self):
+        expired = self.create_waiting_payment(self._one_policy)
+        recent = self.create_waiting_payment(hours_ago=0)
+        # created long ago, but waiting for an OTP since recently
+        QMoneyPayment.objects.filter(uuid=recent.uuid).update(
+            created_at=datetime.datetime.now() - datetime.timedelta(hours=2))
+        being_proceeded = self.create_waiting_payment()
+        QMoneyPaymentOutbox.objects.create(
+            qmoney_payment=being_proceeded,
+            operation=QMoneyPaymentOutbox.Operation.PROCEED,
+            status=QMoneyPaymentOutbox.Status.PROCESSING)
+        failed_to_proceed = self.create_waiting_payment()
+        QMoneyPaymentOutbox.objects.create(
+            qmoney_payment=failed_to_proceed,
+            operation=QMoneyPaymentOutbox.Operation.PROCEED,
+            status=QMoneyPaymentOutbox.Status.FAILED)
+        # the updated_at of the entry isn't the one of the payment
+        QMoneyPayment.objects.filter(uuid=failed_to_proceed.uuid).update(
+            updated_at=datetime.datetime.now() - datetime.timedelta(hours=2))
+
+        assert expire_waiting_payments(ttl=3600) == 2
+
+        for payment in (expired, recent, being_proceeded, failed_to_proceed):
+            payment.refresh_from_db()
+        assert expired.status == QMoneyPayment.Status.C
+        assert recent.status == QMoneyPayment.Status.W
+        assert being_proceeded.status == QMoneyPayment.Status.W
+        assert failed_to_proceed.status == QMoneyPayment.Status.C
+        assert QMoneyPaymentPolicySummary.objects.get(
+            policy=self._one_policy).open_count == 0
+        # the policy is free to be paid again
+        QMoneyPayment.objects.create(policy=self._one_policy, amount=1)
+        recent.policy.delete()
+        being_proceeded.policy.delete()
+        failed_to_proceed.policy.delete()
+
+    def test_expiring_the_qmoney_payments_in_set_based_batches(self):
+        payments = [self.create_waiting_payment() for _ in range(5)]
+
+        with CaptureQueriesContext(connection) as context:
+            assert expire_waiting_payments(ttl=3600, batch_size=2) == 5
+
+        updates_of_payments = [
+            query for query in context.captured_queries
+            if query['sql'].startswith('UPDATE "tblQmoneyPayment"')
+        ]
+        # one per batch, whatever the number of payments in it
+        assert len(updates_of_payments) == 3
+        assert QMoneyPaymentPolicySummary.objects.filter(
+            policy__in=[payment.policy for payment in payments],
+            open_count=0).count() == 5
+        for payment in payments:
+            payment.policy.delete()
@@ -0,0 +1,94 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+
+from qmoney_payment.api.client import Client as QMoneyClient
+from qmoney_payment.api.session import Session
+from qmoney_payment.api.transport import Transport
+
+from .fake_qmoney_gateway import FakeQMoneyGateway
+
+
+class TestSession(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls._gateway = FakeQMoneyGateway().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._gateway.stop()
+
+    def new_session(self, transport=None):
+        return Session(self._gateway.url, self._gateway.username,
+                       self._gateway.password, self._gateway.login_token,
+                       transport)
+
+    def test_requesting_and_proceeding_a_payment(self):
+        session = self.new_session()
+
+        response = session.get_money('payer', 'payee', 1, '1234')
+        assert response.ok
+        assert response.transaction_id is not None
+        assert session.is_logged_in()
+
+        transaction_id = response.transaction_id
+        response = session.verify_code(transaction_id,
+                                       self._gateway.otp_for(transaction_id))
+        assert response.ok
+        assert response.transaction_id == transaction_id
+
+    def test_fetching_the_status_of_a_transaction(self):
+        session = self.new_session()
+        transaction_id = session.get_money('payer', 'payee', 1,
+                                           '1234').transaction_id
+
+        response = session.get_transaction_status(transaction_id)
+        assert response.ok
+        assert response.data['status'] == 'PENDING'
+
+        session.verify_code(transaction_id,
+                            self._gateway.otp_for(transaction_id))
+        response = session.get_transaction_status(transaction_id)
+        assert response.data['status'] == 'SUCCESS'
+
+    def test_reusing_connections_across_calls(self):
+        session = self.new_session()
+        session.login()
+        connections_before = self._gateway.connections
+
+        for _ in range(10):
+            assert session.get_money('payer', 'payee', 1, '1234').ok
+
+        assert self._gateway.connections == connections_before
+
+    def test_sharing_one_transport_across_threads(self):
+        session = self.new_session(Transport(pool_maxsize=4))
+        session.login()
+        connections_before = self._gateway.connections
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            transaction_ids = list(
+                executor.map(
+                    lambda _: session.get_money('payer', 'payee', 1, '1234').
+                    transaction_id, range(40)))
+
+        assert None not in transaction_ids
+        assert len(set(transaction_ids)) == 40
+        assert self._gateway.connections - connections_before <= 4
+
+    def test_building_transport_from_settings(self):
+        session = QMoneyClient.session(
+            self._gateway.url, self._gateway.username, self._gateway.password,
+            self._gateway.login_token, {
+                'pool_connections': '2',
+                'pool_maxsize': '8',
+                'pool_block': 'true',
+                'connect_timeout': '1.5',
+                'read_timeout': None,
+            })
+
+        transport = session.transport
+        assert transport.pool_connections == 2
+        assert transport.pool_maxsize == 8
+        assert transport.pool_block is True
+        assert transport.timeout() == (1.5, 100)
@@ -0,0 +1,127 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+
+from qmoney_payment.api.session import Session
+from qmoney_payment.api.token_manager import AccessToken, TokenManager
+
+from .fake_qmoney_gateway import FakeQMoneyGateway
+
+
+class FakeClock:
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenManager(TestCase):
+
+    def counting_fetch(self, clock, expires_in=300, delay=0):
+        calls = []
+
+        def fetch():
+            calls.append(clock())
+            time.sleep(delay)
+            return AccessToken(f'token-{len(calls)}', clock() + expires_in)
+
+        return fetch, calls
+
+    def test_reading_expiry_from_login_data(self):
+        token = AccessToken.from_login_data(
+            {
+                'access_token': 'abc',
+                'expires_in': 300
+            }, 1000)
+        assert token.expires_at == 1300
+
+        token = AccessToken.from_login_data(
+            {
+                'access_token': 'abc',
+                'accessTokenExpiry': '-1'
+            }, 1000)
+        assert token.expires_at is None
+        assert not token.is_expired(10**12)
+
+    def test_reusing_the_token_until_it_expires(self):
+        clock = FakeClock()
+        fetch, calls = self.counting_fetch(clock)
+        tokens = TokenManager(fetch, refresh_margin=0, clock=clock)
+
+        assert tokens.get() == 'token-1'
+        clock.now += 299
+        assert tokens.get() == 'token-1'
+        clock.now += 1
+        assert tokens.current() is None
+        assert tokens.get() == 'token-2'
+        assert len(calls) == 2
+
+    def test_refreshing_in_background_ahead_of_expiry(self):
+        clock = FakeClock()
+        fetch, calls = self.counting_fetch(clock)
+        tokens = TokenManager(fetch, refresh_margin=60, clock=clock)
+
+        assert tokens.get() == 'token-1'
+        clock.now += 250
+        # still valid, so it is returned while the refresh happens
+        assert tokens.get() == 'token-1'
+        deadline = time.time() + 5
+        while tokens.current() != 'token-2' and time.time() < deadline:
+            time.sleep(0.01)
+        assert tokens.current() == 'token-2'
+        assert len(calls) == 2
+
+    def test_sharing_a_single_in_flight_login(self):
+        clock = FakeClock()
+        fetch, calls = self.counting_fetch(clock, delay=0.2)
+        tokens = TokenManager(fetch, clock=clock)
+        barrier = threading.Barrier(16)
+
+        def get_token(_):
+            barrier.wait()
+            return tokens.get()
+
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            values = list(executor.map(get_token, range(16)))
+
+        assert values == ['token-1'] * 16
+        assert len(calls) == 1
+
+    def test_propagating_login_failure_to_all_waiting_callers(self):
+
+        def fetch():
+            time.sleep(0.1)
+            raise KeyError('data')
+
+        tokens = TokenManager(fetch)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(tokens.get) for _ in range(4)]
+        for future in futures:
+            assert isinstance(future.exception(), KeyError)
+        assert tokens.current() is None
+
+
+class TestSessionAccessToken(TestCase):
+
+    def test_logging_in_again_when_the_access_token_expired(self):
+        with FakeQMoneyGateway(token_ttl=1) as gateway:
+            session = Session(gateway.url, gateway.username, gateway.password,
+                              gateway.login_token, refresh_margin=0)
+            assert session.get_money('payer', 'payee', 1, '1234').ok
+            time.sleep(1.1)
+            assert session.get_money('payer', 'payee', 1, '1234').ok
+            assert gateway.calls['login'] == 2
+
+    def test_retrying_once_after_a_401(self):
+        with FakeQMoneyGateway() as gateway:
+            session = Session(gateway.url, gateway.username, gateway.password,
+                              gateway.login_token)
+            session.login()
+            gateway.revoke_access_tokens()
+
+            assert session.get_money('payer', 'payee', 1, '1234').ok
+            assert gateway.calls['login'] == 2
+            assert gateway.calls['getMoney'] == 2
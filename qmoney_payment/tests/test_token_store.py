@@ -0,0 +1,203 @@
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from qmoney_payment.api.access_token import AccessToken
+from qmoney_payment.api.session import Session
+from qmoney_payment.api.resilience import Resilience, deadline
+from qmoney_payment.api.token_manager import AsyncTokenManager, TokenManager
+from qmoney_payment.api.token_store import DjangoCacheTokenStore, FileLockTokenStore, LocalMemoryTokenStore, RefreshLockTimeout, token_key, token_store_from_settings
+from qmoney_payment.api.transport import Transport
+
+from .fake_qmoney_gateway import FakeQMoneyGateway
+
+WORKERS = 8
+
+
+def request_payments_from_a_worker(gateway, token_store_path, barrier):
+    session = Session(gateway['url'],
+                      gateway['username'],
+                      gateway['password'],
+                      gateway['login_token'],
+                      refresh_margin=0,
+                      token_store=FileLockTokenStore(token_store_path))
+    barrier.wait()
+    for _ in range(3):
+        if not session.get_money('payer', 'payee', 1, '1234').ok:
+            os._exit(1)  # pylint: disable=protected-access
+    os._exit(0)  # pylint: disable=protected-access
+
+
+class TestTokenStore(TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self._token_store_path = os.path.join(self._directory.name,
+                                              'token.json')
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def assert_sharing_token_between_stores(self, one_store, another_store):
+        assert one_store.load() is None
+        one_store.save(AccessToken('abc', time.time() + 60))
+        assert another_store.load().value == 'abc'
+        another_store.discard('not-the-token')
+        assert one_store.load().value == 'abc'
+        another_store.discard('abc')
+        assert one_store.load() is None
+
+    def test_sharing_token_through_a_file(self):
+        self.assert_sharing_token_between_stores(
+            FileLockTokenStore(self._token_store_path),
+            FileLockTokenStore(self._token_store_path))
+
+    def test_sharing_token_through_django_cache(self):
+        key = token_key('http://qmoney', f'user-{time.time()}')
+        self.assert_sharing_token_between_stores(DjangoCacheTokenStore(key),
+                                                 DjangoCacheTokenStore(key))
+
+    def test_building_store_from_settings(self):
+        key = token_key('http://qmoney', 'user')
+        assert isinstance(token_store_from_settings({}, key),
+                          LocalMemoryTokenStore)
+        store = token_store_from_settings(
+            {
+                'store': 'file',
+                'store_path': self._token_store_path
+            }, key)
+        assert isinstance(store, FileLockTokenStore)
+        assert store.path == self._token_store_path
+        store = token_store_from_settings({'store': 'django_cache'}, key)
+        assert isinstance(store, DjangoCacheTokenStore)
+        assert store.key == key
+        # the refresh lock outlives the longest login
+        lock_timeout = Resilience().longest_call(Transport().timeout())
+        assert lock_timeout > Transport().read_timeout
+        store = token_store_from_settings({'store': 'django_cache'}, key,
+                                          lock_timeout)
+        assert store.lock_timeout == lock_timeout
+
+    def test_never_logging_in_without_the_refresh_lock(self):
+        key = token_key('http://qmoney', f'user-{time.time()}')
+        store = DjangoCacheTokenStore(key, lock_timeout=0.2)
+        # held by a worker still logging in
+        store.cache.add(store.lock_key, 'another-worker', timeout=60)
+        logins = []
+
+        def fetch():
+            logins.append(1)
+            return AccessToken('abc', time.time() + 300)
+
+        with self.assertRaises(RefreshLockTimeout):
+            with store.refresh_lock():
+                pass
+        with self.assertRaises(RefreshLockTimeout):
+            TokenManager(fetch, store=store).get()
+        assert logins == []
+
+        # the token stored meanwhile by the holder of the lock is used
+        timer = threading.Timer(
+            0.1, store.save, args=[AccessToken('def', time.time() + 300)])
+        timer.start()
+        assert TokenManager(fetch, store=store).get() == 'def'
+        timer.join()
+        assert logins == []
+        store.cache.delete(store.lock_key)
+
+    def test_waiting_for_the_refresh_lock_until_the_deadline_at_most(self):
+        key = token_key('http://qmoney', f'user-{time.time()}')
+        store = DjangoCacheTokenStore(key, lock_timeout=60)
+        store.cache.add(store.lock_key, 'another-worker', timeout=60)
+
+        started_at = time.monotonic()
+        with self.assertRaises(RefreshLockTimeout):
+            with deadline(0.2):
+                with store.refresh_lock():
+                    pass
+
+        assert time.monotonic() - started_at < 5
+        store.cache.delete(store.lock_key)
+
+    def test_never_logging_in_without_the_refresh_lock_asynchronously(self):
+        key = token_key('http://qmoney', f'user-{time.time()}')
+        store = DjangoCacheTokenStore(key, lock_timeout=0.2)
+        # held by a worker still logging in
+        store.cache.add(store.lock_key, 'another-worker', timeout=60)
+        logins = []
+
+        async def fetch():
+            logins.append(store.cache.get(store.lock_key))
+            return AccessToken('abc', time.time() + 300)
+
+        with self.assertRaises(RefreshLockTimeout):
+            asyncio.run(AsyncTokenManager(fetch, store=store).get())
+        assert logins == []
+
+        # the token stored meanwhile by the holder of the lock is used
+        timer = threading.Timer(
+            0.1, store.save, args=[AccessToken('def', time.time() + 300)])
+        timer.start()
+        assert asyncio.run(AsyncTokenManager(fetch, store=store).get()) == 'def'
+        timer.join()
+        assert logins == []
+
+        # logged in under the lock once released
+        store.cache.delete(store.lock_key)
+        assert asyncio.run(
+            AsyncTokenManager(fetch, store=store).refresh('def')) == 'abc'
+        assert len(logins) == 1 and logins[0] is not None
+        assert store.cache.get(store.lock_key) is None
+        assert asyncio.run(AsyncTokenManager(fetch, store=store).get()) == 'abc'
+        assert len(logins) == 1
+
+    def test_logging_in_once_for_sessions_sharing_a_store(self):
+        key = token_key('http://qmoney', f'user-{time.time()}')
+        with FakeQMoneyGateway() as gateway:
+            sessions = [
+                Session(gateway.url,
+                        gateway.username,
+                        gateway.password,
+                        gateway.login_token,
+                        token_store=DjangoCacheTokenStore(key))
+                for _ in range(3)
+            ]
+            for session in sessions:
+                assert session.get_money('payer', 'payee', 1, '1234').ok
+            assert gateway.calls['login'] == 1
+
+    def run_workers(self, gateway):
+        context = multiprocessing.get_context('fork')
+        barrier = context.Barrier(WORKERS)
+        gateway_settings = {
+            'url': gateway.url,
+            'username': gateway.username,
+            'password': gateway.password,
+            'login_token': gateway.login_token,
+        }
+        workers = [
+            context.Process(target=request_payments_from_a_worker,
+                            args=(gateway_settings, self._token_store_path,
+                                  barrier)) for _ in range(WORKERS)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(30)
+        assert [worker.exitcode for worker in workers] == [0] * WORKERS
+
+    def test_logging_in_once_per_expiry_window_across_processes(self):
+        with FakeQMoneyGateway(token_ttl=2) as gateway:
+            self.run_workers(gateway)
+            assert gateway.calls['login'] == 1
+            assert gateway.calls['getMoney'] == WORKERS * 3
+
+            time.sleep(2.1)
+
+            self.run_workers(gateway)
+            assert gateway.calls['login'] == 2
+            assert gateway.calls['getMoney'] == WORKERS * 3 * 2
@@ -0,0 +1,68 @@
+import threading
+import time
+
+from django.test import TestCase
+
+from qmoney_payment.workers import WorkerPool
+
+
+class TestWorkerPool(TestCase):
+
+    def test_processing_until_there_is_nothing_left(self):
+        pending = list(range(20))
+        processed = []
+        lock = threading.Lock()
+
+        def process():
+            with lock:
+                if not pending:
+                    return None
+                processed.append(pending.pop())
+                return processed[-1]
+
+        pool = WorkerPool(process, size=3, poll_interval=60)
+        pool.notify()
+        try:
+            for _ in range(100):
+                with lock:
+                    if not pending:
+                        break
+                time.sleep(0.05)
+        finally:
+            pool.stop(timeout=5)
+
+        assert sorted(processed) == list(range(20))
+        assert not pool.is_running()
+
+    def test_keeping_on_after_a_failure(self):
+        calls = []
+        done = threading.Event()
+
+        def process():
+            calls.append(None)
+            if len(calls) == 1:
+                raise RuntimeError('failing once')
+            done.set()
+            return None
+
+        pool = WorkerPool(process, size=1, poll_interval=0.01).start()
+        try:
+            assert done.wait(5)
+        finally:
+            pool.stop(timeout=5)
+
+    def test_not_starting_any_worker_when_disabled(self):
+        pool = WorkerPool(lambda: None, size=0)
+        pool.notify()
+
+        assert not pool.is_running()
+
+    def test_reading_the_settings(self):
+        pool = WorkerPool.from_settings(lambda: None, {
+            'size': '4',
+            'queue_depth': '',
+            'poll_interval': '0.5'
+        })
+
+        assert (pool.size, pool.queue_depth, pool.poll_interval) == (4, 100,
+                                                                      0.5)
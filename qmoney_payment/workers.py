@@ -0,0 +1,130 @@
+import logging
+import threading
+import time
+
+from django.db import close_old_connections, connection
+
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE_DEPTH = 100
+DEFAULT_POLL_INTERVAL = 1
+DEFAULT_RECLAIM_INTERVAL = 60
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool:
+    # Threads calling `process` until there is nothing left to process, then
+    # waiting to be notified or for `poll_interval` seconds. The queue is
+    # the outbox table, so that the calls recorded by one process can be
+    # made by the workers of another one, and survive a restart. Every
+    # `reclaim_interval` seconds, one of them calls `reclaim`, e.g. to
+    # release the calls abandoned by the workers of a killed process.
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self,
+            process,
+            size=DEFAULT_WORKERS,
+            queue_depth=DEFAULT_QUEUE_DEPTH,
+            poll_interval=DEFAULT_POLL_INTERVAL,
+            reclaim=None,
+            reclaim_interval=DEFAULT_RECLAIM_INTERVAL,
+            clock=time.monotonic):
+        self.process = process
+        self.size = size
+        self.queue_depth = queue_depth
+        self.poll_interval = poll_interval
+        self.reclaim = reclaim
+        self.reclaim_interval = reclaim_interval
+        self.clock = clock
+        # due at once
+        self.reclaim_at = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.notified = False
+        self.stopping = False
+        self.threads = []
+
+    @classmethod
+    def from_settings(cls, process, settings, reclaim=None):
+        conversions = {
+            'size': int,
+            'queue_depth': int,
+            'poll_interval': float,
+            'reclaim_interval': float,
+        }
+        values = {
+            name: convert(settings[name])
+            for name, convert in conversions.items()
+            if settings.get(name) not in (None, '')
+        }
+        return cls(process, reclaim=reclaim, **values)
+
+    def is_running(self):
+        with self.lock:
+            return bool(self.threads)
+
+    def start(self):
+        with self.lock:
+            if self.threads or self.size <= 0:
+                return self
+            self.stopping = False
+            self.threads = [
+                threading.Thread(target=self.__run,
+                                 name=f'qmoney-payment-worker-{index}',
+                                 daemon=True) for index in range(self.size)
+            ]
+            for thread in self.threads:
+                thread.start()
+        return self
+
+    def notify(self):
+        self.start()
+        with self.wakeup:
+            self.notified = True
+            self.wakeup.notify()
+
+    def stop(self, timeout=None):
+        with self.wakeup:
+            self.stopping = True
+            threads, self.threads = self.threads, []
+            self.wakeup.notify_all()
+        for thread in threads:
+            thread.join(timeout)
+
+    def __run(self):
+        try:
+            while not self.stopping:
+                close_old_connections()
+                self.__reclaim_if_due()
+                if self.__process():
+                    continue
+                with self.wakeup:
+                    if not self.notified and not self.stopping:
+                        self.wakeup.wait(self.poll_interval)
+                    self.notified = False
+        finally:
+            # the connection of the thread
+            connection.close()
+
+    def __process(self):
+        try:
+            return self.process()
+        except Exception:  # pylint: disable=broad-except
+            # the worker has to keep on with the next ones
+            logger.exception('QMoney payment worker failed to process a call')
+            return False
+
+    def __reclaim_if_due(self):
+        if self.reclaim is None:
+            return
+        with self.lock:
+            now = self.clock()
+            if self.reclaim_at is not None and now < self.reclaim_at:
+                return
+            # by a single worker
+            self.reclaim_at = now + self.reclaim_interval
+        try:
+            self.reclaim()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception(
+                'QMoney payment worker failed to reclaim the abandoned calls')